@@ -0,0 +1,80 @@
+"""
+Benchmark of the PDF path against the local Eurofins stand-in: throughput, memory and concurrency of PDF.get_pdf
+and PDF.get_pdfs.
+
+    python -m benchmarks.bench_pdf --documents 200 --size 200000 --latency 0.05 --workers 1 --workers 8
+"""
+import resource
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import click
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.pdf import PDF
+from efa_30mhz.simulator.eurofins import EurofinsSimulator
+
+
+def rows(documents: int, relations: int) -> List[Dict]:
+    return [{"relation_id": i % relations, "resource_id": i} for i in range(documents)]
+
+
+def consume(files) -> int:
+    size = 0
+    for f in files:
+        size += len(f.read())
+        f.close()
+    return size
+
+
+def measure(simulator: EurofinsSimulator, run: Callable[[], int]) -> Dict:
+    simulator.calls = 0
+    simulator.max_in_flight = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = run()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "mb_per_second": size / seconds / 1e6,
+        "calls": simulator.calls,
+        "max_in_flight": simulator.max_in_flight,
+        "peak_mb": peak / 1e6,
+    }
+
+
+@click.command()
+@click.option("--documents", type=int, default=100)
+@click.option("--relations", type=int, default=10)
+@click.option("--size", type=int, default=200 * 1024, help="Bytes per PDF")
+@click.option("--latency", type=float, default=0.05, help="Seconds per getResource call")
+@click.option("--workers", multiple=True, type=int, default=[1, 4, 8])
+@click.option("--resources-per-request", multiple=True, type=int, default=[1, 5])
+@click.option("--spool-size", type=int, default=1024 * 1024)
+def main(documents, relations, size, latency, workers, resources_per_request, spool_size):
+    Metric.initialize_client(backend="null")
+    with EurofinsSimulator(document_size=size, latency=latency) as simulator:
+        print(f"{documents} PDFs of {size} bytes, {latency}s per call")
+        print(f"{'method':>24} {'docs/s':>8} {'MB/s':>8} {'calls':>6} {'in flight':>9} {'peak MB':>8}")
+
+        def report(name, result):
+            print(
+                f"{name:>24} {documents / result['seconds']:8.1f} {result['mb_per_second']:8.2f} "
+                f"{result['calls']:6d} {result['max_in_flight']:9d} {result['peak_mb']:8.2f}"
+            )
+
+        pdf = PDF(simulator.wsdl, spool_size=spool_size)
+        report("get_pdf", measure(simulator, lambda: consume(pdf.get_pdf(r) for r in rows(documents, relations))))
+        for w in workers:
+            for per_request in resources_per_request:
+                pdf = PDF(simulator.wsdl, workers=w, resources_per_request=per_request, spool_size=spool_size)
+                result = measure(simulator, lambda: consume(pdf.get_pdfs(rows(documents, relations)).values()))
+                report(f"get_pdfs w={w} r={per_request}", result)
+    print(f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+End-to-end benchmark of the sync pipeline: scripts.sync.do_sync with synthetic Eurofins rows in a JSON database,
+against the local 30MHz and Eurofins stand-ins. Every size runs in a process of its own, so peak RSS is per size.
+
+    python -m benchmarks.bench_sync run --samples 1000 --samples 10000 --samples 100000
+    python -m benchmarks.bench_sync run --samples 1000 --update-baseline
+
+Results are compared with benchmarks/baseline.json. A run that makes more HTTP calls per sample or syncs fewer
+samples than the baseline exits with status 1. Rows/s and peak RSS depend on the machine, so they only fail the
+run when the baseline was recorded on the same host, otherwise they are reported as advisory.
+"""
+import functools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import click
+from loguru import logger
+
+import efa_30mhz.thirty_mhz
+from benchmarks.synthetic import METRICS, PACKAGE_CODES, auth_rows, eurofins_rows
+from efa_30mhz.eurofins import EurofinsSource
+from efa_30mhz.metrics import Metric
+from efa_30mhz.simulator.eurofins import EurofinsSimulator
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from efa_30mhz.thirty_mhz import ThirtyMHzTarget
+from scripts.sync import do_sync
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Stage name -> (owner, attribute) of the function that is timed, stages may nest
+STAGES = {
+    "read": (EurofinsSource, "read_all"),
+    "convert": (EurofinsSource, "to_thirty_mhz"),
+    "sensor types": (ThirtyMHzTarget, "write_sensor_types"),
+    "import checks": (ThirtyMHzTarget, "write_import_checks"),
+    "ingests": (ThirtyMHzTarget, "write_ingests"),
+    "  remote dedupe": (ThirtyMHzTarget, "filter_existing_order_sample_data_ids"),
+    "  pdfs": (efa_30mhz.thirty_mhz, "prefetch"),
+    "done ids": (ThirtyMHzTarget, "write_ids"),
+}
+
+
+class StageTimer:
+    """
+    Wraps the functions of STAGES to add up the wall time spent in them.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def install(self):
+        for stage, (owner, name) in STAGES.items():
+            setattr(owner, name, self.timed(stage, getattr(owner, name)))
+
+    def timed(self, stage, f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[stage] = self.seconds.get(stage, 0) + time.perf_counter() - start
+
+        return wrapper
+
+
+def create_config(directory, samples_file, auth_file, thirty_mhz_url, wsdl, options) -> Dict:
+    target = {
+        "api_key": "default-key",
+        "organization": "default",
+        "already_done_out": os.path.join(directory, "already_done_out"),
+        "api_url": thirty_mhz_url,
+        "http": {"backoff_factor": 0.05},
+    }
+    if options["ingest_batch"]:
+        target["ingest_batch"] = {"max_events": 500, "max_bytes": 1024 * 1024}
+    if options["workers"]:
+        target["concurrency"] = {"workers": options["workers"], "per_organization": 2}
+    if options["in_flight"]:
+        target["asynchronous"] = {"in_flight": options["in_flight"]}
+    app = {"source": "eurofins", "target": "thirty_mhz"}
+    if options["chunk_size"]:
+        app["chunk_size"] = options["chunk_size"]
+    if options["pipeline_workers"]:
+        app["pipeline_workers"] = options["pipeline_workers"]
+    if options["shards"]:
+        app["shards"] = options["shards"]
+    return {
+        "app": app,
+        "databases": {
+            "samples": {"type": "json", "tables": {"samples": samples_file}},
+            "auth": {"type": "json", "tables": {"auth": auth_file}, "default_table": "auth"},
+        },
+        "eurofins": {
+            "default_database": "samples",
+            "auth_database": "auth",
+            "query": None,
+            "samples": {"table": "samples"},
+            "auth_query": None,
+            "already_done_in": os.path.join(directory, "already_done_in"),
+            "package_codes": PACKAGE_CODES,
+            "metrics": METRICS,
+            "wsdl": wsdl,
+            "schema_version": "1",
+            "default_api_key": "default-key",
+            "default_organization": "default",
+            "pdf": {"workers": options["workers"] or 1},
+        },
+        "thirty_mhz": target,
+        "sentry": {"url": None},
+    }
+
+
+def run_once(samples: int, relations: int, options: Dict) -> Dict:
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    Metric.initialize_client(backend="null")
+    timer = StageTimer()
+    timer.install()
+    with tempfile.TemporaryDirectory() as directory, \
+            ThirtyMHzSimulator(latency=options["latency"]) as thirty_mhz, \
+            EurofinsSimulator(document_size=options["pdf_size"], latency=options["latency"]) as eurofins:
+        samples_file = os.path.join(directory, "samples.json")
+        auth_file = os.path.join(directory, "auth.json")
+        with open(samples_file, "w") as f:
+            json.dump(eurofins_rows(samples, relations=relations), f)
+        with open(auth_file, "w") as f:
+            json.dump(auth_rows(relations), f)
+        open(os.path.join(directory, "already_done_in"), "w").close()
+        config = create_config(directory, samples_file, auth_file, thirty_mhz.url, eurofins.wsdl, options)
+
+        start = time.perf_counter()
+        do_sync(config)
+        seconds = time.perf_counter() - start
+
+        synced = sum(len(events) for events in thirty_mhz.events.values())
+        http_calls = thirty_mhz.request_count + eurofins.calls
+    return {
+        "samples": samples,
+        "synced": synced,
+        "seconds": seconds,
+        "rows_per_second": samples / seconds,
+        "http_calls_per_sample": http_calls / samples,
+        "thirty_mhz_calls": thirty_mhz.request_count,
+        "eurofins_calls": eurofins.calls,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": timer.seconds,
+    }
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> Tuple[List[str], List[str]]:
+    """
+    :return: the regressions of the metrics that don't depend on the machine, and those of the ones that do
+    """
+    regressions = []
+    if result["http_calls_per_sample"] > baseline["http_calls_per_sample"] * (1 + tolerance):
+        regressions.append(
+            f"HTTP calls/sample {result['http_calls_per_sample']:.2f} > baseline {baseline['http_calls_per_sample']:.2f}"
+        )
+    if result["synced"] < baseline["synced"]:
+        regressions.append(f"synced {result['synced']} < baseline {baseline['synced']}")
+    machine_regressions = []
+    if result["rows_per_second"] < baseline["rows_per_second"] * (1 - tolerance):
+        machine_regressions.append(
+            f"rows/s {result['rows_per_second']:.0f} < baseline {baseline['rows_per_second']:.0f}"
+        )
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        machine_regressions.append(
+            f"peak RSS {result['peak_rss_mb']:.0f} MB > baseline {baseline['peak_rss_mb']:.0f} MB"
+        )
+    return regressions, machine_regressions
+
+
+def report(result: Dict):
+    print(
+        f"{result['samples']:>8} samples: {result['synced']} synced in {result['seconds']:.1f}s, "
+        f"{result['rows_per_second']:.0f} rows/s, {result['http_calls_per_sample']:.2f} HTTP calls/sample "
+        f"({result['thirty_mhz_calls']} 30MHz, {result['eurofins_calls']} Eurofins), "
+        f"peak RSS {result['peak_rss_mb']:.0f} MB"
+    )
+    for stage, seconds in result["stages"].items():
+        print(f"{'':>10}{stage:<18} {seconds:8.2f}s")
+
+
+def pipeline_options(f):
+    options = [
+        click.option("--relations", type=int, default=50),
+        click.option("--latency", type=float, default=0.001, help="Seconds per request of the stand-ins"),
+        click.option("--pdf-size", type=int, default=20 * 1024),
+        click.option("--workers", type=int, default=8, help="Target concurrency, 0 for serial ingests"),
+        click.option("--ingest-batch/--no-ingest-batch", default=True),
+        click.option("--in-flight", type=int, default=None, help="Ingest asynchronously, with this many requests"),
+        click.option("--chunk-size", type=int, default=None),
+        click.option("--pipeline-workers", type=int, default=None),
+        click.option(
+            "--shards", type=int, default=None, help="Sync in this many processes, stages and RSS are the parent's"
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--samples", type=int, required=True)
+@pipeline_options
+def one(samples, relations, **options):
+    """
+    Runs a single size and prints the result as JSON.
+    """
+    print(json.dumps(run_once(samples, relations, options)))
+
+
+@cli.command()
+@click.option("--samples", multiple=True, type=int, default=[1000, 10000, 100000])
+@click.option("--baseline", "baseline_file", default=BASELINE)
+@click.option("--update-baseline", is_flag=True, default=False)
+@click.option("--tolerance", type=float, default=0.3, help="Allowed relative regression")
+@pipeline_options
+def run(samples, baseline_file, update_baseline, tolerance, relations, **options):
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    used = {k: v for k, v in dict(options, relations=relations).items() if v is not None}
+    if not update_baseline and baseline and baseline.get("options") != used:
+        print(f"Options differ from the baseline {baseline.get('options')}, not comparing")
+        baseline = {}
+    arguments = [f"--relations={relations}"] + [
+        f"--{k.replace('_', '-')}={v}" for k, v in options.items() if v is not None and not isinstance(v, bool)
+    ] + ["--ingest-batch" if options["ingest_batch"] else "--no-ingest-batch"]
+    # Timings and memory of a baseline of another machine say little about this one
+    baseline_host = baseline.get("host")
+    same_host = baseline_host == platform.node()
+    results = {}
+    regressions = []
+    advisories = []
+    for size in samples:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_sync", "one", f"--samples={size}", *arguments],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results[str(size)] = result
+        report(result)
+        if str(size) in baseline.get("results", {}):
+            hard, machine = compare(result, baseline["results"][str(size)], tolerance)
+            regressions.extend(f"{size} samples: {regression}" for regression in hard)
+            (regressions if same_host else advisories).extend(f"{size} samples: {regression}" for regression in machine)
+    if update_baseline:
+        if not same_host:
+            # Results of another host are not comparable with the new ones
+            baseline = {}
+        baseline = {
+            "options": used,
+            "host": platform.node(),
+            "results": dict(baseline.get("results", {}), **results),
+        }
+        with open(baseline_file, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {baseline_file}")
+    if advisories:
+        print(f"ADVISORY, the baseline was recorded on {baseline_host or 'another host'}:")
+        for advisory in advisories:
+            print(f"  {advisory}")
+    if regressions:
+        print("REGRESSIONS:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,112 @@
+"""
+Microbenchmark of EurofinsSource.to_thirty_mhz on synthetic cleaned rows.
+
+    python -m benchmarks.bench_to_thirty_mhz --sizes 10000 --sizes 100000 --sizes 1000000
+"""
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import click
+import pytz
+
+from efa_30mhz.eurofins import EurofinsSource
+from efa_30mhz.metrics import Metric
+
+PACKAGE_CODES = {"210": "Bemestingsonderzoek", "310": "Potgrond", "410": "Water", "510": "Gewas"}
+
+
+def create_source() -> EurofinsSource:
+    return EurofinsSource(
+        super_source=None,
+        auth_source=None,
+        already_done_in="already_done.txt",
+        package_codes=PACKAGE_CODES,
+        metrics={"default": "default"},
+        wsdl=None,
+        schema_version="1",
+        default_api_key="api_key",
+        default_organization="organization",
+    )
+
+
+def synthetic_rows(n: int, organizations: int = 200, objects: int = 50, seed: int = 0) -> List[Dict]:
+    """
+    Rows as EurofinsSource.clean_data and add_auth produce them.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo=pytz.utc)
+    packages = list(PACKAGE_CODES)
+    rows = []
+    for i in range(n):
+        organization = rng.randrange(organizations)
+        results = rng.randint(3, 12)
+        rows.append({
+            "order_sample_data_id": i,
+            "relation_id": organization,
+            "resource_id": i,
+            "analysis_package_code": rng.choice(packages),
+            "sample_code": f"{2020000 + i}",
+            "sample_description": f"Sample {i}",
+            "sample_date": start + timedelta(hours=i),
+            "additional_field_list": [{"fieldName": "CDOB", "fieldValue": f"object-{rng.randrange(objects)}"}],
+            "result_group_data": [
+                {
+                    "result_description": f"Result {code}",
+                    "result_value": rng.random(),
+                    "origin_code": f"C{code}",
+                    "result_unit_of_measure_description": "mmol/l",
+                }
+                for code in range(results)
+            ],
+            "api_key": f"key-{organization}",
+            "organization_id": f"organization-{organization}",
+        })
+    return rows
+
+
+def legacy_to_thirty_mhz(source: EurofinsSource, rows: List):
+    """
+    The former implementation, which filters all rows once per organization.
+    """
+    sensor_types = []
+    import_checks = []
+    ingests = []
+    ids = []
+    for organization_id in set(r["organization_id"] for r in rows):
+        organization_rows = [r for r in rows if r["organization_id"] == organization_id]
+        sensor_types.extend(
+            source.uniques_schema(map(source.get_sensor_type, organization_rows), id_column="id")
+        )
+        import_checks.extend(
+            source.uniques(map(source.get_import_check, organization_rows), id_column="id")
+        )
+        ingests.extend(filter(lambda x: x is not None, map(source.get_ingests, organization_rows)))
+        ids.extend(r["order_sample_data_id"] for r in organization_rows)
+    return sensor_types, import_checks, ingests, ids
+
+
+def timed(f, *args) -> float:
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--sizes", multiple=True, type=int, default=[10_000, 100_000, 1_000_000])
+@click.option("--organizations", type=int, default=200)
+@click.option("--legacy-limit", type=int, default=100_000, help="Largest size the legacy version is timed for")
+def main(sizes, organizations, legacy_limit):
+    Metric.initialize_client(backend="null")
+    source = create_source()
+    print(f"{'rows':>10} {'single pass (s)':>16} {'rows/s':>12} {'legacy (s)':>12}")
+    for size in sizes:
+        rows = synthetic_rows(size, organizations=organizations)
+        seconds = timed(source.to_thirty_mhz, rows)
+        legacy = f"{timed(legacy_to_thirty_mhz, source, rows):12.2f}" if size <= legacy_limit else f"{'-':>12}"
+        print(f"{size:>10} {seconds:16.2f} {size / seconds:12.0f} {legacy}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Synthetic Eurofins data in the shape the Eurofins views return it, as EurofinsSource.clean_data expects it.
+"""
+import json
+import random
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List
+
+# Package code -> (name, [(origin code, description, unit, typical value)])
+PACKAGES = {
+    "210": (
+        "Bemestingsonderzoek",
+        [
+            ("PH", "pH", "", 5.8),
+            ("EC", "EC", "mS/cm", 1.6),
+            ("NH4", "Ammonium", "mmol/l", 0.4),
+            ("K", "Kalium", "mmol/l", 5.2),
+            ("NA", "Natrium", "mmol/l", 1.1),
+            ("CA", "Calcium", "mmol/l", 3.4),
+            ("MG", "Magnesium", "mmol/l", 1.8),
+            ("NO3", "Nitraat", "mmol/l", 9.5),
+            ("CL", "Chloride", "mmol/l", 1.0),
+            ("SO4", "Sulfaat", "mmol/l", 2.1),
+            ("P", "Fosfor", "mmol/l", 1.2),
+            ("FE", "IJzer", "umol/l", 18.0),
+            ("MN", "Mangaan", "umol/l", 4.5),
+            ("ZN", "Zink", "umol/l", 3.8),
+            ("B", "Borium", "umol/l", 26.0),
+            ("CU", "Koper", "umol/l", 0.7),
+        ],
+    ),
+    "310": (
+        "Potgrond",
+        [
+            ("PH", "pH", "", 5.5),
+            ("EC", "EC", "mS/cm", 0.9),
+            ("NH4", "Ammonium", "mmol/l", 0.2),
+            ("K", "Kalium", "mmol/l", 2.4),
+            ("NO3", "Nitraat", "mmol/l", 4.1),
+            ("P", "Fosfor", "mmol/l", 0.6),
+            ("OS", "Organische stof", "%", 62.0),
+        ],
+    ),
+    "410": (
+        "Water",
+        [
+            ("PH", "pH", "", 7.2),
+            ("EC", "EC", "mS/cm", 0.4),
+            ("NA", "Natrium", "mmol/l", 0.8),
+            ("CL", "Chloride", "mmol/l", 0.9),
+            ("HCO3", "Bicarbonaat", "mmol/l", 2.2),
+            ("FE", "IJzer", "umol/l", 2.0),
+        ],
+    ),
+}
+PACKAGE_CODES = {code: name for code, (name, _) in PACKAGES.items()}
+METRICS = {"default": "ph", "EC": "ec", "PH": "ph"}
+
+
+def result_group_data(rng: random.Random, package: str) -> str:
+    _, results = PACKAGES[package]
+    # Not every sample is analysed for every element, so schemas of one package differ in size
+    measured = [r for r in results if r[0] in ("PH", "EC") or rng.random() < 0.85]
+    groups = [
+        {
+            "resultGroupDescription": "Analyseresultaten",
+            "resultData": [
+                {
+                    "resultDescription": description,
+                    "resultValue": round(value * rng.uniform(0.5, 1.5), 2),
+                    "originCode": code,
+                    "resultUnitOfMeasureDescription": unit,
+                    "resultValueText": None,
+                }
+                for code, description, unit, value in measured
+            ],
+        }
+    ]
+    return json.dumps(groups)
+
+
+def eurofins_rows(n: int, relations: int = 50, objects_per_relation: int = 5, seed: int = 0) -> List[Dict]:
+    """
+    n sample rows of `relations` customers. Sample dates lie in the last 5 days, so they pass the 7-day window
+    of organizations that exist in 30MHz.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    packages = list(PACKAGES)
+    rows = []
+    for i in range(n):
+        relation_id = 1000 + rng.randrange(relations)
+        sample_date = (today - timedelta(days=rng.randrange(5))).isoformat()
+        rows.append({
+            "orderSampleDataId": 1_000_000 + i,
+            "relationId": relation_id,
+            "resourceId": 5_000_000 + i,
+            "sampleId": 2_000_000 + i,
+            "sampleCode": f"{2021_000_000 + i}",
+            "sampleDate": sample_date,
+            "sampleDescription": f"Afdeling {rng.randrange(objects_per_relation) + 1}",
+            "analysisPackageCode": rng.choice(packages),
+            "creationDate": sample_date,
+            "mainCategory": "Tuinbouw",
+            "subCategory": "Glastuinbouw",
+            "resultGroupData": None,
+            "additionalFieldList": json.dumps([
+                {"fieldName": "CDOB", "fieldValue": f"{relation_id}-{rng.randrange(objects_per_relation)}"},
+                {"fieldName": "TEELT", "fieldValue": "Tomaat"},
+            ]),
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+            "updatedAt": datetime.now(timezone.utc).isoformat(),
+        })
+        rows[-1]["resultGroupData"] = result_group_data(rng, rows[-1]["analysisPackageCode"])
+    return rows
+
+
+def auth_rows(relations: int = 50, without_api_key: int = 5) -> List[Dict]:
+    """
+    The auth view: every relation is a 30MHz organization of its own, except the first without_api_key ones,
+    which end up in the default organization.
+    """
+    return [
+        {
+            "relationId": 1000 + r,
+            "apiKey": None if r < without_api_key else f"key-{1000 + r}",
+            "organisationId": f"organization-{1000 + r}",
+        }
+        for r in range(relations)
+    ]
@@ -4,11 +4,11 @@ from dateutil import parser
 api_key = ""
 organization_id = "DeliflorChrysanten"
 
-samples_getter = SamplesGetter(api_key, organization_id)
+samples_getter = SamplesGetter(api_key, organization_id, workers=8, window_days=90)
 
-from_date = parser.parse("2010-01-01").strftime('%Y-%m-%dT%H:%M:%SZ')
-to_date = parser.parse("2021-10-01").strftime('%Y-%m-%dT%H:%M:%SZ')
+from_date = parser.parse("2010-01-01")
+to_date = parser.parse("2021-10-01")
 
-samples = samples_getter.get_all_samples_for_user_from_until(from_date, to_date)
-
-samples.to_csv("samples")
+# Written as the windows come in, use format="parquet" (needs pyarrow) for a smaller file
+written = samples_getter.export(from_date, to_date, "samples.csv", format="csv")
+print(f"Exported {written} samples, failed windows: {samples_getter.failed_windows}")
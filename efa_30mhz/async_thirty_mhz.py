@@ -0,0 +1,463 @@
+"""
+asyncio variant of the 30MHz client, on aiohttp: pip install "aiohttp>=3.12".
+The endpoints build their requests the way the ThirtyMHz endpoints do, only the I/O is awaited, so thousands of
+uploads and ingests can be in flight from one thread. The synchronous ThirtyMHz client is unchanged.
+"""
+import asyncio
+import json
+import random
+import time
+from io import IOBase, SEEK_END
+from typing import Dict, Any, List, Tuple, Optional
+
+from loguru import logger
+
+from efa_30mhz.errors import FileUnavailableError
+from efa_30mhz.files import LazyFile
+from efa_30mhz.metrics import Metric
+from efa_30mhz.rate_limit import RateLimiter, TokenBucket, parse_retry_after, DEFAULT_THROTTLE_RETRIES
+from efa_30mhz.session import (
+    DEFAULT_BACKOFF_FACTOR,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_RETRIES,
+    RETRY_METHODS,
+    RETRY_STATUSES,
+    THROTTLED,
+)
+from efa_30mhz.thirty_mhz import (
+    DataUpload,
+    ImportCheck,
+    IngestError,
+    SensorType,
+    ShareSensorType,
+    Stats,
+    ThirtyMHz,
+    ThirtyMHzError,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_INGEST_MAX_BYTES,
+    DEFAULT_INGEST_MAX_EVENTS,
+    events_size,
+    pack_chunks,
+    resend_chunk,
+)
+from efa_30mhz.tracing import span
+import efa_30mhz.constants as cst
+
+try:
+    import aiohttp
+    from aiohttp.payload import IOBasePayload
+except ImportError:
+    aiohttp = None
+    IOBasePayload = object
+
+DEFAULT_IN_FLIGHT = 100
+
+
+class FilePayload(IOBasePayload):
+    """
+    Streams a file from its current position and leaves it open, aiohttp closes file payloads after every request.
+    The owner of the file closes it once no attempt of the request is sent anymore.
+    """
+
+    @property
+    def size(self) -> Optional[int]:
+        position = self._value.tell()
+        try:
+            return self._value.seek(0, SEEK_END) - position
+        finally:
+            self._value.seek(position)
+
+    def _close(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class AsyncEndpoint:
+    """
+    Mixin that turns the I/O of a ThirtyMHzEndpoint into coroutines.
+    """
+
+    def __init__(self, tmz: "AsyncThirtyMHz"):
+        super(AsyncEndpoint, self).__init__(tmz)
+        self.async_index_lock = asyncio.Lock()
+
+    async def list(self):
+        return await self.tmz.get(self.base_url)
+
+    async def get_index(self) -> Dict[str, Any]:
+        async with self.async_index_lock:
+            if (
+                    self.index is None
+                    or time.monotonic() - self.index_loaded_at > self.tmz.cache_ttl
+            ):
+                index = {}
+                for i in await self.list():
+                    index.setdefault(str(i[self.key_field]), i)
+                self.index = index
+                self.index_loaded_at = time.monotonic()
+            return self.index
+
+    async def exists(self, **kwargs):
+        if self.key_field is not None:
+            return self.index_key(**kwargs) in await self.get_index()
+        return any(self.check(i, **kwargs) for i in await self.list())
+
+    async def get(self, **kwargs):
+        if self.key_field is not None:
+            return (await self.get_index()).get(self.index_key(**kwargs))
+        return next((i for i in await self.list() if self.check(i, **kwargs)), None)
+
+    async def create(self, files=None, organization=True, **kwargs):
+        return await self.send(self.base_url, self.get_data(**kwargs), files=files, organization=organization)
+
+    async def send(self, base_url, data, files=None, organization=True):
+        with span("30mhz.create", endpoint=type(self).__name__, organization=self.tmz.organization):
+            try:
+                t0 = time.time()
+                result = await self.tmz.post(base_url, data, files=files, organization=organization)
+                t1 = time.time()
+                self.statsd_client.incr(self.stats_success)
+                self.statsd_client.timing(self.stats_time, t1 - t0)
+                if self.key_field is not None:
+                    self.remember(result)
+                return result
+            except ThirtyMHzError as e:
+                logger.debug(e.message)
+                self.statsd_client.incr(self.stats_failures)
+
+
+class AsyncSensorType(AsyncEndpoint, SensorType):
+    pass
+
+
+class AsyncImportCheck(AsyncEndpoint, ImportCheck):
+    async def events(self, import_check, rows) -> List[Dict]:
+        timestamps = [r.pop("datetime").replace(microsecond=0).isoformat() for r in rows]
+        converted = await asyncio.gather(*(self.convert_row(r) for r in rows))
+        return [self.event(import_check, t, c) for t, c in zip(timestamps, converted)]
+
+    async def convert_row(self, r: Dict[str, Any]) -> Dict[str, Any]:
+        d = {}
+        for k, v in r.items():
+            if isinstance(v, LazyFile):
+                d[k] = v.get_data_upload_id(self.tmz.organization)
+                if d[k] is not None:
+                    logger.debug(f"Reusing data upload {d[k]}")
+                    continue
+                try:
+                    # Files are prefetched before the ingests, opening one that wasn't fetches it on a thread
+                    file = await asyncio.to_thread(v.open)
+                except FileUnavailableError as e:
+                    raise ThirtyMHzError(e.message)
+                d[k] = await self.upload(file)
+                v.set_data_upload_id(self.tmz.organization, d[k])
+            elif isinstance(v, IOBase):
+                d[k] = await self.upload(v)
+            else:
+                d[k] = v
+        return d
+
+    async def upload(self, file) -> str:
+        data_upload = await self.tmz.data_upload.create(file=file)
+        if data_upload is None:
+            raise ThirtyMHzError("Data upload failed")
+        return data_upload["dataUploadId"]
+
+    async def ingest(self, import_check, rows):
+        await self.post_events(await self.events(import_check, rows))
+
+    async def post_events(self, data):
+        t0 = time.time()
+        with span("30mhz.ingest", organization=self.tmz.organization):
+            r = await self.tmz.post("ingest", data)
+        t1 = time.time()
+        if r["failedEventsNo"] > 0:
+            self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_FAILURES, r["failedEventsNo"])
+            if r["okEventsNo"] > 0:
+                self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_SUCCESS, r["okEventsNo"])
+            raise IngestError(f"Failed ingest events: {r}", r["okEventsNo"])
+        self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_SUCCESS, r["okEventsNo"])
+        self.statsd_client.timing(cst.STATS_30MHZ_INGESTS_TIME, t1 - t0)
+
+    async def ingest_batch(
+            self,
+            items: List[Tuple[Any, Dict, List[Dict]]],
+            max_events: int = DEFAULT_INGEST_MAX_EVENTS,
+            max_bytes: int = DEFAULT_INGEST_MAX_BYTES,
+    ) -> List:
+        """
+        See ImportCheck.ingest_batch, the files of the items are uploaded and the chunks are posted concurrently. At
+        most in_flight items of the getter upload their files at once, so only that many files are read at once.
+        """
+
+        async def group(order_id, import_check, rows):
+            async with self.tmz.in_flight:
+                try:
+                    events = await self.events(import_check, rows)
+                except ThirtyMHzError as e:
+                    logger.error(e.message)
+                    return None
+            return order_id, events, events_size(events)
+
+        groups = await asyncio.gather(*(group(*item) for item in items))
+        chunks = pack_chunks((g for g in groups if g is not None), max_events, max_bytes)
+        results = await asyncio.gather(*(self.post_chunk(chunk) for chunk in chunks))
+        return [order_id for done in results for order_id in done]
+
+    async def post_chunk(self, chunk) -> List:
+        try:
+            await self.post_events([event for _, events, _ in chunk for event in events])
+            return [order_id for order_id, _, _ in chunk]
+        except ThirtyMHzError as e:
+            logger.error(e.message)
+            if len(chunk) == 1 or not resend_chunk(e):
+                return []
+        logger.debug(f"Retrying {len(chunk)} orders of a failed batch one by one")
+        done = []
+        for order_id, events, _ in chunk:
+            try:
+                await self.post_events(events)
+                done.append(order_id)
+            except ThirtyMHzError as e:
+                logger.error(f"Ingest of order {order_id} failed: {e.message}")
+        return done
+
+
+class AsyncDataUpload(AsyncEndpoint, DataUpload):
+    async def create(self, file: IOBase, **kwargs):
+        # Streamed from the file, see AsyncThirtyMHz.post
+        try:
+            return await AsyncEndpoint.create(
+                self, files={"file": ("report.pdf", file, "application/pdf")}, **kwargs
+            )
+        finally:
+            file.close()
+
+
+class AsyncStats(AsyncEndpoint, Stats):
+    async def get(self, id, **kwargs):
+        import_check = await self.tmz.import_check.get(id=id)
+        return await self.tmz.get(
+            self.base_url.format(check_id=import_check["checkId"]), organization=False
+        )
+
+
+class AsyncShareSensorType(AsyncEndpoint, ShareSensorType):
+    async def create(self, id, organization_id):
+        sensor_type = await self.tmz.sensor_type.get(id=id)
+        base_url = self.base_url.format(
+            sensor_type_id=sensor_type["typeId"], organization_id=organization_id
+        )
+        logger.debug(base_url)
+        await self.send(base_url, self.get_data(), organization=False)
+
+
+class AsyncThirtyMHz(ThirtyMHz):
+    """
+    ThirtyMHz with the same endpoint properties, of which the requests are coroutines on a shared aiohttp session.
+    Requests wait for the token bucket of the tenant, 429s are sent again like ThirtyMHzSession does and connection
+    errors, and for GETs also 5xx and timeouts, are retried with jittered exponential backoff.
+    """
+
+    sensor_type_class = AsyncSensorType
+    share_sensor_type_class = AsyncShareSensorType
+    import_check_class = AsyncImportCheck
+    data_upload_class = AsyncDataUpload
+    stats_class = AsyncStats
+
+    def __init__(
+            self,
+            api_key,
+            organization,
+            session: "aiohttp.ClientSession",
+            cache_ttl: float = DEFAULT_CACHE_TTL,
+            api_url: str = None,
+            rate_limit: TokenBucket = None,
+            retries: int = DEFAULT_RETRIES,
+            backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+            throttle_retries: int = DEFAULT_THROTTLE_RETRIES,
+            in_flight: asyncio.Semaphore = None,
+    ):
+        """
+        :param in_flight: bounds the work in flight, like the items of ingest_batch, shared by the tenants of a getter
+        """
+        super(AsyncThirtyMHz, self).__init__(
+            api_key, organization, session=session, cache_ttl=cache_ttl, api_url=api_url
+        )
+        self.in_flight = in_flight or asyncio.Semaphore(DEFAULT_IN_FLIGHT)
+        self.statsd_client = Metric.client()
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.throttle_retries = throttle_retries
+
+    async def request(self, method, url, headers, body=None) -> Tuple[int, Any]:
+        """
+        :param body: function that returns the body of the request, called for every attempt
+        :return: status code and decoded JSON body of the response
+        """
+        attempt = 0
+        throttled = 0
+        while True:
+            if self.rate_limit is not None:
+                wait = self.rate_limit.try_acquire()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.rate_limit.try_acquire()
+            # Whether the request may be sent again, see RETRY_METHODS
+            retry = method in RETRY_METHODS
+            try:
+                async with self.session.request(
+                        method, url, headers=headers, data=body() if body is not None else None
+                ) as r:
+                    status = r.status
+                    text = await r.text()
+                    retry_after = r.headers.get("Retry-After")
+            except aiohttp.ClientConnectorError as e:
+                # Never reached the server
+                status, text, retry_after, retry = None, repr(e), None, True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, text, retry_after = None, repr(e), None
+            if status == THROTTLED:
+                self.statsd_client.incr(cst.STATS_30MHZ_THROTTLED)
+                seconds = parse_retry_after(retry_after)
+                if self.rate_limit is not None:
+                    self.rate_limit.throttled(seconds)
+                throttled += 1
+                if throttled <= self.throttle_retries:
+                    if self.rate_limit is None:
+                        await asyncio.sleep(seconds if seconds is not None else 2 ** throttled)
+                    continue
+            elif status is not None and self.rate_limit is not None:
+                # Only a response tells that the tenant is not throttled, failed connections don't
+                self.rate_limit.succeeded()
+            if retry and (status is None or status in RETRY_STATUSES) and attempt < self.retries:
+                attempt += 1
+                await asyncio.sleep(random.uniform(0, self.backoff_factor * 2 ** attempt))
+                continue
+            if status is None:
+                raise ThirtyMHzError(f"Request to {url} failed: {text}")
+            try:
+                return status, json.loads(text)
+            except ValueError:
+                return status, text
+
+    async def get(self, base_url, organization=True):
+        url = self.create_url(base_url, organization=organization)
+        status, body = await self.request("GET", url, self.headers)
+        if 200 <= status < 300:
+            return body
+        raise ThirtyMHzError(f"Faulty status code {status}: {body}", status)
+
+    async def post(self, base_url, data=None, files=None, organization=True):
+        url = self.create_url(base_url, organization=organization)
+        headers = self.headers
+        if not files:
+            encoded = json.dumps(data)
+            body = lambda: encoded
+        else:
+            del headers["Content-type"]
+
+            def body():
+                # Files are streamed in chunks, every attempt from the start
+                form = aiohttp.FormData()
+                for name, (filename, f, content_type) in files.items():
+                    if not isinstance(f, bytes):
+                        f.seek(0)
+                        f = FilePayload(f, content_type=content_type)
+                    form.add_field(name, f, filename=filename, content_type=content_type)
+                return form
+
+        status, response = await self.request("POST", url, headers, body)
+        if 200 <= status < 300:
+            logger.debug(response)
+            return response
+        logger.debug(f"Something wrong posting to {url}")
+        raise ThirtyMHzError(f"Faulty status code {status}: {response}", status)
+
+
+class AsyncThirtyMHzGetter:
+    """
+    AsyncThirtyMHz clients of all tenants, on one aiohttp session with at most in_flight requests at once.
+    Use as `async with AsyncThirtyMHzGetter(...) as getter:` inside the event loop.
+    """
+
+    def __init__(
+            self,
+            default_api_key,
+            default_organization,
+            in_flight: int = DEFAULT_IN_FLIGHT,
+            http: Dict = None,
+            cache_ttl: float = DEFAULT_CACHE_TTL,
+            api_url: str = None,
+            rate_limiter: Optional[RateLimiter] = None,
+    ):
+        """
+        :param http: the http settings of ThirtyMHzGetter; connect_timeout, read_timeout, retries, backoff_factor,
+            throttle_retries and rate_limit apply
+        :param rate_limiter: token buckets to share with synchronous clients, by default made from http
+        """
+        if aiohttp is None:
+            raise ThirtyMHzError("The async client needs aiohttp, pip install aiohttp")
+        http = dict(http or {})
+        rate_limit = http.pop("rate_limit", None)
+        if rate_limiter is None and rate_limit is not False:
+            rate_limiter = RateLimiter(**(rate_limit or {}))
+        self.default_api_key = default_api_key
+        self.default_organization = default_organization
+        self.in_flight = in_flight
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=http.pop("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            sock_read=http.pop("read_timeout", DEFAULT_READ_TIMEOUT),
+        )
+        self.client_kwargs = {
+            "retries": http.pop("retries", DEFAULT_RETRIES),
+            "backoff_factor": http.pop("backoff_factor", DEFAULT_BACKOFF_FACTOR),
+            "throttle_retries": http.pop(
+                "throttle_retries",
+                rate_limiter.retries if rate_limiter is not None else DEFAULT_THROTTLE_RETRIES,
+            ),
+        }
+        self.cache_ttl = cache_ttl
+        self.api_url = api_url
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.in_flight_semaphore = None
+        self.tmzs = {}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.in_flight), timeout=self.timeout
+        )
+        self.in_flight_semaphore = asyncio.Semaphore(self.in_flight)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+        self.session = None
+        self.tmzs = {}
+
+    def get(self, row) -> AsyncThirtyMHz:
+        api_key = row.get("api_key", self.default_api_key)
+        organization = row.get("organization_id", self.default_organization)
+        return self.get_by_api_key(api_key, organization)
+
+    def get_default(self) -> AsyncThirtyMHz:
+        return self.get_by_api_key(self.default_api_key, self.default_organization)
+
+    def get_by_api_key(self, api_key, organization) -> AsyncThirtyMHz:
+        if (api_key, organization) not in self.tmzs:
+            self.tmzs[(api_key, organization)] = AsyncThirtyMHz(
+                api_key,
+                organization,
+                session=self.session,
+                cache_ttl=self.cache_ttl,
+                api_url=self.api_url,
+                rate_limit=self.rate_limiter.get(api_key, organization) if self.rate_limiter else None,
+                in_flight=self.in_flight_semaphore,
+                **self.client_kwargs,
+            )
+        return self.tmzs[(api_key, organization)]
@@ -6,6 +6,13 @@ STATS_SOURCE_CLIENTS = f"{STATS_PREFIX}.source.clients.all"
 STATS_SOURCE_SAMPLES_TODO = f"{STATS_PREFIX}.source.samples.todo"
 STATS_SOURCE_CLIENTS_TODO = f"{STATS_PREFIX}.source.clients.todo"
 
+STATS_SOURCE_PDFS_FETCHED = f"{STATS_PREFIX}.source.pdfs.fetched"
+STATS_SOURCE_PDFS_AVOIDED = f"{STATS_PREFIX}.source.pdfs.avoided"
+
+STATS_SOURCE_PDF_CACHE_HITS = f"{STATS_PREFIX}.source.pdfcache.hits"
+STATS_SOURCE_PDF_CACHE_MISSES = f"{STATS_PREFIX}.source.pdfcache.misses"
+STATS_SOURCE_PDF_CACHE_EVICTIONS = f"{STATS_PREFIX}.source.pdfcache.evictions"
+
 STATS_30MHZ_STATS_TIME = f"{STATS_PREFIX}.30mhz.stats.time"
 STATS_30MHZ_STATS_SUCCESS = f"{STATS_PREFIX}.30mhz.stats.success"
 STATS_30MHZ_STATS_FAILURES = f"{STATS_PREFIX}.30mhz.stats.failures"
@@ -37,6 +44,9 @@ STATS_30MHZ_INGESTS_TODO = f"{STATS_PREFIX}.30mhz.ingests.todo"
 STATS_30MHZ_INGESTS_SUCCESS = f"{STATS_PREFIX}.30mhz.ingests.success"
 STATS_30MHZ_INGESTS_FAILURES = f"{STATS_PREFIX}.30mhz.ingests.failures"
 
+STATS_30MHZ_THROTTLED = f"{STATS_PREFIX}.30mhz.throttled"
+STATS_30MHZ_THROTTLE_WAIT = f"{STATS_PREFIX}.30mhz.throttle.wait"
+
 STATS_APP_SAMPLES_DONE = f"{STATS_PREFIX}.app.samples.done"
 STATS_APP_CLIENTS_DONE = f"{STATS_PREFIX}.app.clients.done"
 STATS_APP_RUNTIME = f"{STATS_PREFIX}.app.runtime"
@@ -2,3 +2,9 @@ class EurofinsError(Exception):
     def __init__(self, message):
         self.message = message
         super(EurofinsError, self).__init__(message)
+
+
+class FileUnavailableError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(FileUnavailableError, self).__init__(message)
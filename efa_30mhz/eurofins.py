@@ -1,14 +1,18 @@
+import functools
+import itertools
 import json
 from datetime import datetime, date 
-from typing import List, Dict, Iterable
+from typing import List, Dict, Iterable, Iterator, Any, Callable
 
 import pytz
 from loguru import logger
 
-from efa_30mhz.errors import EurofinsError
 from efa_30mhz.metrics import Metric
 from efa_30mhz.pdf import PDF
+from efa_30mhz.shards import shard_of
+from efa_30mhz.store import DoneStore, HighWaterMarks, to_datetime
 from efa_30mhz.sync import Source
+from efa_30mhz.tracing import Tracer, span
 from efa_30mhz.thirty_mhz import infer_type
 from typing import Tuple
 import efa_30mhz.constants as cst
@@ -26,8 +30,17 @@ class EurofinsSource(Source):
             schema_version: str,
             default_api_key: str,
             default_organization: str,
+            pdf_options: Dict = None,
+            bulk_read: bool = False,
+            done_store: DoneStore = None,
+            high_water_marks: HighWaterMarks = None,
+            incremental: bool = True,
+            shard: Tuple[int, int] = None,
             **kwargs,
     ):
+        """
+        :param shard: (index, shards) to only read the relations of which shard_of(relationId, shards) is index
+        """
         super(EurofinsSource, self).__init__(**kwargs)
         self.already_done_in = already_done_in
         self.super_source = super_source
@@ -35,23 +48,54 @@ class EurofinsSource(Source):
         self.package_codes = package_codes
         self.metrics = metrics
         self.schema_version = schema_version
-        self.pdf = PDF(wsdl)
+        self.pdf = PDF(wsdl, **(pdf_options or {}))
         self.statsd_client = Metric.client()
         self.default_api_key = default_api_key
         self.default_organization = default_organization
+        self.bulk_read = bulk_read
+        self.done_store = done_store
+        self.already_done_ids = None
+        self.high_water_marks = high_water_marks
+        self.incremental = incremental
+        self.marks = None
+        # Per relation the largest updatedAt read in this run, see HighWaterMarks
+        self.seen_marks = {}
+        self.shard = shard
 
     def to_thirty_mhz(self, rows: List) -> Tuple[List, List, List, List]:
-        sensor_types = []
-        import_checks = []
-        for organization_id in set(map(lambda r: r["organization_id"], rows)): # gets all unique sensor types
-            organization_rows = list(filter(lambda x: x['organization_id'] == organization_id, rows))
-            sensor_types.extend(self.uniques_schema(
-                map(self.get_sensor_type, organization_rows),
-                id_column="id"
-            ))
-            import_checks.extend(self.uniques(map(self.get_import_check, organization_rows), id_column="id")) # gets all unique import checks
-        ingests = list(filter(lambda x: x is not None, map(self.get_ingests, rows))) # gets ingests
-        ids = list(map(lambda x: x["order_sample_data_id"], rows)) # ids of samples
+        """
+        Converts rows in a single pass. Per organization the first row of a sensor type or import check defines it,
+        except that a sensor type is replaced by the one with the largest schema, see uniques_schema.
+        """
+        # organization_id -> sensor type id -> (schema size, row), and import check id -> row
+        sensor_type_rows = {}
+        import_check_rows = {}
+        ingests = []
+        ids = []
+        for row in rows:
+            organization_id = row["organization_id"]
+            sensor_type_id = self.get_sensor_type_id(row["analysis_package_code"])
+            schema_size = self.get_schema_size(row)
+            organization_sensor_types = sensor_type_rows.setdefault(organization_id, {})
+            current = organization_sensor_types.get(sensor_type_id)
+            if current is None or current[0] < schema_size:
+                organization_sensor_types[sensor_type_id] = (schema_size, row)
+            ingest = self.get_ingests(row)
+            import_check_id = ingest["id"] if ingest is not None else self.get_import_check_id(row)
+            import_check_rows.setdefault(organization_id, {}).setdefault(import_check_id, row)
+            if ingest is not None:
+                ingests.append(ingest)
+            ids.append(row["order_sample_data_id"])
+        sensor_types = [
+            self.get_sensor_type(row)
+            for organization_sensor_types in sensor_type_rows.values()
+            for _, row in organization_sensor_types.values()
+        ]
+        import_checks = [
+            self.get_import_check(row)
+            for organization_import_checks in import_check_rows.values()
+            for row in organization_import_checks.values()
+        ]
         return sensor_types, import_checks, ingests, ids
 
     def is_in_scope(self, row: Dict):
@@ -123,6 +167,14 @@ class EurofinsSource(Source):
             "organization_id": row["organization_id"],
         }
 
+    def get_schema_size(self, row: Dict) -> int:
+        """
+        Number of keys in the schema get_sensor_type would build for row.
+        """
+        return len({"file", "research_number"}.union(
+            result_data["origin_code"] for result_data in row["result_group_data"]
+        ))
+
     def uniques(self, data: Iterable[Dict], id_column) -> List[Dict]:
         done = []
         done_ids = set()
@@ -162,7 +214,8 @@ class EurofinsSource(Source):
         }
 
     def get_sample_file(self, row: Dict):
-        return self.pdf.get_pdf(row)
+        # Fetched by ThirtyMHzTarget only for the rows it actually ingests
+        return self.pdf.handle(row)
 
     def get_import_check_id(self, row: Dict):
         sensor_type = self.get_sensor_type_id(row["analysis_package_code"])
@@ -179,16 +232,11 @@ class EurofinsSource(Source):
         data["research_number"] = row["sample_code"]
         data["order_sample_data_id"] = row["order_sample_data_id"]
         
-        try:
-            sample_file = self.get_sample_file(row)
-            if sample_file:
-                data['file'] = sample_file
-        except EurofinsError as e:
-            logger.debug(e.message)
-            return None
+        data['file'] = self.get_sample_file(row)
         return {
             "id": import_check_id,
             "order_id": order_id,
+            "relation_id": row["relation_id"],
             "data": [data],
             "api_key": row["api_key"],
             "organization_id": row["organization_id"],
@@ -235,47 +283,144 @@ class EurofinsSource(Source):
             already_done = set(map(int, filter(lambda x: x != "\n", f.readlines())))
             return already_done
 
-    def read_single_user(self, auth_row):
-        
-        # check if user is already known
-        # if no, 
-
-        already_done = self.read_already_done(self.already_done_in)
-        rows = self.super_source.read_all(auth_row['relationId'])
-        self.statsd_client.gauge(cst.STATS_SOURCE_SAMPLES, len(rows))
-        self.statsd_client.gauge(
-            cst.STATS_SOURCE_CLIENTS, len(set(map(lambda x: x["relationId"], rows)))
-        )
-        logger.debug(f"Found {len(rows)} rows")
+    @property
+    def already_done(self):
+        """
+        The ids that were synced before: the done store, or else the already done file, read once per run.
+        """
+        if self.done_store is not None:
+            return self.done_store
+        if self.already_done_ids is None:
+            self.already_done_ids = self.read_already_done(self.already_done_in)
+        return self.already_done_ids
+
+    def updated_after(self, relation_id):
+        """
+        The high water mark of a relation in incremental mode, rows updated before it are synced already.
+        """
+        if not self.incremental or self.high_water_marks is None:
+            return None
+        if self.marks is None:
+            self.marks = self.high_water_marks.get_all()
+        return self.marks.get(str(relation_id))
+
+    def read_single_user(self, auth_row) -> Iterator[Dict]:
+        """
+        Streams the cleaned, in scope rows of one customer. The source gauges are sent once the rows are consumed.
+        """
         logger.debug(auth_row)
-        rows = list(
-            filter(
-                lambda x: x
-                          and len(x["result_group_data"]) > 0
-                          and self.is_in_scope(x),
-                map(
-                    lambda x: self.add_auth(row=x, auth_rows=[auth_row]),
-                    map(self.clean_data, rows),
-                ),
+        updated_after = self.updated_after(auth_row["relationId"])
+        if updated_after is not None:
+            raw_rows = self.super_source.iter_rows(
+                auth_row['relationId'], updated_after=updated_after
             )
+        else:
+            raw_rows = self.super_source.iter_rows(auth_row['relationId'])
+        return Tracer.get().iterate(
+            "source.read",
+            self.clean_rows(raw_rows, {auth_row["relationId"]: [auth_row]}),
+            relation=auth_row["relationId"],
         )
-        if len(rows) > 0:
-            logger.debug(rows[0])
-        self.statsd_client.gauge(cst.STATS_SOURCE_SAMPLES_TODO, len(rows))
-        self.statsd_client.gauge(
-            cst.STATS_SOURCE_CLIENTS_TODO,
-            len(set(map(lambda x: x["relation_id"], rows))),
+
+    def read_bulk(self, auth_rows: List[Dict]) -> Iterator[Dict]:
+        """
+        Streams the cleaned, in scope rows of all customers, read with one query per chunk of relations instead of
+        one query per customer.
+        """
+        auth_rows_per_relation = {}
+        for auth_row in auth_rows:
+            auth_rows_per_relation.setdefault(auth_row["relationId"], []).append(auth_row)
+        marks = {r: self.updated_after(r) for r in auth_rows_per_relation}
+        unmarked = [r for r, mark in marks.items() if mark is None]
+        marked = [r for r, mark in marks.items() if mark is not None]
+        # Marked relations are read from their oldest mark, clean_rows skips what is older than a relation's own
+        raw_rows = itertools.chain(
+            self.super_source.iter_rows_for(unmarked) if unmarked else [],
+            self.super_source.iter_rows_for(
+                marked, updated_after=min(marks[r] for r in marked)
+            ) if marked else [],
         )
+        return Tracer.get().iterate("source.read", self.clean_rows(raw_rows, auth_rows_per_relation))
+
+    def clean_rows(self, raw_rows: Iterable[Dict], auth_rows_per_relation: Dict) -> Iterator[Dict]:
+        already_done = self.already_done
+        found = 0
+        clients = set()
+        todo = 0
+        todo_clients = set()
+        for raw_row in raw_rows:
+            found += 1
+            clients.add(raw_row["relationId"])
+            updated = to_datetime(raw_row.get("updatedAt"))
+            if updated is not None:
+                seen = self.seen_marks.get(raw_row["relationId"])
+                if seen is None or updated > seen:
+                    self.seen_marks[raw_row["relationId"]] = updated
+                updated_after = self.updated_after(raw_row["relationId"])
+                if updated_after is not None and updated <= updated_after:
+                    continue
+            # Skip synced samples before spending time on cleaning them
+            if raw_row["orderSampleDataId"] in already_done:
+                continue
+            with span("source.clean"):
+                cleaned = self.clean_data(raw_row)
+            row = self.add_auth(
+                row=cleaned,
+                auth_rows=auth_rows_per_relation.get(raw_row["relationId"], []),
+            )
+            if not (row and len(row["result_group_data"]) > 0 and self.is_in_scope(row)):
+                continue
+            if todo == 0:
+                logger.debug(row)
+            todo += 1
+            todo_clients.add(row["relation_id"])
+            yield row
+        logger.debug(f"Found {found} rows")
+        self.statsd_client.gauge(cst.STATS_SOURCE_SAMPLES, found)
+        self.statsd_client.gauge(cst.STATS_SOURCE_CLIENTS, len(clients))
+        self.statsd_client.gauge(cst.STATS_SOURCE_SAMPLES_TODO, todo)
+        self.statsd_client.gauge(cst.STATS_SOURCE_CLIENTS_TODO, len(todo_clients))
         logger.debug(
-            f"Left with {len(rows)} rows after removing already done and rows without data."
+            f"Left with {todo} rows after removing already done and rows without data."
         )
-        return rows
 
     def read_all(self):
-        logger.info("Reading")
+        return list(self.iter_rows())
+
+    def read_auth_rows(self) -> List[Dict]:
         auth_rows = self.auth_source.read_all()
-        all_rows = map(self.read_single_user, auth_rows)
-        return [row for rows in all_rows for row in rows]
+        if self.shard is None:
+            return auth_rows
+        index, shards = self.shard
+        auth_rows = [r for r in auth_rows if shard_of(r["relationId"], shards) == index]
+        logger.info(f"Shard {index} of {shards} has {len(auth_rows)} auth rows")
+        return auth_rows
+
+    def iter_rows(self) -> Iterator[Dict]:
+        """
+        Streams the cleaned, in scope rows of all customers, customer by customer unless bulk_read is set.
+        """
+        logger.info("Reading")
+        auth_rows = self.read_auth_rows()
+        if self.bulk_read:
+            return self.read_bulk(auth_rows)
+        return itertools.chain.from_iterable(map(self.read_single_user, auth_rows))
+
+    def iter_partitions(self) -> Iterator[Tuple[Any, Callable[[], Iterator[Dict]]]]:
+        """
+        One partition per customer, keyed by relation id. With bulk_read all customers are read with one query,
+        so they form a single partition.
+        """
+        logger.info("Reading")
+        auth_rows = self.read_auth_rows()
+        if self.bulk_read:
+            yield None, lambda: self.read_bulk(auth_rows)
+            return
+        # Load the marks and already done ids once, before the partitions use them from several threads
+        self.updated_after(None)
+        self.already_done
+        for auth_row in auth_rows:
+            yield auth_row["relationId"], functools.partial(self.read_single_user, auth_row)
 
     def add_auth(self, row, auth_rows):
         try:
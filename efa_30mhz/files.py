@@ -0,0 +1,76 @@
+import threading
+from abc import ABC, abstractmethod
+from typing import IO, Iterable, List, Optional
+
+
+class LazyFile(ABC):
+    """
+    Reference to a file that is only fetched when it is opened, see ImportCheck.convert_row.
+    Files that share a loader can be fetched together up front with prefetch().
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.file = None
+        self.fetched = False
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def fetch(self) -> IO:
+        """
+        Fetches the file, raises FileUnavailableError if it can't be fetched.
+        """
+        raise NotImplementedError
+
+    def get_data_upload_id(self, organization) -> Optional[str]:
+        """
+        The dataUploadId this file got in an earlier upload to organization, if known.
+        """
+        return None
+
+    def set_data_upload_id(self, organization, data_upload_id):
+        pass
+
+    def set_file(self, file: IO):
+        with self.lock:
+            self.file = file
+            self.fetched = True
+
+    def open(self) -> IO:
+        with self.lock:
+            if self.file is None:
+                self.file = self.fetch()
+                self.fetched = True
+            file, self.file = self.file, None
+            return file
+
+    def release(self):
+        """
+        Closes the file when it was fetched but never opened, a later open() fetches it again.
+        """
+        with self.lock:
+            file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+
+def lazy_files(ingests: Iterable) -> List[LazyFile]:
+    return [
+        value
+        for ingest in ingests
+        for row in ingest["data"]
+        for value in row.values()
+        if isinstance(value, LazyFile)
+    ]
+
+
+def prefetch(files: Iterable[LazyFile]):
+    """
+    Lets the loader of each file fetch its files in one go, loaders without a prefetch method are skipped.
+    """
+    per_loader = {}
+    for f in files:
+        per_loader.setdefault(id(f.loader), (f.loader, []))[1].append(f)
+    for loader, loader_files in per_loader.values():
+        if hasattr(loader, "prefetch"):
+            loader.prefetch(loader_files)
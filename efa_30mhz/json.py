@@ -1,6 +1,7 @@
-from typing import List
+from typing import List, Iterator, Dict, Iterable
 import json
 
+from efa_30mhz.store import to_datetime
 from efa_30mhz.sync import Source
 
 
@@ -9,10 +10,35 @@ class JSONSource(Source):
     def to_thirty_mhz(**kwargs):
         pass
 
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, bulk_column="relationId", updated_column="updatedAt", **kwargs):
         super(JSONSource, self).__init__(**kwargs)
         self.filename = filename
+        self.bulk_column = bulk_column
+        self.updated_column = updated_column
+        self.rows = None
 
-    def read_all(self) -> List:
-        with open(self.filename, "r") as f:
-            return json.load(f)
+    def read_all(self, *args, **kwargs) -> List:
+        """
+        Reads all rows, or with an argument only the rows of which bulk_column equals it.
+        """
+        if self.rows is None:
+            with open(self.filename, "r") as f:
+                self.rows = json.load(f)
+        if len(args) > 0:
+            return [row for row in self.rows if row[self.bulk_column] == args[0]]
+        return self.rows
+
+    def iter_rows(self, *args, updated_after=None, **kwargs) -> Iterator[Dict]:
+        return (row for row in self.read_all(*args) if self.is_updated_after(row, updated_after))
+
+    def iter_rows_for(self, values: Iterable, updated_after=None) -> Iterator[Dict]:
+        values = set(values)
+        return (
+            row
+            for row in self.read_all()
+            if row[self.bulk_column] in values and self.is_updated_after(row, updated_after)
+        )
+
+    def is_updated_after(self, row, updated_after) -> bool:
+        updated = to_datetime(row.get(self.updated_column))
+        return updated_after is None or updated is None or updated > updated_after
@@ -1,6 +1,205 @@
+import atexit
+import threading
+import time
+from typing import Dict, List, Optional, Set, Union
+
 import statsd
+from statsd.client.base import StatsClientBase, PipelineBase
 from loguru import logger
 
+DEFAULT_MAX_STATS = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class BufferedPipeline(PipelineBase):
+    """
+    Pipeline of a client that buffers itself, its stats go to the client's buffer as one unit.
+    """
+
+    def _send(self):
+        while self._stats:
+            self._client._after(self._stats.popleft())
+
+
+class BufferedStatsClient(StatsClientBase):
+    """
+    Statsd client that buffers stats and sends them through a pipeline of the wrapped client, so they go out
+    packed into as few packets as fit. The buffer is flushed when it holds max_stats stats, on the first stat
+    after flush_interval seconds since the last flush, on flush() and when the process exits.
+    With aggregate, counters are summed, gauges keep their last value and sets their distinct values until the
+    flush, so a counter incremented for every ingest is a single stat per flush. Timings are always sent as is.
+    """
+
+    def __init__(
+            self,
+            client: StatsClientBase,
+            max_stats: int = DEFAULT_MAX_STATS,
+            flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+            aggregate: bool = True,
+    ):
+        self.client = client
+        self._prefix = getattr(client, "_prefix", None)
+        self.max_stats = max_stats
+        self.flush_interval = flush_interval
+        self.aggregate = aggregate
+        self.lock = threading.Lock()
+        self.lines: List[str] = []
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.sets: Dict[str, Set] = {}
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def incr(self, stat, count=1, rate=1):
+        if not self.aggregate or rate != 1:
+            return super(BufferedStatsClient, self).incr(stat, count, rate)
+        with self.lock:
+            self.counters[stat] = self.counters.get(stat, 0) + count
+            self.pending += 1
+        self.maybe_flush()
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        if not self.aggregate or rate != 1 or delta:
+            return super(BufferedStatsClient, self).gauge(stat, value, rate, delta)
+        with self.lock:
+            self.gauges[stat] = value
+            self.pending += 1
+        self.maybe_flush()
+
+    def set(self, stat, value, rate=1):
+        if not self.aggregate or rate != 1:
+            return super(BufferedStatsClient, self).set(stat, value, rate)
+        with self.lock:
+            self.sets.setdefault(stat, set()).add(value)
+            self.pending += 1
+        self.maybe_flush()
+
+    def _after(self, data):
+        if data:
+            with self.lock:
+                self.lines.append(data)
+                self.pending += 1
+            self.maybe_flush()
+
+    def pipeline(self):
+        return BufferedPipeline(self)
+
+    def maybe_flush(self):
+        if self.pending >= self.max_stats or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, counters, gauges, sets = self.lines, self.counters, self.gauges, self.sets
+            self.lines, self.counters, self.gauges, self.sets = [], {}, {}, {}
+            self.pending = 0
+            self.flushed_at = time.monotonic()
+        if not (lines or counters or gauges or sets):
+            return
+        pipe = self.client.pipeline()
+        for stat, count in counters.items():
+            pipe.incr(stat, count)
+        for stat, value in gauges.items():
+            pipe.gauge(stat, value)
+        for stat, values in sets.items():
+            for value in values:
+                pipe.set(stat, value)
+        for line in lines:
+            # Already prepared, with prefix and sample rate
+            pipe._stats.append(line)
+        pipe.send()
+
+    def close(self):
+        self.flush()
+        self.client.close()
+
+
+class MemoryStatsClient(StatsClientBase):
+    """
+    Statsd client that keeps the stats it's sent in memory, for tests.
+    """
+
+    def __init__(self, prefix=None):
+        self._prefix = prefix
+        self.lock = threading.Lock()
+        self.stats: List[str] = []
+
+    def _send(self, data):
+        with self.lock:
+            self.stats.extend(data.split("\n"))
+
+    def pipeline(self):
+        return MemoryPipeline(self)
+
+    def close(self):
+        pass
+
+    def values(self, stat) -> List[str]:
+        """
+        :return: the values sent for stat, like "3|c"
+        """
+        with self.lock:
+            return [line.split(":", 1)[1] for line in self.stats if line.split(":", 1)[0] == stat]
+
+    def count(self, stat) -> float:
+        """
+        :return: the sum of the counter stat
+        """
+        return sum(float(value.split("|")[0]) for value in self.values(stat) if value.endswith("|c"))
+
+
+class MemoryPipeline(PipelineBase):
+    def _send(self):
+        self._client._after("\n".join(self._stats))
+        self._stats.clear()
+
+
+class NullStatsClient(StatsClientBase):
+    """
+    Statsd client that drops every stat, for benchmarks.
+    """
+
+    _prefix = None
+
+    def _send_stat(self, stat, value, rate):
+        pass
+
+    def _send(self, data):
+        pass
+
+    def pipeline(self):
+        return NullPipeline(self)
+
+    def close(self):
+        pass
+
+
+class NullPipeline(PipelineBase):
+    def _send(self):
+        self._stats.clear()
+
+
+def create_client(backend: str = "udp", buffer: Union[bool, Dict] = None, **kwargs) -> StatsClientBase:
+    """
+    :param backend: udp for a statsd server at host and port, memory to keep stats in memory or null to drop them
+    :param buffer: arguments of a BufferedStatsClient ({max_stats, flush_interval, aggregate}) around the
+        backend, or False to send every stat when it happens. The udp backend is buffered by default.
+    :param kwargs: arguments of statsd.StatsClient, like host, port and prefix
+    """
+    if backend == "udp":
+        client = statsd.StatsClient(**kwargs)
+    elif backend == "memory":
+        client = MemoryStatsClient(prefix=kwargs.get("prefix"))
+    elif backend == "null":
+        client = NullStatsClient()
+    else:
+        raise ValueError(f"Unknown statsd backend {backend}")
+    if buffer is None:
+        buffer = backend == "udp"
+    if buffer is False:
+        return client
+    return BufferedStatsClient(client, **(buffer if isinstance(buffer, dict) else {}))
+
 
 class Metric:
     __instance = None
@@ -8,11 +207,27 @@ class Metric:
 
     @staticmethod
     def initialize_client(**kwargs):
+        """
+        :param kwargs: arguments of create_client, the statsd section of the config
+        """
+        Metric.flush()
         Metric.__kwargs = kwargs
+        Metric.__instance = None
 
     @staticmethod
-    def client() -> statsd.StatsClient:
+    def client() -> StatsClientBase:
         if Metric.__instance is None:
             assert Metric.__kwargs is not None
-            Metric.__instance = statsd.StatsClient(**Metric.__kwargs)
+            Metric.__instance = create_client(**Metric.__kwargs)
+            if isinstance(Metric.__instance, BufferedStatsClient):
+                atexit.register(Metric.__instance.flush)
         return Metric.__instance
+
+    @staticmethod
+    def flush():
+        """
+        Sends the stats a buffered client still holds.
+        """
+        if isinstance(Metric.__instance, BufferedStatsClient):
+            logger.debug("Flushing statsd buffer")
+            Metric.__instance.flush()
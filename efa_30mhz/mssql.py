@@ -1,31 +1,123 @@
-from typing import List
+import threading
+from typing import List, Iterator, Dict, Iterable
 import pymssql
 import pandas
 
 from efa_30mhz.sync import Source
+from efa_30mhz.tracing import Tracer
+
+DEFAULT_BATCH_SIZE = 500
+# SQL Server accepts at most 2100 parameters per query
+DEFAULT_BULK_CHUNK_SIZE = 1000
 
 
 class MSSQLSource(Source):
     def __init__(
-            self, server, user, password, database, port, table=None, query=None, **kwargs
+            self,
+            server,
+            user,
+            password,
+            database,
+            port,
+            table=None,
+            query=None,
+            batch_size=DEFAULT_BATCH_SIZE,
+            bulk_query=None,
+            bulk_column="relationId",
+            bulk_chunk_size=DEFAULT_BULK_CHUNK_SIZE,
+            updated_column="updatedAt",
+            **kwargs
     ):
         super().__init__(**kwargs)
-        self.conn = pymssql.connect(
+        self.connect_kwargs = dict(
             server=server, user=user, password=password, database=database, port=port
         )
+        self.conn = pymssql.connect(**self.connect_kwargs)
+        # A pymssql connection runs one query at a time, so other threads get a connection of their own
+        self.local = threading.local()
+        self.local.conn = self.conn
         self.table = table
         self.query = query
+        self.batch_size = batch_size
+        self.bulk_query = bulk_query
+        self.bulk_column = bulk_column
+        self.bulk_chunk_size = bulk_chunk_size
+        self.updated_column = updated_column
 
     @staticmethod
     def to_thirty_mhz(**kwargs):
         pass
 
-    def read_all(self, *args, **kwargs) -> List:
+    def get_query(self, *args) -> str:
         if not self.query and self.table:
             self.query = f"SELECT * FROM {self.table}"
         query = self.query
         if len(args) > 0:
             query = self.query.format(*args)
-        df = pandas.read_sql(query, self.conn)
+        return query
+
+    def read_all(self, *args, **kwargs) -> List:
+        df = pandas.read_sql(self.get_query(*args), self.conn)
         result = df.to_dict(orient="records")
         return result
+
+    def iter_rows(self, *args, updated_after=None, **kwargs) -> Iterator[Dict]:
+        """
+        Streams the result of the query as dict rows, fetching batch_size rows at a time.
+        :param updated_after: only stream rows of which updated_column is after this timestamp (or NULL)
+        """
+        query = self.get_query(*args)
+        if updated_after is None:
+            return self.execute(query)
+        # The query is not formatted by pymssql, so literal percent signs must be escaped
+        query = query.replace("%", "%%")
+        return self.execute(
+            f"SELECT * FROM ({query}) AS incremental "
+            f"WHERE (incremental.{self.updated_column} > %s OR incremental.{self.updated_column} IS NULL)",
+            (updated_after,),
+        )
+
+    def get_bulk_query(self, count, updated_after=False) -> str:
+        base = self.bulk_query or f"SELECT * FROM {self.table}"
+        placeholders = ", ".join(["%s"] * count)
+        # The base query is not formatted by pymssql, so literal percent signs must be escaped
+        base = base.replace("%", "%%")
+        query = f"SELECT * FROM ({base}) AS bulk WHERE bulk.{self.bulk_column} IN ({placeholders})"
+        if updated_after:
+            query += f" AND (bulk.{self.updated_column} > %s OR bulk.{self.updated_column} IS NULL)"
+        return query
+
+    def iter_rows_for(self, values: Iterable, updated_after=None) -> Iterator[Dict]:
+        """
+        Streams the rows of bulk_query (or the whole table) of which bulk_column is one of values and, if given,
+        updated_column is after updated_after. Values are passed as query parameters, bulk_chunk_size values per
+        query.
+        """
+        values = list(values)
+        for start in range(0, len(values), self.bulk_chunk_size):
+            chunk = tuple(values[start: start + self.bulk_chunk_size])
+            if updated_after is not None:
+                query = self.get_bulk_query(len(chunk), updated_after=True)
+                yield from self.execute(query, chunk + (updated_after,))
+            else:
+                yield from self.execute(self.get_bulk_query(len(chunk)), chunk)
+
+    def connection(self):
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = pymssql.connect(**self.connect_kwargs)
+        return self.local.conn
+
+    def execute(self, query, params=None) -> Iterator[Dict]:
+        return Tracer.get().iterate("source.sql", self.fetch(query, params))
+
+    def fetch(self, query, params=None) -> Iterator[Dict]:
+        cursor = self.connection().cursor(as_dict=True)
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
@@ -1,38 +1,117 @@
+import binascii
 import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, IO, Iterable
 
 from loguru import logger
 from zeep import Client
-import base64
 
-from efa_30mhz.errors import EurofinsError
+from efa_30mhz.errors import EurofinsError, FileUnavailableError
+from efa_30mhz.files import LazyFile
+from efa_30mhz.pdf_cache import PDFCache
+from efa_30mhz.tracing import traced
+
+DEFAULT_WORKERS = 4
+DEFAULT_RESOURCES_PER_REQUEST = 1
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+DECODE_CHUNK_SIZE = 64 * 1024
+
+if not issubclass(tempfile.SpooledTemporaryFile, io.IOBase):  # Python < 3.11
+    io.IOBase.register(tempfile.SpooledTemporaryFile)
+
+
+class PDFHandle(LazyFile):
+    """
+    A PDF of the Eurofins resource service that is only fetched when it's needed.
+    """
+
+    def __init__(self, pdf: "PDF", relation_id, resource_id):
+        super(PDFHandle, self).__init__(loader=pdf)
+        self.relation_id = relation_id
+        self.resource_id = resource_id
+
+    @property
+    def row(self) -> Dict:
+        return {"relation_id": self.relation_id, "resource_id": self.resource_id}
+
+    def fetch(self) -> IO:
+        try:
+            return self.loader.get_pdf(self.row)
+        except EurofinsError as e:
+            raise FileUnavailableError(e.message)
+
+    def get_data_upload_id(self, organization):
+        if self.loader.cache is None:
+            return None
+        return self.loader.cache.get_data_upload_id(
+            self.relation_id, self.resource_id, organization
+        )
+
+    def set_data_upload_id(self, organization, data_upload_id):
+        if self.loader.cache is not None:
+            self.loader.cache.set_data_upload_id(
+                self.relation_id, self.resource_id, organization, data_upload_id
+            )
 
 
 class PDF:
-    def __init__(self, wsdl):
+    def __init__(
+            self,
+            wsdl,
+            workers: int = DEFAULT_WORKERS,
+            resources_per_request: int = DEFAULT_RESOURCES_PER_REQUEST,
+            spool_size: int = DEFAULT_SPOOL_SIZE,
+            cache: Dict = None,
+    ):
+        """
+        :param wsdl: location of the Eurofins resource service, None to serve application.pdf for every row
+        :param workers: number of concurrent getResource calls in get_pdfs
+        :param resources_per_request: number of resourceIds of one relation requested per getResource call
+        :param spool_size: PDFs larger than this many bytes are decoded to disk instead of memory
+        :param cache: arguments of a PDFCache ({directory, max_bytes}) to keep fetched PDFs on disk
+        """
         self.client = None
         if wsdl is not None:
             self.client = Client(wsdl)
+        self.workers = workers
+        self.resources_per_request = resources_per_request
+        self.spool_size = spool_size
+        self.cache = PDFCache(**cache) if cache else None
 
-    def get_pdf(self, row):
-        if self.client is None:
-            return open("application.pdf", "rb")
+    @staticmethod
+    def key(row) -> Tuple:
+        return row["relation_id"], row["resource_id"]
 
-        logger.info(f'Getting pdf {row["resource_id"]} for client {row["relation_id"]}')
-        resource_request = {
+    def resource_request(self, relation_id, resource_ids: List) -> Dict:
+        resources = [
+            {
+                "resourceId": resource_id,
+                "resourceTypeId": 3,
+            }
+            for resource_id in resource_ids
+        ]
+        return {
             "user": {
-                "userName": row["relation_id"],
-                "requesterRelationId": row["relation_id"],
+                "userName": relation_id,
+                "requesterRelationId": relation_id,
             },
-            "relationId": row["relation_id"],
+            "relationId": relation_id,
             "resources": [
                 {
-                    "ResourceRequestArray": {
-                        "resourceId": row["resource_id"],
-                        "resourceTypeId": 3,
-                    }
+                    "ResourceRequestArray": resources[0] if len(resources) == 1 else resources
                 }
             ],
         }
+
+    @traced("pdf.soap", tags=lambda self, relation_id, resource_ids: {"relation": relation_id})
+    def get_resources(self, relation_id, resource_ids: List) -> Dict[Tuple, IO]:
+        """
+        Fetches several resources of one relation in a single getResource call.
+        :return: files keyed by (relation_id, resource_id)
+        """
+        logger.info(f"Getting pdfs {resource_ids} for client {relation_id}")
+        resource_request = self.resource_request(relation_id, resource_ids)
         b64_response = self.client.service.getResource(
             getResourcesRequest=resource_request
         )
@@ -40,11 +119,123 @@ class PDF:
         if "resources" not in b64_response or b64_response["resources"] is None:
             logger.error("No PDF found")
             raise EurofinsError(
-                f'PDF not found for resourceId {row["resource_id"]}, relationId {row["relation_id"]}. {resource_request}'
+                f"PDF not found for resourceIds {resource_ids}, relationId {relation_id}. {resource_request}"
             )
-        b64_pdf = b64_response["resources"]["ResourceResponseArray"][0][
-            "resourceContent"
-        ]
-        pdf = base64.decodebytes(b64_pdf.encode("utf-8"))
-        f = io.BytesIO(pdf)
+        resources = b64_response["resources"]["ResourceResponseArray"]
+        files = {}
+        if len(resource_ids) == 1:
+            files[(relation_id, resource_ids[0])] = self.decode(resources[0]["resourceContent"])
+            return self.store(files)
+        # The service returns resourceIds as strings, whatever type they were requested as
+        requested = {str(resource_id): resource_id for resource_id in resource_ids}
+        for position, resource in enumerate(resources):
+            try:
+                resource_id = requested[str(resource["resourceId"])]
+            except (KeyError, AttributeError):
+                if len(resources) != len(resource_ids):
+                    raise EurofinsError(
+                        f"Can't match {len(resources)} PDFs to resourceIds {resource_ids}, relationId {relation_id}"
+                    )
+                resource_id = resource_ids[position]
+            files[(relation_id, resource_id)] = self.decode(resource["resourceContent"])
+        return self.store(files)
+
+    def store(self, files: Dict[Tuple, IO]) -> Dict[Tuple, IO]:
+        if self.cache is not None:
+            for (relation_id, resource_id), f in files.items():
+                self.cache.put(relation_id, resource_id, f)
+        return files
+
+    def decode(self, b64_pdf) -> IO:
+        """
+        Decodes a base64 encoded PDF chunk by chunk into a spooled temporary file.
+        """
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        if isinstance(b64_pdf, bytes):
+            # zeep already decoded xsd:base64Binary content
+            f.write(b64_pdf)
+        else:
+            rest = ""
+            for start in range(0, len(b64_pdf), DECODE_CHUNK_SIZE):
+                chunk = rest + "".join(b64_pdf[start: start + DECODE_CHUNK_SIZE].split())
+                end = len(chunk) - len(chunk) % 4
+                f.write(binascii.a2b_base64(chunk[:end]))
+                rest = chunk[end:]
+            if rest:
+                f.write(binascii.a2b_base64(rest))
+        f.seek(0)
         return f
+
+    @traced("pdf.get", tags=lambda self, row: {"relation": row["relation_id"]})
+    def get_pdf(self, row):
+        if self.client is None:
+            return open("application.pdf", "rb")
+        if self.cache is not None:
+            f = self.cache.get(row["relation_id"], row["resource_id"])
+            if f is not None:
+                return f
+        return self.get_resources(row["relation_id"], [row["resource_id"]])[self.key(row)]
+
+    def handle(self, row) -> PDFHandle:
+        return PDFHandle(self, row["relation_id"], row["resource_id"])
+
+    def prefetch(self, handles: List[PDFHandle]):
+        """
+        Fetches the PDFs of handles that were not fetched yet and are not cached with get_pdfs.
+        """
+        handles = [
+            h
+            for h in handles
+            if not h.fetched
+               and not (self.cache is not None and self.cache.contains(h.relation_id, h.resource_id))
+        ]
+        files = self.get_pdfs(h.row for h in handles)
+        for h in handles:
+            if self.key(h.row) in files:
+                h.set_file(files.pop(self.key(h.row)))
+
+    def get_pdfs(self, rows: Iterable[Dict]) -> Dict[Tuple, IO]:
+        """
+        Fetches the PDFs of many rows with `workers` concurrent getResource calls.
+        Rows of which the PDF could not be fetched are missing from the result.
+        :return: files keyed by (relation_id, resource_id)
+        """
+        if self.client is None:
+            return {self.key(row): self.get_pdf(row) for row in rows}
+
+        files = {}
+        resource_ids = {}
+        for row in rows:
+            if self.cache is not None:
+                f = self.cache.get(row["relation_id"], row["resource_id"])
+                if f is not None:
+                    files[self.key(row)] = f
+                    continue
+            resource_ids.setdefault(row["relation_id"], {})[row["resource_id"]] = None
+        requests = []
+        for relation_id, ids in resource_ids.items():
+            ids = list(ids)
+            for start in range(0, len(ids), self.resources_per_request):
+                requests.append((relation_id, ids[start: start + self.resources_per_request]))
+
+        def fetch(request):
+            relation_id, ids = request
+            try:
+                return self.get_resources(relation_id, ids)
+            except EurofinsError as e:
+                logger.debug(e.message)
+                if len(ids) == 1:
+                    return {}
+            # One missing PDF fails the whole call, so retry the resources one by one
+            files = {}
+            for resource_id in ids:
+                try:
+                    files.update(self.get_resources(relation_id, [resource_id]))
+                except EurofinsError as e:
+                    logger.debug(e.message)
+            return files
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for fetched in executor.map(fetch, requests):
+                files.update(fetched)
+        return files
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import IO, Optional
+
+from loguru import logger
+
+from efa_30mhz.metrics import Metric
+import efa_30mhz.constants as cst
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class PDFCache:
+    """
+    On-disk cache of Eurofins PDFs.
+    Files are stored by the sha256 of their content. An index maps (relation_id, resource_id) to a content hash,
+    and a content hash plus organization to the dataUploadId it got in 30MHz. When the files together grow
+    beyond max_bytes, the least recently used files are evicted. Evicting a file keeps its hash and upload ids,
+    so a report that was uploaded before is still never uploaded again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"), check_same_thread=False
+        )
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS resources "
+                "(relation_id TEXT, resource_id TEXT, hash TEXT, PRIMARY KEY (relation_id, resource_id))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS uploads "
+                "(hash TEXT, organization TEXT, data_upload_id TEXT, PRIMARY KEY (hash, organization))"
+            )
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        self.statsd_client = Metric.client()
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, "blobs", content_hash[:2], content_hash)
+
+    def get_hash(self, relation_id, resource_id) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash FROM resources WHERE relation_id = ? AND resource_id = ?",
+                (str(relation_id), str(resource_id)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def has_blob(self, content_hash: str) -> bool:
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)
+            ).fetchone() is not None
+
+    def contains(self, relation_id, resource_id) -> bool:
+        content_hash = self.get_hash(relation_id, resource_id)
+        return content_hash is not None and self.has_blob(content_hash)
+
+    def get(self, relation_id, resource_id) -> Optional[IO]:
+        content_hash = self.get_hash(relation_id, resource_id)
+        if content_hash is not None and self.has_blob(content_hash):
+            try:
+                f = open(self.path(content_hash), "rb")
+                with self.lock, self.db:
+                    self.db.execute(
+                        "UPDATE blobs SET last_used = ? WHERE hash = ?",
+                        (time.time(), content_hash),
+                    )
+                self.statsd_client.incr(cst.STATS_SOURCE_PDF_CACHE_HITS)
+                return f
+            except FileNotFoundError:
+                logger.warning(f"Cached PDF {content_hash} disappeared")
+                self.remove(content_hash)
+        self.statsd_client.incr(cst.STATS_SOURCE_PDF_CACHE_MISSES)
+        return None
+
+    def put(self, relation_id, resource_id, file: IO) -> str:
+        """
+        Stores the content of file, atomically, and rewinds file.
+        :return: the content hash
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=os.path.join(self.directory, "blobs"))
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    size += len(chunk)
+                    temp.write(chunk)
+            content_hash = sha.hexdigest()
+            os.makedirs(os.path.dirname(self.path(content_hash)), exist_ok=True)
+            os.replace(temp_path, self.path(content_hash))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        file.seek(0)
+        with self.lock, self.db:
+            previous = self.db.execute(
+                "SELECT size FROM blobs WHERE hash = ?", (content_hash,)
+            ).fetchone()
+            self.total += size - (previous[0] if previous else 0)
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs (hash, size, last_used) VALUES (?, ?, ?)",
+                (content_hash, size, time.time()),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO resources (relation_id, resource_id, hash) VALUES (?, ?, ?)",
+                (str(relation_id), str(resource_id), content_hash),
+            )
+        self.evict()
+        return content_hash
+
+    def remove(self, content_hash: str):
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT size FROM blobs WHERE hash = ?", (content_hash,)
+            ).fetchone()
+            if row is not None:
+                self.total -= row[0]
+            self.db.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+        try:
+            os.remove(self.path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while self.total > self.max_bytes:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT hash FROM blobs ORDER BY last_used LIMIT 1"
+                ).fetchone()
+            if row is None:
+                return
+            logger.debug(f"Evicting cached PDF {row[0]}")
+            self.remove(row[0])
+            self.statsd_client.incr(cst.STATS_SOURCE_PDF_CACHE_EVICTIONS)
+
+    def get_data_upload_id(self, relation_id, resource_id, organization) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT u.data_upload_id FROM resources r JOIN uploads u ON u.hash = r.hash "
+                "WHERE r.relation_id = ? AND r.resource_id = ? AND u.organization = ?",
+                (str(relation_id), str(resource_id), str(organization)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_data_upload_id(self, relation_id, resource_id, organization, data_upload_id):
+        content_hash = self.get_hash(relation_id, resource_id)
+        if content_hash is None:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads (hash, organization, data_upload_id) VALUES (?, ?, ?)",
+                (content_hash, str(organization), str(data_upload_id)),
+            )
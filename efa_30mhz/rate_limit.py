@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+DEFAULT_BURST = 5
+DEFAULT_MIN_RATE = 0.5
+DEFAULT_DECREASE = 0.5
+DEFAULT_INCREASE = 0.05
+DEFAULT_THROTTLE_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1.0
+# Number of recent requests the rate before the first 429 is measured over
+RATE_WINDOW = 50
+
+
+def parse_retry_after(value, now: datetime = None) -> Optional[float]:
+    """
+    :param value: a Retry-After header, in seconds or as an HTTP date
+    :return: seconds to wait, None when there is no usable header
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - (now or datetime.now(timezone.utc))).total_seconds())
+
+
+class TokenBucket:
+    """
+    Client side rate limit of one api key and organization, that adapts to the throttling of 30MHz.
+    Without a rate, requests are not limited until the first 429. A 429 halts all requests until its Retry-After
+    passed and multiplies the rate by decrease, starting from the rate measured over the last requests. Every
+    successful request then adds increase requests per second to the rate, so the rate settles just below the
+    limit of 30MHz. Up to burst requests may go out at once.
+    """
+
+    def __init__(
+            self,
+            rate: float = None,
+            burst: int = DEFAULT_BURST,
+            min_rate: float = DEFAULT_MIN_RATE,
+            max_rate: float = None,
+            decrease: float = DEFAULT_DECREASE,
+            increase: float = DEFAULT_INCREASE,
+    ):
+        """
+        :param rate: requests per second to start with, None to not limit until throttled
+        :param min_rate: the rate is never cut below this many requests per second
+        :param max_rate: the rate never grows beyond this many requests per second
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.recent = deque(maxlen=RATE_WINDOW)
+
+    def acquire(self) -> float:
+        """
+        Waits until a request may go out.
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token when there is one, without waiting, for callers that wait in their own way like asyncio.
+        :return: 0 when a request may go out, otherwise the seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if wait > 0:
+                return wait
+            if self.rate is None:
+                self.recent.append(now)
+                return 0
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.recent.append(now)
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def measured_rate(self) -> Optional[float]:
+        if len(self.recent) < 2 or self.recent[-1] <= self.recent[0]:
+            return None
+        return (len(self.recent) - 1) / (self.recent[-1] - self.recent[0])
+
+    def throttled(self, retry_after: float = None):
+        """
+        Registers a 429 response.
+        :param retry_after: seconds of its Retry-After header
+        """
+        with self.lock:
+            now = time.monotonic()
+            # Requests that were in flight together are throttled together, cut the rate once for all of them
+            if now >= self.blocked_until:
+                rate = self.rate if self.rate is not None else self.measured_rate()
+                # Too few requests to measure, allow a burst per second
+                rate = (rate or float(self.burst)) * self.decrease
+                self.rate = max(self.min_rate, rate)
+            self.tokens = 0.0
+            self.updated_at = now
+            self.blocked_until = max(
+                self.blocked_until,
+                now + (retry_after if retry_after is not None else DEFAULT_RETRY_AFTER),
+            )
+
+    def succeeded(self):
+        """
+        Registers a response that was not throttled.
+        """
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate += self.increase
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+
+class RateLimiter:
+    """
+    Hands out one token bucket per (api_key, organization), all configured the same way.
+    """
+
+    def __init__(self, retries: int = DEFAULT_THROTTLE_RETRIES, **bucket_kwargs):
+        """
+        :param retries: number of times a throttled request is sent again
+        :param bucket_kwargs: arguments of TokenBucket
+        """
+        self.retries = retries
+        self.bucket_kwargs = bucket_kwargs
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def get(self, api_key, organization) -> TokenBucket:
+        with self.lock:
+            if (api_key, organization) not in self.buckets:
+                self.buckets[(api_key, organization)] = TokenBucket(**self.bucket_kwargs)
+            return self.buckets[(api_key, organization)]
@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.rate_limit import TokenBucket, RateLimiter, parse_retry_after, DEFAULT_THROTTLE_RETRIES
+import efa_30mhz.constants as cst
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+# Requests that may be sent again after a 5xx or a read timeout. The server may have applied a POST that failed
+# that way, so a POST is only sent again when it could not connect
+RETRY_METHODS = frozenset({"GET"})
+THROTTLED = 429
+
+
+class JitteredRetry(Retry):
+    """
+    Retry policy with "full jitter": the exponential backoff is used as the upper bound of a random sleep,
+    so clients that were throttled at the same moment don't all come back at the same moment.
+    """
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # A 429 is left to the rate limit of the session, that slows down all requests of the tenant
+        if status_code == THROTTLED:
+            return False
+        return super(JitteredRetry, self).is_retry(method, status_code, has_retry_after)
+
+
+class ThirtyMHzSession(requests.Session):
+    """
+    A keep-alive session with a connection pool, default timeouts and retries on connection errors, and for GETs
+    also on 5xx and read timeouts.
+    With a rate limit, requests wait for its token bucket, and a 429 slows the bucket down and is sent again once
+    its Retry-After passed, up to throttle_retries times.
+    """
+
+    def __init__(
+            self,
+            pool_size: int = DEFAULT_POOL_SIZE,
+            connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+            read_timeout: float = DEFAULT_READ_TIMEOUT,
+            retries: int = DEFAULT_RETRIES,
+            backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+            rate_limit: TokenBucket = None,
+            throttle_retries: int = DEFAULT_THROTTLE_RETRIES,
+    ):
+        super(ThirtyMHzSession, self).__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limit = rate_limit
+        self.throttle_retries = throttle_retries
+        retry = JitteredRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=RETRY_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if self.rate_limit is not None:
+                waited = self.rate_limit.acquire()
+                if waited > 0:
+                    Metric.client().timing(cst.STATS_30MHZ_THROTTLE_WAIT, waited * 1000)
+            r = super(ThirtyMHzSession, self).request(method, url, **kwargs)
+            if r.status_code != THROTTLED:
+                if self.rate_limit is not None:
+                    self.rate_limit.succeeded()
+                return r
+            Metric.client().incr(cst.STATS_30MHZ_THROTTLED)
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            if self.rate_limit is not None:
+                self.rate_limit.throttled(retry_after)
+            attempt += 1
+            if attempt > self.throttle_retries:
+                return r
+            if self.rate_limit is None:
+                time.sleep(retry_after if retry_after is not None else 2 ** attempt)
+            rewind(kwargs.get("files"))
+
+
+def rewind(files):
+    """
+    Rewinds the files of a multipart request that is sent again.
+    """
+    for value in (files or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, "seek"):
+            f.seek(0)
+
+
+class SessionPool:
+    """
+    Hands out one session per (api_key, organization), all configured the same way, each with the token bucket
+    of its api key and organization.
+    """
+
+    def __init__(self, rate_limit: Dict = None, **session_kwargs):
+        """
+        :param rate_limit: arguments of a RateLimiter ({retries, rate, burst, min_rate, max_rate, ...}), or False
+            to leave 429s unlimited
+        """
+        self.rate_limiter = None if rate_limit is False else RateLimiter(**(rate_limit or {}))
+        self.session_kwargs = session_kwargs
+        self.sessions: Dict[Tuple[str, str], ThirtyMHzSession] = {}
+        self.lock = threading.Lock()
+
+    def get(self, api_key, organization) -> ThirtyMHzSession:
+        with self.lock:
+            if (api_key, organization) not in self.sessions:
+                rate_limit = None
+                if self.rate_limiter is not None:
+                    rate_limit = self.rate_limiter.get(api_key, organization)
+                    self.session_kwargs.setdefault("throttle_retries", self.rate_limiter.retries)
+                self.sessions[(api_key, organization)] = ThirtyMHzSession(
+                    rate_limit=rate_limit, **self.session_kwargs
+                )
+            return self.sessions[(api_key, organization)]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
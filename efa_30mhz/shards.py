@@ -0,0 +1,116 @@
+import os
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+from efa_30mhz.rate_limit import DEFAULT_BURST, DEFAULT_MIN_RATE
+
+
+def shard_of(relation_id, shards: int) -> int:
+    """
+    The shard of a relation, stable between runs and processes, unlike hash().
+    """
+    return zlib.crc32(str(relation_id).encode()) % shards
+
+
+def shard_path(path: str, index: int) -> str:
+    return f"{path}.shard{index}"
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock, between processes and between threads, held for the block. Needs fcntl, so only sharded runs
+    are POSIX only.
+    """
+    import fcntl
+
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def shard_rate_limit(rate_limit: Dict, shards: int) -> Dict:
+    """
+    The rate limit settings of one of shards processes, so that together they stay within rate_limit. Every shard
+    limits its own requests, so the rates and the burst are split; increase is not, a shard only counts its own
+    successful requests.
+    :param rate_limit: arguments of a RateLimiter, see SessionPool
+    """
+    rate_limit = dict(rate_limit)
+    rate_limit.setdefault("min_rate", DEFAULT_MIN_RATE)
+    for key in ("rate", "min_rate", "max_rate"):
+        if rate_limit.get(key) is not None:
+            rate_limit[key] = rate_limit[key] / shards
+    rate_limit["burst"] = max(1, rate_limit.get("burst", DEFAULT_BURST) // shards)
+    return rate_limit
+
+
+def merge_done_files(paths: Iterable[str], out: str) -> List[str]:
+    """
+    Concatenates the already done files of the shards into out, in the format of a single run, and removes them.
+    :return: the merged ids
+    """
+    ids = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as f:
+            ids.extend(line for line in map(str.strip, f) if line)
+        os.remove(path)
+    with open(out, "w") as f:
+        f.write("\n".join(ids))
+    return ids
+
+
+def merge_stats(shard_stats: Iterable[List[str]]) -> List[str]:
+    """
+    Merges the statsd lines of the shards into the lines of a single run. Counters, timings and sets add up on the
+    statsd server as they are, but a gauge of a shard only counts its own relations, so the last value of every
+    shard is summed, the way a bulk read counts all relations.
+    :param shard_stats: the lines of every shard
+    """
+    merged = []
+    gauges: Dict[str, float] = {}
+    for lines in shard_stats:
+        last: Dict[str, float] = {}
+        for line in lines:
+            if not line:
+                continue
+            stat, _, value = line.partition(":")
+            number, _, kind = value.partition("|")
+            if kind == "g" and number[:1] not in ("+", "-"):
+                last[stat] = float(number)
+            else:
+                merged.append(line)
+        for stat, value in last.items():
+            gauges[stat] = gauges.get(stat, 0) + value
+    merged.extend(
+        f"{stat}:{int(value) if value.is_integer() else value}|g" for stat, value in gauges.items()
+    )
+    return merged
+
+
+def send_stats(client, lines: Iterable[str]):
+    """
+    Sends statsd lines, like those of merge_stats, through the client as if they happened in this process. The lines
+    are without prefix, the client adds its own. Sampled counters are scaled up, the rest is sent as it is.
+    """
+    for line in lines:
+        stat, _, value = line.partition(":")
+        number, kind, *rest = value.split("|")
+        rate = float(rest[0][1:]) if rest and rest[0].startswith("@") else 1
+        if kind == "c":
+            count = float(number) / rate
+            client.incr(stat, int(count) if count.is_integer() else count)
+        elif kind == "g":
+            client.gauge(stat, float(number) if "." in number else int(number), delta=number[:1] in ("+", "-"))
+        elif kind == "ms":
+            client.timing(stat, float(number))
+        elif kind == "s":
+            client.set(stat, number)
+        else:
+            raise ValueError(f"Unknown statsd line {line}")
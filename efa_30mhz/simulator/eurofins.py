@@ -0,0 +1,295 @@
+"""
+A stand-in for the Eurofins resource SOAP service, serving getResource with generated PDFs of a configurable size,
+latency and set of missing resources.
+
+    python -m efa_30mhz.simulator.eurofins --port 8031 --document-size 200000
+
+and point the source at it with `wsdl: http://127.0.0.1:8031/resources?wsdl`.
+"""
+import base64
+import hashlib
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, List, Tuple
+from xml.sax.saxutils import escape
+
+import click
+
+NAMESPACE = "http://eurofins.simulator/resources"
+SOAP_NAMESPACE = "http://schemas.xmlsoap.org/soap/envelope/"
+
+WSDL = """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/"
+             xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+             xmlns:tns="{namespace}"
+             targetNamespace="{namespace}">
+  <types>
+    <xsd:schema targetNamespace="{namespace}" elementFormDefault="qualified">
+      <xsd:complexType name="User">
+        <xsd:sequence>
+          <xsd:element name="userName" type="xsd:string" minOccurs="0"/>
+          <xsd:element name="requesterRelationId" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ResourceRequest">
+        <xsd:sequence>
+          <xsd:element name="resourceId" type="xsd:string"/>
+          <xsd:element name="resourceTypeId" type="xsd:int"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ResourceRequests">
+        <xsd:sequence>
+          <xsd:element name="ResourceRequestArray" type="tns:ResourceRequest" maxOccurs="unbounded"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GetResourcesRequest">
+        <xsd:sequence>
+          <xsd:element name="user" type="tns:User" minOccurs="0"/>
+          <xsd:element name="relationId" type="xsd:string"/>
+          <xsd:element name="resources" type="tns:ResourceRequests" maxOccurs="unbounded"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ResourceResponse">
+        <xsd:sequence>
+          <xsd:element name="resourceId" type="xsd:string" minOccurs="0"/>
+          <xsd:element name="resourceContent" type="xsd:base64Binary"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ResourceResponses">
+        <xsd:sequence>
+          <xsd:element name="ResourceResponseArray" type="tns:ResourceResponse" maxOccurs="unbounded"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:element name="getResource">
+        <xsd:complexType>
+          <xsd:sequence>
+            <xsd:element name="getResourcesRequest" type="tns:GetResourcesRequest"/>
+          </xsd:sequence>
+        </xsd:complexType>
+      </xsd:element>
+      <xsd:element name="getResourceResponse">
+        <xsd:complexType>
+          <xsd:sequence>
+            <xsd:element name="relationId" type="xsd:string" minOccurs="0"/>
+            <xsd:element name="resources" type="tns:ResourceResponses" minOccurs="0"/>
+          </xsd:sequence>
+        </xsd:complexType>
+      </xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="getResourceRequest">
+    <part name="parameters" element="tns:getResource"/>
+  </message>
+  <message name="getResourceResponse">
+    <part name="parameters" element="tns:getResourceResponse"/>
+  </message>
+  <portType name="ResourcePort">
+    <operation name="getResource">
+      <input message="tns:getResourceRequest"/>
+      <output message="tns:getResourceResponse"/>
+    </operation>
+  </portType>
+  <binding name="ResourceBinding" type="tns:ResourcePort">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="getResource">
+      <soap:operation soapAction="getResource"/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="ResourceService">
+    <port name="ResourcePort" binding="tns:ResourceBinding">
+      <soap:address location="{location}"/>
+    </port>
+  </service>
+</definitions>
+"""
+
+
+def document(relation_id, resource_id, size: int) -> bytes:
+    """
+    A deterministic PDF-like document of size bytes for a resource.
+    """
+    header = f"%PDF-1.4\n% relation {relation_id} resource {resource_id}\n".encode()
+    seed = hashlib.sha256(f"{relation_id}/{resource_id}".encode()).digest()
+    body = (seed * (size // len(seed) + 1))[: max(0, size - len(header) - 6)]
+    return header + body + b"\n%%EOF"
+
+
+class EurofinsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "EurofinsServer"
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        self.respond(200, simulator.get_wsdl().encode(), "text/xml; charset=utf-8")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, response = self.server.simulator.handle(body)
+        self.respond(status, response, "text/xml; charset=utf-8")
+
+    def respond(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EurofinsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    simulator: "EurofinsSimulator"
+
+
+class EurofinsSimulator:
+    """
+    Serves the WSDL on GET and getResource on POST, on a background thread.
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            document_size: int = 100 * 1024,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            missing: Iterable[Tuple[str, str]] = (),
+            seed: int = None,
+    ):
+        """
+        :param document_size: size in bytes of every served PDF
+        :param latency: seconds every getResource call takes at least
+        :param jitter: up to this many seconds are added to the latency at random
+        :param missing: (relation_id, resource_id) of resources the service doesn't have. A call asking for one
+            of them gets no resources at all.
+        """
+        self.document_size = document_size
+        self.latency = latency
+        self.jitter = jitter
+        self.missing = {(str(r), str(i)) for r, i in missing}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_sent = 0
+        # resource ids per call -> number of calls
+        self.resources_per_call = Counter()
+        self.server = EurofinsServer((host, port), EurofinsHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/resources"
+
+    @property
+    def wsdl(self) -> str:
+        return self.url + "?wsdl"
+
+    def get_wsdl(self) -> str:
+        return WSDL.format(namespace=NAMESPACE, location=self.url)
+
+    def start(self) -> "EurofinsSimulator":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def handle(self, body: bytes) -> Tuple[int, bytes]:
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        try:
+            if delay:
+                time.sleep(delay)
+            try:
+                relation_id, resource_ids = self.parse(body)
+            except (ET.ParseError, AttributeError) as e:
+                return 500, self.fault(f"Bad request: {e}")
+            with self.lock:
+                self.resources_per_call[len(resource_ids)] += 1
+            response = self.response(relation_id, resource_ids)
+            with self.lock:
+                self.bytes_sent += len(response)
+            return 200, response
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    @staticmethod
+    def parse(body: bytes) -> Tuple[str, List[str]]:
+        ns = {"r": NAMESPACE}
+        request = ET.fromstring(body).find(".//r:getResourcesRequest", ns)
+        relation_id = request.find("r:relationId", ns).text
+        resource_ids = [e.text for e in request.iterfind("r:resources/r:ResourceRequestArray/r:resourceId", ns)]
+        return relation_id, resource_ids
+
+    def response(self, relation_id, resource_ids: List[str]) -> bytes:
+        resources = ""
+        if not any((str(relation_id), str(i)) in self.missing for i in resource_ids):
+            resources = "<resources>" + "".join(
+                "<ResourceResponseArray>"
+                f"<resourceId>{escape(str(i))}</resourceId>"
+                f"<resourceContent>{base64.b64encode(document(relation_id, i, self.document_size)).decode()}</resourceContent>"
+                "</ResourceResponseArray>"
+                for i in resource_ids
+            ) + "</resources>"
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<soap:Envelope xmlns:soap="{SOAP_NAMESPACE}"><soap:Body>'
+            f'<getResourceResponse xmlns="{NAMESPACE}"><relationId>{escape(str(relation_id))}</relationId>{resources}'
+            f"</getResourceResponse></soap:Body></soap:Envelope>"
+        ).encode()
+
+    @staticmethod
+    def fault(message) -> bytes:
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<soap:Envelope xmlns:soap="{SOAP_NAMESPACE}"><soap:Body><soap:Fault>'
+            f"<faultcode>soap:Client</faultcode><faultstring>{escape(message)}</faultstring>"
+            f"</soap:Fault></soap:Body></soap:Envelope>"
+        ).encode()
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8031)
+@click.option("--document-size", type=int, default=100 * 1024, help="Bytes per PDF")
+@click.option("--latency", type=float, default=0.0, help="Seconds every call takes")
+@click.option("--jitter", type=float, default=0.0, help="Random extra seconds per call")
+def main(host, port, document_size, latency, jitter):
+    simulator = EurofinsSimulator(
+        host=host, port=port, document_size=document_size, latency=latency, jitter=jitter
+    )
+    print(f"Serving a Eurofins resource service stand-in, WSDL at {simulator.wsdl}")
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
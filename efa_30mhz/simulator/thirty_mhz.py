@@ -0,0 +1,327 @@
+"""
+A fake 30MHz API for load and regression tests. It keeps sensor types, import checks, shares, data uploads and
+ingested events in memory and serves them with configurable latency, errors and 429 throttling.
+
+    python -m efa_30mhz.simulator.thirty_mhz --port 8030 --latency 0.05 --rate-limit 20
+
+and point the target at it with `api_url: http://127.0.0.1:8030/api`.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+
+import click
+
+STATS_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Takes a token.
+        :return: 0 when a token was available, otherwise the seconds until there is one
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let them wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    server: "SimulatorServer"
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.simulator.handle(self, method, body)
+
+    def respond(self, status: int, data=None, headers: Dict[str, str] = None):
+        body = json.dumps(data if data is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    simulator: "ThirtyMHzSimulator"
+
+
+class ThirtyMHzSimulator:
+    """
+    In memory 30MHz API, served on a background thread.
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            error_rate: float = 0.0,
+            rate_limit: float = None,
+            burst: float = None,
+            organizations: Optional[Set[str]] = None,
+            seed: int = None,
+    ):
+        """
+        :param latency: seconds every request takes at least
+        :param jitter: up to this many seconds are added to the latency at random
+        :param error_rate: fraction of the requests that fail with a 500
+        :param rate_limit: requests per second per api key, beyond that requests get a 429 with Retry-After
+        :param burst: requests per api key that may come in at once, by default rate_limit
+        :param organizations: organizations that exist, by default every organization exists
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else rate_limit
+        self.organizations = organizations
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
+        # organization -> listed items
+        self.sensor_types: Dict[str, List[Dict]] = {}
+        self.import_checks: Dict[str, List[Dict]] = {}
+        # checkId -> ingested events
+        self.events: Dict[str, List[Dict]] = {}
+        self.uploads = 0
+        # (method, route) -> number of requests, and status -> number of responses
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.routes = [
+            ("GET", r"/api/organization/(?P<organization>[^/]+)", self.get_organization),
+            ("GET", r"/api/sensor-type/organization/(?P<organization>[^/]+)", self.list_sensor_types),
+            ("POST", r"/api/sensor-type/organization/(?P<organization>[^/]+)", self.create_sensor_type),
+            ("GET", r"/api/import-check/organization/(?P<organization>[^/]+)", self.list_import_checks),
+            ("POST", r"/api/import-check/organization/(?P<organization>[^/]+)", self.create_import_check),
+            (
+                "POST",
+                r"/api/share-sensor-type/sensor-type/(?P<type_id>[^/]+)/organization/(?P<organization>[^/]+)",
+                self.share_sensor_type,
+            ),
+            ("POST", r"/api/data-upload/organization/(?P<organization>[^/]+)", self.data_upload),
+            ("POST", r"/api/ingest/organization/(?P<organization>[^/]+)", self.ingest),
+            (
+                "GET",
+                r"/api/stats/check/(?P<check_id>[^/]+)/from/(?P<from_date>[^/]+)/until/(?P<until>[^/?]+)",
+                self.stats,
+            ),
+        ]
+        self.server = SimulatorServer((host, port), SimulatorHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self) -> "ThirtyMHzSimulator":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def request_count(self) -> int:
+        with self.lock:
+            return sum(self.requests.values())
+
+    def handle(self, handler: SimulatorHandler, method: str, body: bytes):
+        path = handler.path.split("?", 1)[0]
+        for route_method, pattern, route in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            self.count(method, None, 404)
+            handler.respond(404, {"error": f"No route for {method} {path}"})
+            return
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        retry_after = self.throttle(handler.headers.get("Authorization", ""))
+        if retry_after:
+            self.count(method, pattern, 429)
+            handler.respond(429, {"error": "Too many requests"}, {"Retry-After": str(retry_after)})
+            return
+        with self.lock:
+            failed = self.error_rate and self.random.random() < self.error_rate
+        if failed:
+            self.count(method, pattern, 500)
+            handler.respond(500, {"error": "Simulated error"})
+            return
+        try:
+            status, data = route(body=body, **match.groupdict())
+        except (ValueError, KeyError, TypeError) as e:
+            status, data = 400, {"error": f"Bad request: {e}"}
+        self.count(method, pattern, status)
+        handler.respond(status, data)
+
+    def count(self, method, pattern, status):
+        with self.lock:
+            self.requests[(method, pattern)] += 1
+            self.statuses[status] += 1
+
+    def throttle(self, api_key) -> int:
+        """
+        :return: 0, or the whole seconds to wait before retrying when api_key is over its rate limit
+        """
+        if self.rate_limit is None:
+            return 0
+        with self.lock:
+            if api_key not in self.buckets:
+                self.buckets[api_key] = TokenBucket(self.rate_limit, self.burst)
+            wait = self.buckets[api_key].take()
+        return int(wait) + 1 if wait else 0
+
+    def exists(self, organization) -> bool:
+        return self.organizations is None or organization in self.organizations
+
+    def get_organization(self, organization, body):
+        if not self.exists(organization):
+            return 404, {"error": f"Organization {organization} not found"}
+        return 200, {"organizationId": organization, "name": organization}
+
+    def list_sensor_types(self, organization, body):
+        with self.lock:
+            return 200, list(self.sensor_types.get(organization, []))
+
+    def create_sensor_type(self, organization, body):
+        sensor_type = dict(json.loads(body), typeId=str(uuid.uuid4()))
+        with self.lock:
+            self.sensor_types.setdefault(organization, []).append(sensor_type)
+        return 200, sensor_type
+
+    def share_sensor_type(self, type_id, organization, body):
+        with self.lock:
+            sensor_type = next(
+                (s for types in self.sensor_types.values() for s in types if s["typeId"] == type_id),
+                None,
+            )
+            if sensor_type is None:
+                return 404, {"error": f"Sensor type {type_id} not found"}
+            shared = self.sensor_types.setdefault(organization, [])
+            if sensor_type not in shared:
+                shared.append(sensor_type)
+        return 200, {}
+
+    def list_import_checks(self, organization, body):
+        with self.lock:
+            return 200, list(self.import_checks.get(organization, []))
+
+    def create_import_check(self, organization, body):
+        import_check = dict(json.loads(body), checkId=str(uuid.uuid4()))
+        with self.lock:
+            self.import_checks.setdefault(organization, []).append(import_check)
+            self.events[import_check["checkId"]] = []
+        return 200, import_check
+
+    def data_upload(self, organization, body):
+        with self.lock:
+            self.uploads += 1
+        return 200, {"dataUploadId": str(uuid.uuid4())}
+
+    def ingest(self, organization, body):
+        events = json.loads(body)
+        ok = 0
+        with self.lock:
+            checks = {i["checkId"] for i in self.import_checks.get(organization, [])}
+            for event in events:
+                if event.get("checkId") in checks:
+                    self.events[event["checkId"]].append(event)
+                    ok += 1
+        return 200, {"okEventsNo": ok, "failedEventsNo": len(events) - ok}
+
+    def stats(self, check_id, from_date, until, body):
+        start = datetime.strptime(from_date, STATS_DATE_FORMAT).replace(tzinfo=timezone.utc)
+        end = datetime.strptime(until, STATS_DATE_FORMAT).replace(tzinfo=timezone.utc)
+        with self.lock:
+            import_check = next(
+                (i for checks in self.import_checks.values() for i in checks if i["checkId"] == check_id),
+                None,
+            )
+            if import_check is None:
+                return 404, {"error": f"Import check {check_id} not found"}
+            events = list(self.events[check_id])
+        stats = {}
+        for event in events:
+            timestamp = datetime.fromisoformat(event["timestamp"])
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
+            if start <= timestamp < end:
+                stats[str(int(timestamp.timestamp() * 1000))] = {
+                    f"{import_check['sensorType']}.{k}": v for k, v in event["data"].items()
+                }
+        return 200, stats
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8030)
+@click.option("--latency", type=float, default=0.0, help="Seconds every request takes")
+@click.option("--jitter", type=float, default=0.0, help="Random extra seconds per request")
+@click.option("--error-rate", type=float, default=0.0, help="Fraction of requests that get a 500")
+@click.option("--rate-limit", type=float, default=None, help="Requests per second per api key")
+@click.option("--burst", type=float, default=None, help="Requests per api key at once")
+def main(host, port, latency, jitter, error_rate, rate_limit, burst):
+    simulator = ThirtyMHzSimulator(
+        host=host,
+        port=port,
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        rate_limit=rate_limit,
+        burst=burst,
+    )
+    print(f"Serving a fake 30MHz API on {simulator.url}")
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Iterable, Dict, Optional, Set
+
+from loguru import logger
+
+
+class DoneStore:
+    """
+    Persistent set of the order sample data ids that were synced to 30MHz, kept in an indexed SQLite table.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS done (id INTEGER PRIMARY KEY)")
+
+    def __contains__(self, order_sample_data_id) -> bool:
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM done WHERE id = ?", (int(order_sample_data_id),)
+            ).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM done").fetchone()[0]
+
+    def add_many(self, ids: Iterable):
+        """
+        Adds ids in a single transaction, so either all or none of them are stored.
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO done (id) VALUES (?)", ((int(i),) for i in ids)
+            )
+
+    def import_file(self, filename: str):
+        """
+        Adds the ids of a legacy already done file, one id per line.
+        """
+        if not os.path.exists(filename):
+            return
+        with open(filename, "r") as f:
+            ids = [line for line in map(str.strip, f) if line]
+        logger.info(f"Importing {len(ids)} already done ids from {filename}")
+        self.add_many(ids)
+
+    def compact(self):
+        with self.lock:
+            self.db.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def to_datetime(value) -> Optional[datetime]:
+    """
+    Timestamps come as datetimes from SQL Server and as ISO 8601 strings from JSON.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
+class HighWaterMarks:
+    """
+    Per relation, the updatedAt up to which all samples are synced. Rows updated at or before the mark don't have
+    to be read again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS marks (relation_id TEXT PRIMARY KEY, mark TEXT)"
+            )
+
+    def get_all(self) -> Dict[str, datetime]:
+        with self.lock:
+            rows = self.db.execute("SELECT relation_id, mark FROM marks").fetchall()
+        return {relation_id: to_datetime(mark) for relation_id, mark in rows}
+
+    def advance(self, marks: Dict):
+        """
+        Moves the marks of relations forward, in a single transaction. Marks never move back.
+        """
+        current = self.get_all()
+        updates = []
+        for relation_id, mark in marks.items():
+            mark = to_datetime(mark)
+            previous = current.get(str(relation_id))
+            if mark is not None and (previous is None or mark > previous):
+                updates.append((str(relation_id), mark.isoformat()))
+        logger.debug(f"Advancing {len(updates)} high water marks")
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO marks (relation_id, mark) VALUES (?, ?)", updates
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class RemoteOrderIds:
+    """
+    Per scope, like an organization, the order sample data ids found in 30MHz and the moment up to which 30MHz was
+    searched for them. The ids of the default organization have no scope.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS remote_ids (scope TEXT NOT NULL, id INTEGER NOT NULL, "
+                "PRIMARY KEY (scope, id)) WITHOUT ROWID"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS remote_state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'remote'").fetchone():
+                # Stores without scopes only held the ids of the default organization
+                self.db.execute("INSERT OR IGNORE INTO remote_ids (scope, id) SELECT '', id FROM remote")
+                self.db.execute("DROP TABLE remote")
+
+    @staticmethod
+    def scope_key(scope: str = None) -> str:
+        return "" if scope is None else scope
+
+    def get_all(self, scope: str = None) -> Set[int]:
+        with self.lock:
+            return {
+                row[0] for row in self.db.execute("SELECT id FROM remote_ids WHERE scope = ?", (self.scope_key(scope),))
+            }
+
+    @staticmethod
+    def synced_until_key(scope: str = None) -> str:
+        return "synced_until" if scope is None else f"synced_until:{scope}"
+
+    def get_synced_until(self, scope: str = None) -> Optional[datetime]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM remote_state WHERE key = ?", (self.synced_until_key(scope),)
+            ).fetchone()
+        return to_datetime(row[0]) if row else None
+
+    def add_many(self, ids: Iterable, synced_until: datetime = None, scope: str = None):
+        """
+        Adds ids to scope and, when given, moves synced_until of scope, in a single transaction.
+        """
+        key = self.scope_key(scope)
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO remote_ids (scope, id) VALUES (?, ?)", ((key, int(i)) for i in ids)
+            )
+            if synced_until is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO remote_state (key, value) VALUES (?, ?)",
+                    (self.synced_until_key(scope), synced_until.isoformat()),
+                )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
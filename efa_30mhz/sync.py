@@ -1,8 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Type, List, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Type, List, Callable, Iterator, Iterable, Tuple, Any
 
 from loguru import logger
 
+from efa_30mhz.tracing import span
+
 
 class Source(ABC):
     @abstractmethod
@@ -18,6 +21,19 @@ class Source(ABC):
     def read_all(self, *args, **kwargs) -> List:
         return []
 
+    def iter_rows(self, *args, **kwargs) -> Iterator:
+        """
+        Streams the rows of read_all. Sources that can produce rows lazily override this.
+        """
+        return iter(self.read_all(*args, **kwargs))
+
+    def iter_partitions(self) -> Iterator[Tuple[Any, Callable[[], Iterable]]]:
+        """
+        Splits the rows into independent units of work, as (key, function streaming the rows of the unit).
+        Sources with a natural partitioning, like one customer, override this.
+        """
+        yield None, self.iter_rows
+
 
 class Target(ABC):
     @abstractmethod
@@ -28,19 +44,113 @@ class Target(ABC):
     def write(self, rows):
         pass
 
+    def start_stream(self):
+        pass
+
+    def write_chunk(self, rows):
+        """
+        Writes one chunk of to_thirty_mhz output of a stream. Targets that keep state per stream override
+        start_stream, write_chunk and finish_stream.
+        """
+        self.write(rows)
+
+    def finish_stream(self):
+        pass
+
+    def write_stream(self, chunks: Iterable[Tuple]):
+        """
+        Writes chunks of to_thirty_mhz output one after the other.
+        """
+        self.start_stream()
+        try:
+            for rows in chunks:
+                with span("sync.write"):
+                    self.write_chunk(rows)
+        finally:
+            self.finish_stream()
+
+
+def chunked(rows: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 class Sync:
     """
     A Sync object represents a continuous synchronization between a source and a target.
     """
 
-    def __init__(self, source: Source, target: Target) -> None:
+    def __init__(
+            self, source: Source, target: Target, chunk_size: int = None, workers: int = None
+    ) -> None:
+        """
+        :param chunk_size: when set, rows are streamed from the source and converted and written chunk_size rows
+            at a time, instead of all rows at once
+        :param workers: when set, every partition of the source is read, converted and written as its own unit,
+            on a pool of this many threads. A partition that fails is logged and doesn't stop the others.
+        """
         self.source = source
         self.target = target
+        self.chunk_size = chunk_size
+        self.workers = workers
+        # Keys of the partitions that raised
+        self.failed_partitions = []
 
     def start(self):
-        rows = self.source.read_all()
-        logger.info("Converting data to 30MHz format")
-        thirty_mhz_rows = self.source.to_thirty_mhz(rows)
-        logger.info(f"Writing data")
-        self.target.write(thirty_mhz_rows)
+        with span("sync"):
+            if self.workers is not None:
+                self.start_partitioned()
+                return
+            if self.chunk_size is not None:
+                logger.info(f"Streaming data in chunks of {self.chunk_size} rows")
+                self.target.write_stream(self.iter_chunks())
+                return
+            with span("sync.read"):
+                rows = self.source.read_all()
+            logger.info("Converting data to 30MHz format")
+            with span("sync.convert"):
+                thirty_mhz_rows = self.source.to_thirty_mhz(rows)
+            logger.info(f"Writing data")
+            with span("sync.write"):
+                self.target.write(thirty_mhz_rows)
+
+    def iter_chunks(self, rows: Iterable = None) -> Iterator[Tuple]:
+        if rows is None:
+            rows = self.source.iter_rows()
+        chunks = chunked(rows, self.chunk_size) if self.chunk_size is not None else [list(rows)]
+        for i, rows in enumerate(chunks):
+            if not rows:
+                continue
+            logger.info(f"Converting chunk {i} of {len(rows)} rows to 30MHz format")
+            with span("sync.convert"):
+                converted = self.source.to_thirty_mhz(rows)
+            yield converted
+
+    def start_partitioned(self):
+        logger.info(f"Syncing partitions with {self.workers} workers")
+        self.target.start_stream()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {
+                    executor.submit(self.sync_partition, rows): key
+                    for key, rows in self.source.iter_partitions()
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.exception(f"Partition {futures[future]} failed: {e}")
+                        self.failed_partitions.append(futures[future])
+        finally:
+            self.target.finish_stream()
+
+    def sync_partition(self, rows: Callable[[], Iterable]):
+        for chunk in self.iter_chunks(rows()):
+            with span("sync.write"):
+                self.target.write_chunk(chunk)
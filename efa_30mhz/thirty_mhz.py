@@ -1,22 +1,50 @@
+import asyncio
 import json
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from io import IOBase
 from pprint import pformat
-from typing import IO, Dict, Any
+from typing import IO, Dict, Any, List, Tuple, Iterable, Optional, Set, Iterator
 
 from loguru import logger
 from abc import ABC, abstractmethod
 from pandas import DataFrame, concat
-import requests
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
+from requests import RequestException
 
+from efa_30mhz.errors import FileUnavailableError
+from efa_30mhz.files import LazyFile, lazy_files, prefetch
 from efa_30mhz.metrics import Metric
-from efa_30mhz.sync import Target
+from efa_30mhz.session import SessionPool, ThirtyMHzSession, THROTTLED
+from efa_30mhz.shards import file_lock
+from efa_30mhz.store import DoneStore, RemoteOrderIds, to_datetime
+from efa_30mhz.sync import Target, chunked
+from efa_30mhz.tracing import span, traced
 import efa_30mhz.constants as cst
 
+DEFAULT_CACHE_TTL = 15 * 60
+DEFAULT_INGEST_MAX_EVENTS = 500
+DEFAULT_INGEST_MAX_BYTES = 1024 * 1024
+DEFAULT_WORKERS = 8
+DEFAULT_PER_ORGANIZATION = 2
+DEFAULT_ASYNC_PER_ORGANIZATION = 50
+DEFAULT_DEDUPE_WINDOW_DAYS = 7
+DEFAULT_DEDUPE_OVERLAP_HOURS = 24
+STATS_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DEFAULT_API_URL = "https://api.30mhz.com/api"
+DEFAULT_EXPORT_WINDOW_DAYS = 30
+DEFAULT_PREFETCH_WINDOW = 100
+# Windows of ingests of which the files are held at once on the event loop, see ThirtyMHzTarget.ingest_async
+ASYNC_WINDOWS_IN_FLIGHT = 2
+
 
 class ThirtyMHzEndpoint(ABC):
     base_url = ""
+    # Field of a listed item that check() matches on. Endpoints that set it get an indexed listing cache.
+    key_field = None
     stats_success = None
     stats_failures = None
     stats_time = None
@@ -24,6 +52,9 @@ class ThirtyMHzEndpoint(ABC):
     def __init__(self, tmz: "ThirtyMHz"):
         self.tmz = tmz
         self.statsd_client = Metric.client()
+        self.index = None
+        self.index_loaded_at = None
+        self.index_lock = threading.Lock()
 
     def list(self):
         return self.tmz.get(self.base_url)
@@ -32,18 +63,61 @@ class ThirtyMHzEndpoint(ABC):
     def check(self, item, **kwargs):
         raise NotImplementedError
 
+    def index_key(self, **kwargs) -> str:
+        return str(kwargs["id"])
+
+    def get_index(self) -> Dict[str, Any]:
+        """
+        Returns the listing of this endpoint keyed by `key_field`. The listing is fetched once and kept until
+        it is older than the cache TTL of the ThirtyMHz object or until invalidate() is called.
+        """
+        with self.index_lock:
+            if (
+                    self.index is None
+                    or time.monotonic() - self.index_loaded_at > self.tmz.cache_ttl
+            ):
+                index = {}
+                for i in self.list():
+                    index.setdefault(str(i[self.key_field]), i)
+                self.index = index
+                self.index_loaded_at = time.monotonic()
+            return self.index
+
+    def invalidate(self):
+        with self.index_lock:
+            self.index = None
+            self.index_loaded_at = None
+
+    def remember(self, item):
+        with self.index_lock:
+            if self.index is None:
+                return
+            if not isinstance(item, dict) or self.key_field not in item:
+                self.index = None
+                return
+            self.index.setdefault(str(item[self.key_field]), item)
+
     def exists(self, **kwargs):
+        if self.key_field is not None:
+            return self.index_key(**kwargs) in self.get_index()
         l = self.list()
         for i in l:
             if self.check(i, **kwargs):
                 return True
         return False
 
-    def create(self, files=None, organization=True, **kwargs):
+    @traced(
+        "30mhz.create",
+        tags=lambda self, *args, **kwargs: {"endpoint": type(self).__name__, "organization": self.tmz.organization},
+    )
+    def create(self, files=None, organization=True, base_url=None, **kwargs):
+        """
+        :param base_url: url to post to instead of the base_url of the endpoint
+        """
         try:
             t0 = time.time()
             result = self.tmz.post(
-                self.base_url,
+                base_url or self.base_url,
                 self.get_data(**kwargs),
                 files=files,
                 organization=organization,
@@ -51,6 +125,8 @@ class ThirtyMHzEndpoint(ABC):
             t1 = time.time()
             self.statsd_client.incr(self.stats_success)
             self.statsd_client.timing(self.stats_time, t1 - t0)
+            if self.key_field is not None:
+                self.remember(result)
             return result
         except ThirtyMHzError as e:
             logger.debug(e.message)
@@ -61,6 +137,8 @@ class ThirtyMHzEndpoint(ABC):
         raise NotImplementedError
 
     def get(self, **kwargs):
+        if self.key_field is not None:
+            return self.get_index().get(self.index_key(**kwargs))
         l = self.list()
         for i in l:
             if self.check(i, **kwargs):
@@ -69,11 +147,25 @@ class ThirtyMHzEndpoint(ABC):
 
 
 class ThirtyMHzError(Exception):
-    def __init__(self, message):
+    def __init__(self, message, status_code=None):
+        """
+        :param status_code: status of the response 30MHz answered with, None when there was no response
+        """
         self.message = message
+        self.status_code = status_code
         super(ThirtyMHzError, self).__init__(message)
 
 
+class IngestError(ThirtyMHzError):
+    """
+    An ingest request of which 30MHz reported failed events; it stored the ok_events other events of the request.
+    """
+
+    def __init__(self, message, ok_events=0):
+        super(IngestError, self).__init__(message)
+        self.ok_events = ok_events
+
+
 def infer_type(col):
     if isinstance(col, float) or isinstance(col, int):
         return "double"
@@ -83,6 +175,7 @@ def infer_type(col):
 
 class SensorType(ThirtyMHzEndpoint):
     base_url = "sensor-type"
+    key_field = "radioId"
     stats_success = cst.STATS_30MHZ_SENSOR_TYPES_SUCCESS
     stats_failures = cst.STATS_30MHZ_SENSOR_TYPES_FAILURES
     stats_time = cst.STATS_30MHZ_SENSOR_TYPES_TIME
@@ -131,6 +224,7 @@ class SensorType(ThirtyMHzEndpoint):
 
 class ImportCheck(ThirtyMHzEndpoint):
     base_url = "import-check"
+    key_field = "sourceId"
     stats_success = cst.STATS_30MHZ_IMPORT_CHECKS_SUCCESS
     stats_failures = cst.STATS_30MHZ_IMPORT_CHECKS_FAILURES
     stats_time = cst.STATS_30MHZ_IMPORT_CHECKS_TIME
@@ -151,43 +245,167 @@ class ImportCheck(ThirtyMHzEndpoint):
         }
         return d
 
-    def ingest(self, import_check, rows):
-        t0 = time.time()
+    def events(self, import_check, rows) -> List[Dict]:
         data = []
         for r in rows:
             timestamp = r.pop("datetime").replace(microsecond=0).isoformat()
             converted_r = self.convert_row(r)
-            data.append(
-                {
-                    "checkId": import_check["checkId"],
-                    "data": converted_r,
-                    "timestamp": timestamp,
-                    "status": "ok",
-                }
-            )
+            data.append(self.event(import_check, timestamp, converted_r))
+        return data
+
+    @staticmethod
+    def event(import_check, timestamp: str, data: Dict) -> Dict:
+        return {
+            "checkId": import_check["checkId"],
+            "data": data,
+            "timestamp": timestamp,
+            "status": "ok",
+        }
 
-        r = self.tmz.post("ingest", data)
+    def ingest(self, import_check, rows):
+        self.post_events(self.events(import_check, rows))
+
+    def post_events(self, data):
+        t0 = time.time()
+        # Both ingest and ingest_batch post their events here
+        with span("30mhz.ingest", organization=self.tmz.organization):
+            r = self.tmz.post("ingest", data)
         t1 = time.time()
         if r["failedEventsNo"] > 0:
             self.statsd_client.incr(
                 cst.STATS_30MHZ_INGESTS_FAILURES, r["failedEventsNo"]
             )
-            raise ThirtyMHzError(f"Failed ingest events: {r}")
+            if r["okEventsNo"] > 0:
+                self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_SUCCESS, r["okEventsNo"])
+            raise IngestError(f"Failed ingest events: {r}", r["okEventsNo"])
         self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_SUCCESS, r["okEventsNo"])
         self.statsd_client.timing(cst.STATS_30MHZ_INGESTS_TIME, t1 - t0)
 
+    def ingest_batch(
+            self,
+            items: List[Tuple[Any, Dict, List[Dict]]],
+            max_events: int = DEFAULT_INGEST_MAX_EVENTS,
+            max_bytes: int = DEFAULT_INGEST_MAX_BYTES,
+    ) -> List:
+        """
+        Ingests the rows of many import checks in as few requests as possible.
+        The events of one order are never split over two requests. When 30MHz stored none of a request, the
+        orders in it are ingested one by one again, so failures can be attributed to a single order. When 30MHz
+        may have stored part of it, sending it again could store events twice, so none of its orders are done and
+        they are left to a later run, see resend_chunk.
+        :param items: (order_id, import_check, rows) tuples
+        :param max_events: maximum number of events per request
+        :param max_bytes: maximum (JSON encoded) body size per request
+        :return: order ids of which all events were accepted, in the order of items
+        """
+        groups = []
+        for order_id, import_check, rows in items:
+            try:
+                events = self.events(import_check, rows)
+            except ThirtyMHzError as e:
+                logger.error(e.message)
+                continue
+            groups.append((order_id, events, events_size(events)))
+
+        done = []
+        for chunk in pack_chunks(groups, max_events, max_bytes):
+            done.extend(self.post_chunk(chunk))
+        return done
+
+    def post_chunk(self, chunk) -> List:
+        try:
+            self.post_events([event for _, events, _ in chunk for event in events])
+            return [order_id for order_id, _, _ in chunk]
+        except ThirtyMHzError as e:
+            logger.error(e.message)
+            if len(chunk) == 1 or not resend_chunk(e):
+                return []
+        logger.debug(f"Retrying {len(chunk)} orders of a failed batch one by one")
+        done = []
+        for order_id, events, _ in chunk:
+            try:
+                self.post_events(events)
+                done.append(order_id)
+            except ThirtyMHzError as e:
+                logger.error(f"Ingest of order {order_id} failed: {e.message}")
+        return done
+
     def convert_row(self, r: Dict[str, Any]) -> Dict[str, Any]:
         d = {}
         for k in r.keys():
-            if isinstance(r[k], IOBase):
+            if isinstance(r[k], LazyFile):
+                d[k] = r[k].get_data_upload_id(self.tmz.organization)
+                if d[k] is not None:
+                    logger.debug(f"Reusing data upload {d[k]}")
+                    continue
+                logger.debug("Creating a data_upload")
+                try:
+                    file = r[k].open()
+                except FileUnavailableError as e:
+                    raise ThirtyMHzError(e.message)
+                d[k] = self.upload(file)
+                r[k].set_data_upload_id(self.tmz.organization, d[k])
+            elif isinstance(r[k], IOBase):
                 logger.debug("Creating a data_upload")
-                data_upload = self.tmz.data_upload.create(file=r[k])
-                logger.debug(f"Data upload created: {data_upload}")
-                d[k] = data_upload["dataUploadId"]
+                d[k] = self.upload(r[k])
             else:
                 d[k] = r[k]
         return d
 
+    def upload(self, file) -> str:
+        data_upload = self.tmz.data_upload.create(file=file)
+        logger.debug(f"Data upload created: {data_upload}")
+        if data_upload is None:
+            raise ThirtyMHzError("Data upload failed")
+        return data_upload["dataUploadId"]
+
+def resend_chunk(e: ThirtyMHzError) -> bool:
+    """
+    Whether the orders of a failed ingest request may be sent again one by one, only when the failure shows 30MHz
+    stored none of it: an ingest that reported no stored events, or a 4xx that rejected the request. After a 5xx or
+    a request without response the events may have been stored.
+    """
+    if isinstance(e, IngestError):
+        if e.ok_events > 0:
+            logger.warning(f"{e.ok_events} events of a failed ingest were stored, not sending its orders again")
+            return False
+        return True
+    if e.status_code is not None and 400 <= e.status_code < 500 and e.status_code != THROTTLED:
+        return True
+    logger.warning("A failed ingest may have been stored, not sending its orders again")
+    return False
+
+
+def events_size(events: List[Dict]) -> int:
+    """
+    :return: the size the events add to a JSON encoded ingest request
+    """
+    return sum(len(json.dumps(event)) + 2 for event in events)
+
+
+def pack_chunks(groups: Iterable[Tuple[Any, List[Dict], int]], max_events: int, max_bytes: int) -> Iterator[List]:
+    """
+    Packs (order_id, events, size) groups into chunks of at most max_events events and max_bytes bytes, a group
+    is never split over two chunks.
+    """
+    chunk = []
+    chunk_events = 0
+    chunk_bytes = 2
+    for group in groups:
+        _, events, size = group
+        if chunk and (
+                chunk_events + len(events) > max_events
+                or chunk_bytes + size > max_bytes
+        ):
+            yield chunk
+            chunk, chunk_events, chunk_bytes = [], 0, 2
+        chunk.append(group)
+        chunk_events += len(events)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
 class DataUpload(ThirtyMHzEndpoint):
     stats_success = cst.STATS_30MHZ_UPLOADS_SUCCESS
     stats_failures = cst.STATS_30MHZ_UPLOADS_FAILURES
@@ -254,21 +472,41 @@ class ShareSensorType(ThirtyMHzEndpoint):
     def create(self, id, organization_id):
         sensor_type = self.tmz.sensor_type.get(id=id)
         # logger.debug(f"Got sensor type: {pformat(sensor_type)}")
-        prev_base_url = self.base_url
-        self.base_url = self.base_url.format(
+        # Formatted per call, tenants share this endpoint of the default organization from several threads
+        base_url = self.base_url.format(
             sensor_type_id=sensor_type["typeId"], organization_id=organization_id
         )
-        logger.debug(self.base_url)
-        super(ShareSensorType, self).create(organization=False)
-        self.base_url = prev_base_url
+        logger.debug(base_url)
+        super(ShareSensorType, self).create(organization=False, base_url=base_url)
 
 class ThirtyMHz:
-    api_url = "https://api.30mhz.com/api/{base_url}/organization/{organization}"
-    api_url_no_organization = "https://api.30mhz.com/api/{base_url}"
-
-    def __init__(self, api_key, organization):
+    api_url = DEFAULT_API_URL + "/{base_url}/organization/{organization}"
+    api_url_no_organization = DEFAULT_API_URL + "/{base_url}"
+    sensor_type_class = SensorType
+    share_sensor_type_class = ShareSensorType
+    import_check_class = ImportCheck
+    data_upload_class = DataUpload
+    stats_class = Stats
+
+    def __init__(
+            self,
+            api_key,
+            organization,
+            session: ThirtyMHzSession = None,
+            cache_ttl: float = DEFAULT_CACHE_TTL,
+            api_url: str = None,
+    ):
+        """
+        :param api_url: root of the API, like the default https://api.30mhz.com/api
+        """
+        if api_url is not None:
+            self.api_url = api_url.rstrip("/") + "/{base_url}/organization/{organization}"
+            self.api_url_no_organization = api_url.rstrip("/") + "/{base_url}"
         self.api_key = api_key
         self.organization = organization
+        self.session = session or ThirtyMHzSession()
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
         self.sensor_type_obj = None
         self.share_sensor_type_obj = None
         self.import_check_obj = None
@@ -277,34 +515,44 @@ class ThirtyMHz:
 
     @property
     def sensor_type(self) -> SensorType:
-        if not self.sensor_type_obj:
-            self.sensor_type_obj = SensorType(self)
+        with self.lock:
+            if not self.sensor_type_obj:
+                self.sensor_type_obj = self.sensor_type_class(self)
         return self.sensor_type_obj
 
     @property
     def share_sensor_type(self) -> SensorType:
-        if not self.share_sensor_type_obj:
-            self.share_sensor_type_obj = ShareSensorType(self)
+        with self.lock:
+            if not self.share_sensor_type_obj:
+                self.share_sensor_type_obj = self.share_sensor_type_class(self)
         return self.share_sensor_type_obj
 
     @property
     def import_check(self) -> ImportCheck:
-        if not self.import_check_obj:
-            self.import_check_obj = ImportCheck(self)
+        with self.lock:
+            if not self.import_check_obj:
+                self.import_check_obj = self.import_check_class(self)
         return self.import_check_obj
 
     @property
     def data_upload(self) -> DataUpload:
-        if not self.data_upload_obj:
-            self.data_upload_obj = DataUpload(self)
+        with self.lock:
+            if not self.data_upload_obj:
+                self.data_upload_obj = self.data_upload_class(self)
         return self.data_upload_obj
 
     @property
     def stats(self) -> Stats:
-        if not self.stats_obj:
-            self.stats_obj = Stats(self)
+        with self.lock:
+            if not self.stats_obj:
+                self.stats_obj = self.stats_class(self)
         return self.stats_obj
 
+    def invalidate_cache(self):
+        for endpoint in (self.sensor_type_obj, self.import_check_obj):
+            if endpoint is not None:
+                endpoint.invalidate()
+
     def create_url(self, base_url, organization=True):
         if organization:
             return self.api_url.format(
@@ -324,12 +572,15 @@ class ThirtyMHz:
     def get(self, base_url, organization=True):
         url = self.create_url(base_url, organization=organization)
         headers = self.headers
-        r = requests.get(url, headers=headers)
+        try:
+            r = self.session.get(url, headers=headers)
+        except RequestException as e:
+            raise ThirtyMHzError(f"Request to {url} failed: {e!r}")
         if 200 <= r.status_code < 300:
             return r.json()
         else:
             logger.error(r.request.headers)
-            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.json()}")
+            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {response_body(r)}", r.status_code)
 
     def post(self, base_url, data=None, files=None, organization=True):
         url = self.create_url(base_url, organization=organization)
@@ -338,7 +589,11 @@ class ThirtyMHz:
             data = json.dumps(data)
         else:
             del headers["Content-type"]
-        r = requests.post(url, data=data, headers=headers, files=files)
+        try:
+            r = self.session.post(url, data=data, headers=headers, files=files)
+        except RequestException as e:
+            # A timeout or a connection error once the retries of the session ran out
+            raise ThirtyMHzError(f"Request to {url} failed: {e!r}")
         if 200 <= r.status_code < 300:
             logger.debug(r.json())
             return r.json()
@@ -348,13 +603,35 @@ class ThirtyMHz:
             logger.debug(files)
             logger.debug(url)
             logger.debug(data)
-            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.json()}")
-        
+            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {response_body(r)}", r.status_code)
+
+
+def response_body(r):
+    """
+    The decoded JSON body of a response, or its text when a gateway answered with something else.
+    """
+    try:
+        return r.json()
+    except ValueError:
+        return r.text
+
+
 class ThirtyMHzGetter:
-    def __init__(self, default_api_key, default_organization):
+    def __init__(
+            self,
+            default_api_key,
+            default_organization,
+            http: Dict = None,
+            cache_ttl: float = DEFAULT_CACHE_TTL,
+            api_url: str = None,
+    ):
         self.tmzs = {}
         self.default_api_key = default_api_key
         self.default_organization = default_organization
+        self.sessions = SessionPool(**(http or {}))
+        self.cache_ttl = cache_ttl
+        self.api_url = api_url
+        self.lock = threading.Lock()
 
     def get(self, row):
         api_key = row.get("api_key", self.default_api_key)
@@ -364,232 +641,815 @@ class ThirtyMHzGetter:
     def get_default(self):
         return self.get_by_api_key(self.default_api_key, self.default_organization)
 
+    def invalidate_cache(self):
+        for tmz in self.tmzs.values():
+            tmz.invalidate_cache()
+
     def get_by_api_key(self, api_key, organization):
-        if (api_key, organization) in self.tmzs:
+        with self.lock:
+            if (api_key, organization) not in self.tmzs:
+                self.tmzs[(api_key, organization)] = ThirtyMHz(
+                    api_key,
+                    organization,
+                    session=self.sessions.get(api_key, organization),
+                    cache_ttl=self.cache_ttl,
+                    api_url=self.api_url,
+                )
             return self.tmzs[(api_key, organization)]
-        self.tmzs[(api_key, organization)] = ThirtyMHz(api_key, organization)
-        return self.tmzs[(api_key, organization)]
+
+# Status of an organization that doesn't exist. A 403 only tells that the api key can't see it.
+MISSING_ORGANIZATION_STATUS = 404
+
+
+class OrganizationCache:
+    """
+    Metadata of 30MHz organizations, fetched once per organization with the api key of tmz. Organizations that
+    don't exist have None as metadata. Other failures, like a 403 for an organization the api key can't see, are not
+    cached, the next lookup asks again.
+    """
+
+    def __init__(self, tmz: ThirtyMHz, workers: int = DEFAULT_WORKERS):
+        self.tmz = tmz
+        self.workers = workers
+        self.metadata: Dict[str, Optional[Dict]] = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, organization) -> Optional[Dict]:
+        """
+        :raises ThirtyMHzError: when 30MHz could not tell whether the organization exists
+        """
+        url = self.tmz.create_url(f"organization/{organization}", organization=False)
+        try:
+            r = self.tmz.session.get(url, headers=self.tmz.headers)
+        except RequestException as e:
+            raise ThirtyMHzError(f"Request to {url} failed: {e!r}")
+        if r.status_code == MISSING_ORGANIZATION_STATUS:
+            logger.debug(f"Organization {organization} not found: {r.status_code}")
+            return None
+        if not 200 <= r.status_code < 300:
+            raise ThirtyMHzError(
+                f"Can't get organization {organization}, faulty status code {r.status_code}: {response_body(r)}",
+                r.status_code,
+            )
+        try:
+            return r.json()
+        except ValueError:
+            return {}
+
+    def get(self, organization) -> Optional[Dict]:
+        with self.lock:
+            if organization in self.metadata:
+                return self.metadata[organization]
+        metadata = self.fetch(organization)
+        with self.lock:
+            return self.metadata.setdefault(organization, metadata)
+
+    def exists(self, organization) -> bool:
+        return self.get(organization) is not None
+
+    def prefetch(self, organizations: Iterable):
+        """
+        Fetches the organizations that were not fetched yet, concurrently. Organizations that fail are logged and
+        left to the next lookup.
+        """
+        with self.lock:
+            todo = [o for o in dict.fromkeys(organizations) if o not in self.metadata]
+        if not todo:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(todo))) as executor:
+            futures = [executor.submit(self.fetch, organization) for organization in todo]
+            for organization, future in zip(todo, futures):
+                try:
+                    metadata = future.result()
+                except ThirtyMHzError as e:
+                    logger.warning(e.message)
+                    continue
+                with self.lock:
+                    self.metadata.setdefault(organization, metadata)
+
 
 class ThirtyMHzTarget(Target):
-    def __init__(self, api_key, organization, already_done_out, **kwargs):
+    def __init__(
+            self,
+            api_key,
+            organization,
+            already_done_out,
+            http=None,
+            cache_ttl=DEFAULT_CACHE_TTL,
+            ingest_batch=None,
+            concurrency=None,
+            done_store: DoneStore = None,
+            remote_dedupe=None,
+            api_url=None,
+            asynchronous=None,
+            setup_lock=None,
+            prefetch_window=None,
+            **kwargs,
+    ):
+        """
+        :param prefetch_window: number of ingests of which the files are fetched at once, by default max_events of
+            ingest_batch, in_flight of asynchronous or DEFAULT_PREFETCH_WINDOW
+        """
         super(ThirtyMHzTarget, self).__init__(**kwargs)
         logger.debug(f"Default organization: {organization}")
-        self.tmz = ThirtyMHzGetter(api_key, organization)
+        self.tmz = ThirtyMHzGetter(
+            api_key, organization, http=http, cache_ttl=cache_ttl, api_url=api_url
+        )
         self.already_done_out = already_done_out
         self.statsd_client = Metric.client()
         self.api_key = api_key
         self.organization = organization
+        # {"max_events": ..., "max_bytes": ...} enables batched ingests
+        self.ingest_batch = ingest_batch
+        # {"workers": ..., "per_organization": ...} enables concurrent ingests
+        self.concurrency = concurrency
+        # {"in_flight": ..., "per_organization": ...} ingests on an event loop instead, needs aiohttp
+        self.asynchronous = asynchronous
+        self.http = http
+        self.cache_ttl = cache_ttl
+        self.api_url = api_url
+        self.done_store = done_store
+        # Path of a file lock that serializes setting up sensor types and import checks between the processes of a
+        # sharded sync, which share the default organization
+        self.setup_lock = setup_lock
+        self.prefetch_window = prefetch_window
+        # Relations with an ingest that was not accepted, their high water marks must not advance
+        self.failed_relations = set()
+        self.lock = threading.Lock()
+        # Sensor type id -> lock held while creating it in the default organization, which tenants share
+        self.sensor_type_locks = {}
+        self.organizations = OrganizationCache(
+            self.tmz.get_default(),
+            workers=(concurrency or {}).get("workers", DEFAULT_WORKERS),
+        )
+        # {"store": ..., "window_days": ..., "overlap_hours": ..., "workers": ...} configures the remote dedupe
+        self.remote_dedupe = dict(remote_dedupe or {})
+        store = self.remote_dedupe.pop("store", None)
+        self.remote_store = RemoteOrderIds(store) if store else None
+        # (api_key, organization) -> RemoteDedupeIndex of the tenant, for the run
+        self.remote_indexes = {}
 
-    def check_if_org_exists(self) -> bool:
-        url = f"https://api.30mhz.com/api/organization/{self.organization}"
-        
-        r = requests.get(url, headers= {
-                                "Authorization": self.api_key,
-                                "Content-type": "application/json",
-                                "Accept": "application/json",
-                            })
-        if r.status_code > 200:
-            return False
-        else:
-            return True
+    def check_if_org_exists(self, organization=None) -> bool:
+        return self.organizations.exists(organization or self.organization)
+
+    def get_organization_id(self, row):
+        return row.get("organization_id", self.organization)
 
     def write(self, rows):
         sensor_types, import_checks, ingests, ids = rows
-        
-        self.statsd_client.incr(cst.STATS_30MHZ_SENSOR_TYPES_TODO, len(sensor_types))
-        self.statsd_client.incr(cst.STATS_30MHZ_IMPORT_CHECKS_TODO, len(import_checks))
-        self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_TODO, len(ingests))
-        logger.debug(sensor_types)
-        logger.debug("import_checks:")
-        logger.debug(import_checks)
         self.write_sensor_types(sensor_types)
         self.write_import_checks(import_checks)
-        
-        if self.check_if_org_exists()==True:
-            today = date.today()
-            week_ago = today - timedelta(days=7)
-            try:
-                filtered = ingests = filter(
-                    lambda i: i['data']['datetime'] > week_ago if 'datetime' in i['data'] and 'data' in i else False,
-                ingests
-                )
-                ingests = filtered 
-            except Exception as e:
-                logger.error(e.message)
-                    
+        self.write_ids(self.write_samples(ingests))
+
+    def start_stream(self):
+        self.stream_lock = threading.Lock()
+        # (kind, organization_id, id) -> event that is set once the sensor type or import check is set up
+        self.set_up = {}
+        self.already_done_file = open(self.already_done_out, "w")
+
+    def write_chunk(self, rows):
+        """
+        Writes one chunk of a stream; chunks may be written from several threads at once. Every sensor type and
+        import check is set up once per stream, and the ingests of a chunk are only written once the sensor types
+        and import checks they depend on are set up, by this chunk or another. The done ids are written as the
+        chunk completes.
+        """
+        sensor_types, import_checks, ingests, ids = rows
+        self.set_up_once("sensor_type", sensor_types, self.write_sensor_types)
+        self.set_up_once("import_check", import_checks, self.write_import_checks)
+        accepted = self.write_samples(ingests)
+        with self.stream_lock:
+            self.write_ids(accepted, f=self.already_done_file)
+
+    def finish_stream(self):
+        self.already_done_file.close()
+
+    def set_up_once(self, kind, items, write):
+        """
+        Writes the items no other chunk of the stream has claimed, then waits for the ones other chunks claimed.
+        """
+        todo = []
+        claimed = []
+        pending = []
+        with self.stream_lock:
+            for item in items:
+                key = (kind, item.get("organization_id"), item["id"])
+                if key in self.set_up:
+                    pending.append(self.set_up[key])
+                else:
+                    self.set_up[key] = threading.Event()
+                    claimed.append(self.set_up[key])
+                    todo.append(item)
+        try:
+            write(todo)
+        finally:
+            for event in claimed:
+                event.set()
+        for event in pending:
+            event.wait()
+
+    def write_samples(self, ingests):
+        """
+        Writes the ingests of a chunk and fetches their files.
+        :return: the order ids of the accepted ingests
+        """
+        files = lazy_files(ingests)
+        self.statsd_client.incr(cst.STATS_30MHZ_INGESTS_TODO, len(ingests))
+
+        self.organizations.prefetch(map(self.get_organization_id, ingests))
+        ingests = self.filter_recent(ingests)
         ingest_results = self.write_ingests(ingests)
-        self.write_ids(ingest_results)
 
+        fetched = sum(1 for f in files if f.fetched)
+        self.statsd_client.incr(cst.STATS_SOURCE_PDFS_FETCHED, fetched)
+        self.statsd_client.incr(cst.STATS_SOURCE_PDFS_AVOIDED, len(files) - fetched)
+        return ingest_results
+
+
+    def filter_recent(self, ingests) -> List:
+        """
+        Organizations that already exist in 30MHz only get the samples of the last 7 days. Ingests of organizations
+        of which that can't be told are dropped and their relations failed, so a later run sends them.
+        """
+        week_ago = date.today() - timedelta(days=7)
+        exists = {}
+        for organization in dict.fromkeys(map(self.get_organization_id, ingests)):
+            try:
+                exists[organization] = self.check_if_org_exists(organization)
+            except ThirtyMHzError as e:
+                logger.error(f"Not ingesting the samples of organization {organization}: {e.message}")
+                exists[organization] = None
+        unknown = [i for i in ingests if exists[self.get_organization_id(i)] is None]
+        if unknown:
+            with self.lock:
+                self.failed_relations.update(i.get("relation_id") for i in unknown)
+
+        def is_recent(event):
+            timestamp = event.get("datetime")
+            if isinstance(timestamp, datetime):
+                timestamp = timestamp.date()
+            return timestamp is not None and timestamp > week_ago
+
+        return [
+            i
+            for i in ingests
+            if exists[self.get_organization_id(i)] is False
+            or (exists[self.get_organization_id(i)] and all(map(is_recent, i.get("data", []))))
+        ]
 
     def write_sensor_types(self, sensor_types):
+        self.statsd_client.incr(cst.STATS_30MHZ_SENSOR_TYPES_TODO, len(sensor_types))
+        logger.debug(sensor_types)
+        self.organizations.prefetch(map(self.get_organization_id, sensor_types))
         for sensor_type in sensor_types:
             id = sensor_type["id"]
             try:
                 if not self.tmz.get(sensor_type).sensor_type.exists(
                     id=sensor_type["id"]
                 ):
-                    if not self.tmz.get_default().sensor_type.exists(
-                        id=sensor_type["id"]
-                    ):
-                        logger.debug("Creating sensor type")
-                        try:
-                            self.tmz.get_default().sensor_type.create(
-                                id=id,
-                                name=sensor_type["name"],
-                                schema=sensor_type["schema"],
-                            )
-                        except ThirtyMHzError as e:
-                            logger.error(e)
-                    logger.debug("Sharing sensor type")
-                    try:
-                        self.tmz.get_default().share_sensor_type.create(
-                            id=id,
-                            organization_id=sensor_type.get(
-                                "organization_id", self.tmz.default_organization
-                            ),
-                        )
-                    except ThirtyMHzError as e:
-                        logger.error(e)
+                    with self.setup_guard(sensor_type):
+                        if not self.tmz.get(sensor_type).sensor_type.exists(id=id):
+                            self.create_sensor_type(sensor_type)
             except ThirtyMHzError as e:
                 logger.error(e.message)
                 logger.error(self.tmz.get_default().api_key)
                 continue
 
+    @contextmanager
+    def setup_guard(self, row):
+        """
+        Holds the setup lock, if any, for setting up a sensor type or import check of row. Another shard may have set
+        it up while waiting for the lock, so the cached indexes of the tenant and the default organization are
+        dropped and the caller checks again.
+        """
+        if self.setup_lock is None:
+            yield
+            return
+        with file_lock(self.setup_lock):
+            self.tmz.get(row).invalidate_cache()
+            self.tmz.get_default().invalidate_cache()
+            yield
+
+    def create_sensor_type(self, sensor_type):
+        """
+        Creates the sensor type in the default organization when it doesn't exist there yet and shares it with the
+        organization of the row.
+        """
+        id = sensor_type["id"]
+        with self.lock:
+            lock = self.sensor_type_locks.setdefault(id, threading.Lock())
+        # Chunks of different tenants set up the same sensor type of the default organization
+        with lock:
+            if not self.tmz.get_default().sensor_type.exists(id=id):
+                logger.debug("Creating sensor type")
+                try:
+                    self.tmz.get_default().sensor_type.create(
+                        id=id,
+                        name=sensor_type["name"],
+                        schema=sensor_type["schema"],
+                    )
+                except ThirtyMHzError as e:
+                    logger.error(e)
+        organization_id = sensor_type.get(
+            "organization_id", self.tmz.default_organization
+        )
+        if not self.check_if_org_exists(organization_id):
+            logger.warning(
+                f"Organization {organization_id} not found, not sharing sensor type {id}"
+            )
+            return
+        logger.debug("Sharing sensor type")
+        try:
+            self.tmz.get_default().share_sensor_type.create(
+                id=id,
+                organization_id=organization_id,
+            )
+        except ThirtyMHzError as e:
+            logger.error(e)
+
     def write_import_checks(self, import_checks):
+        self.statsd_client.incr(cst.STATS_30MHZ_IMPORT_CHECKS_TODO, len(import_checks))
+        logger.debug("import_checks:")
+        logger.debug(import_checks)
         for import_check in import_checks:
             try:
                 if not self.tmz.get(import_check).import_check.exists(
                     id=import_check["id"]
                 ):
-                    logger.debug("Creating import check")
-                    sensor_type = self.tmz.get_default().sensor_type.get(
-                        id=import_check["sensor_type"]
-                    )
-                    if sensor_type is None:
-                        logger.error(
-                            f'No sensor type found: {import_check["sensor_type"]}'
-                        )
-
-                        continue
-                    try:
-                        self.tmz.get(import_check).import_check.create(
-                            id=import_check["id"],
-                            name=import_check["name"],
-                            sensor_type=sensor_type,
-                        )
-                    except ThirtyMHzError as e:
-                        logger.error(e)
-
+                    with self.setup_guard(import_check):
+                        if not self.tmz.get(import_check).import_check.exists(id=import_check["id"]):
+                            self.create_import_check(import_check)
             except ThirtyMHzError as e:
                 logger.error(self.tmz.get(import_check).api_key)
                 logger.error(e)
 
+    def create_import_check(self, import_check):
+        logger.debug("Creating import check")
+        sensor_type = self.tmz.get_default().sensor_type.get(
+            id=import_check["sensor_type"]
+        )
+        if sensor_type is None:
+            logger.error(
+                f'No sensor type found: {import_check["sensor_type"]}'
+            )
+            return
+        try:
+            self.tmz.get(import_check).import_check.create(
+                id=import_check["id"],
+                name=import_check["name"],
+                sensor_type=sensor_type,
+            )
+        except ThirtyMHzError as e:
+            logger.error(e)
+
     def write_ingests(self, ingests):
-        done_ids = []
-        
-        ingests = self.filter_existing_order_sample_data_ids(ingests)
-        
+        ingests = list(self.filter_existing_order_sample_data_ids(ingests))
+        if self.asynchronous is not None:
+            # One event loop for all windows, see ingest_async
+            accepted = self.write_ingests_async(ingests)
+        else:
+            accepted = set()
+            for window in self.iter_windows(ingests):
+                if self.ingest_batch is not None:
+                    accepted.update(self.write_ingests_batched(window))
+                elif self.concurrency is not None:
+                    accepted.update(self.write_ingests_concurrent(window))
+                else:
+                    accepted.update(i["order_id"] for i in window if self.write_ingest(i))
+        with self.lock:
+            self.failed_relations.update(
+                i.get("relation_id") for i in ingests if i["order_id"] not in accepted
+            )
+        # Done ids keep the order of the ingests, however the work was scheduled
+        return [i["order_id"] for i in ingests if i["order_id"] in accepted]
+
+    def get_prefetch_window(self) -> int:
+        if self.prefetch_window is not None:
+            return self.prefetch_window
+        if self.ingest_batch is not None:
+            return self.ingest_batch.get("max_events", DEFAULT_INGEST_MAX_EVENTS)
+        if self.asynchronous is not None:
+            return self.asynchronous.get("in_flight", DEFAULT_PREFETCH_WINDOW)
+        return DEFAULT_PREFETCH_WINDOW
+
+    def get_windows(self, ingests) -> List[List]:
+        """
+        Splits the ingests into windows of get_prefetch_window() ingests, the unit in which their files are fetched.
+        """
+        if self.ingest_batch is not None:
+            # Windows of a single tenant fill whole batches
+            ingests = sorted(
+                ingests,
+                key=lambda i: (str(i.get("api_key", self.api_key)), str(self.get_organization_id(i))),
+            )
+        return list(chunked(ingests, self.get_prefetch_window()))
+
+    def iter_windows(self, ingests) -> Iterator[List]:
+        """
+        Yields the windows of get_windows. The files of the next window are fetched while the caller writes the
+        current one, so at most two windows of files are held at once, and files of a window that were not uploaded
+        are closed once the caller is done with it.
+        """
+        windows = self.get_windows(ingests)
+        if not windows:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            fetching = executor.submit(prefetch, lazy_files(windows[0]))
+            for position, window in enumerate(windows):
+                fetching.result()
+                if position + 1 < len(windows):
+                    fetching = executor.submit(prefetch, lazy_files(windows[position + 1]))
+                try:
+                    yield window
+                finally:
+                    for f in lazy_files(window):
+                        f.release()
+
+    def write_ingest(self, ingest) -> bool:
+        import_check = self.get_ingest_import_check(ingest)
+        if import_check is None:
+            return False
+        try:
+            self.tmz.get(ingest).import_check.ingest(import_check, ingest["data"])
+            return True
+        except ThirtyMHzError as e:
+            logger.error(e.message)
+            return False
+
+    def write_ingests_concurrent(self, ingests) -> set:
+        """
+        Ingests on a pool of `workers` threads. Every organization gets at most `per_organization` lanes, each
+        lane working through that organization's ingests one at a time, so no organization gets more than
+        `per_organization` requests in flight.
+        """
+        workers = self.concurrency.get("workers", DEFAULT_WORKERS)
+        per_organization = self.concurrency.get(
+            "per_organization", DEFAULT_PER_ORGANIZATION
+        )
+        queues = {}
         for ingest in ingests:
-            try:
-                import_check = self.tmz.get(ingest).import_check.get(id=ingest["id"])
-            except ThirtyMHzError as e:
-                logger.debug(e.message)
-                logger.debug(self.tmz.get(ingest).api_key)
+            organization = ingest.get("organization_id", self.organization)
+            queues.setdefault(organization, deque()).append(ingest)
+
+        def lane(queue):
+            done = []
+            while True:
+                try:
+                    ingest = queue.popleft()
+                except IndexError:
+                    return done
+                if self.write_ingest(ingest):
+                    done.append(ingest["order_id"])
+
+        lanes = [
+            queue
+            for queue in queues.values()
+            for _ in range(min(per_organization, len(queue)))
+        ]
+        accepted = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for done in executor.map(lane, lanes):
+                accepted.update(done)
+        return accepted
+
+    def write_ingests_batched(self, ingests) -> set:
+        """
+        Ingests per tenant in batches of events from many import checks, see ImportCheck.ingest_batch.
+        With concurrency enabled the tenants are ingested in parallel.
+        """
+        items_per_tenant = {}
+        for ingest in ingests:
+            import_check = self.get_ingest_import_check(ingest)
+            if import_check is None:
                 continue
+            tmz = self.tmz.get(ingest)
+            items_per_tenant.setdefault((tmz.api_key, tmz.organization), []).append(
+                (ingest["order_id"], import_check, ingest["data"])
+            )
+
+        def ingest_tenant(tenant):
+            (api_key, organization), items = tenant
+            return self.tmz.get_by_api_key(api_key, organization).import_check.ingest_batch(
+                items, **self.ingest_batch
+            )
+
+        if self.concurrency is None:
+            results = list(map(ingest_tenant, items_per_tenant.items()))
+        else:
+            workers = self.concurrency.get("workers", DEFAULT_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(ingest_tenant, items_per_tenant.items()))
+        return {order_id for done in results for order_id in done}
+
+    def write_ingests_async(self, ingests) -> set:
+        """
+        Ingests on an event loop, with at most `in_flight` requests in flight and, without ingest_batch, at most
+        `per_organization` ingests per organization. With ingest_batch every tenant is ingested in batches, see
+        AsyncImportCheck.ingest_batch.
+        """
+        windows = self.get_windows(ingests)
+        if not windows:
+            return set()
+        return asyncio.run(self.ingest_async(windows))
+
+    def get_items_per_tenant(self, ingests) -> Dict:
+        items_per_tenant = {}
+        for ingest in ingests:
+            import_check = self.get_ingest_import_check(ingest)
             if import_check is None:
-                logger.error(f'No import check found: {ingest["id"]}')
-                logger.error(ingest)
                 continue
-            try:
-                self.tmz.get(ingest).import_check.ingest(import_check, ingest["data"])
-                done_ids.append(ingest["order_id"])
-            except ThirtyMHzError as e:
-                logger.error(e.message)
-        return done_ids
+            tmz = self.tmz.get(ingest)
+            items_per_tenant.setdefault((tmz.api_key, tmz.organization), []).append(
+                (ingest["order_id"], import_check, ingest["data"])
+            )
+        return items_per_tenant
+
+    async def ingest_async(self, windows: List[List]) -> set:
+        """
+        Ingests the windows on one session, ASYNC_WINDOWS_IN_FLIGHT at once, so the next window is under way while
+        the last requests of a window finish. The files of a window are fetched when it starts and the ones that
+        were not uploaded are closed when it's done.
+        """
+        from efa_30mhz.async_thirty_mhz import AsyncThirtyMHzGetter, DEFAULT_IN_FLIGHT
+
+        per_organization = self.asynchronous.get("per_organization", DEFAULT_ASYNC_PER_ORGANIZATION)
+        semaphores = {}
+        async with AsyncThirtyMHzGetter(
+                self.api_key,
+                self.organization,
+                in_flight=self.asynchronous.get("in_flight", DEFAULT_IN_FLIGHT),
+                http=self.http,
+                cache_ttl=self.cache_ttl,
+                api_url=self.api_url,
+                rate_limiter=self.tmz.sessions.rate_limiter,
+        ) as getter:
+
+            async def ingest_tenant(tenant, items):
+                import_check = getter.get_by_api_key(*tenant).import_check
+                if self.ingest_batch is not None:
+                    return await import_check.ingest_batch(items, **self.ingest_batch)
+                semaphore = semaphores.setdefault(tenant, asyncio.Semaphore(per_organization))
+
+                async def ingest_one(order_id, check, rows):
+                    async with semaphore, getter.in_flight_semaphore:
+                        try:
+                            await import_check.ingest(check, rows)
+                            return order_id
+                        except ThirtyMHzError as e:
+                            logger.error(e.message)
+
+                done = await asyncio.gather(*(ingest_one(*item) for item in items))
+                return [order_id for order_id in done if order_id is not None]
+
+            async def ingest_window(window):
+                try:
+                    await asyncio.to_thread(prefetch, lazy_files(window))
+                    # Looked up with the synchronous client, cached after the first window
+                    items_per_tenant = await asyncio.to_thread(self.get_items_per_tenant, window)
+                    results = await asyncio.gather(
+                        *(ingest_tenant(tenant, items) for tenant, items in items_per_tenant.items())
+                    )
+                    return {order_id for done in results for order_id in done}
+                finally:
+                    for f in lazy_files(window):
+                        f.release()
+
+            accepted = set()
+            running = set()
+            for window in windows:
+                if len(running) == ASYNC_WINDOWS_IN_FLIGHT:
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        accepted.update(task.result())
+                running.add(asyncio.ensure_future(ingest_window(window)))
+            for done in await asyncio.gather(*running):
+                accepted.update(done)
+        return accepted
+
+    def get_ingest_import_check(self, ingest):
+        try:
+            import_check = self.tmz.get(ingest).import_check.get(id=ingest["id"])
+        except ThirtyMHzError as e:
+            logger.debug(e.message)
+            logger.debug(self.tmz.get(ingest).api_key)
+            return None
+        if import_check is None:
+            logger.error(f'No import check found: {ingest["id"]}')
+            logger.error(ingest)
+        return import_check
     
+    def get_tenant(self, row) -> Tuple[str, str]:
+        tmz = self.tmz.get(row)
+        return tmz.api_key, tmz.organization
+
+    def get_remote_index(self, api_key, organization) -> "RemoteDedupeIndex":
+        with self.lock:
+            if (api_key, organization) not in self.remote_indexes:
+                default = (api_key, organization) == (self.api_key, self.organization)
+                self.remote_indexes[(api_key, organization)] = RemoteDedupeIndex(
+                    SamplesGetter(
+                        # Tenant keys come with the Bearer prefix that SamplesGetter adds itself
+                        api_key[len("Bearer "):] if api_key.startswith("Bearer ") else api_key,
+                        organization,
+                        session=self.tmz.sessions.get(api_key, organization),
+                        api_url=self.api_url,
+                    ),
+                    store=self.remote_store,
+                    scope=None if default else organization,
+                    **self.remote_dedupe,
+                )
+            return self.remote_indexes[(api_key, organization)]
+
     def filter_existing_order_sample_data_ids(self, ingests):
-        try:
-            samples_getter = SamplesGetter(self.api_key, self.organization)
-            
-            from_date = datetime.today().strftime('%Y-%m-%d')
-            to_date = (datetime.today() - timedelta(days=7)).strftime('%Y-%m-%d')
-            existing_order_ids = samples_getter.get_all_order_ids_for_user_from_until(from_date, to_date)
-            
-            filtered_ingests = filter(
-                lambda i: i['data']['order_sample_data_id'] not in existing_order_ids, 
-                ingests
-                )    
-            
-            return filtered_ingests
-        
-        except Exception as e:
-            logger.warning("Problem during filtering of order sample data ids for existing customer. Resuming with original list.")
-            logger.warning(e.message)
-            return ingests 
-            
-
-    def write_ids(self, ids):
-        with open(self.already_done_out, "w") as f:
-            logger.debug("Writing to already done")
-            logger.debug(ids)
+        """
+        Drops the ingests of samples that are already in the organization they go to, see RemoteDedupeIndex. The
+        indexes of the tenants that were not seen before in this run are fetched concurrently.
+        """
+        indexes = {
+            tenant: self.get_remote_index(*tenant) for tenant in dict.fromkeys(map(self.get_tenant, ingests))
+        }
+        todo = [index for index in indexes.values() if index.ids is None]
+        if len(todo) > 1:
+            workers = self.remote_dedupe.get("workers", DEFAULT_WORKERS)
+            with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as executor:
+                list(executor.map(RemoteDedupeIndex.get_ids, todo))
+        return [i for i in ingests if i["order_id"] not in indexes[self.get_tenant(i)]]
+
+    def write_ids(self, ids, f=None):
+        """
+        :param f: already done file to append the ids to, by default the file is overwritten with ids
+        """
+        if self.done_store is not None:
+            self.done_store.add_many(ids)
+        logger.debug("Writing to already done")
+        logger.debug(ids)
+        if f is None:
+            with open(self.already_done_out, "w") as f:
+                f.write("\n".join(list(map(str, ids))))
+        elif len(ids) > 0:
+            if f.tell() > 0:
+                f.write("\n")
             f.write("\n".join(list(map(str, ids))))
+            f.flush()
+
 
 class SamplesGetter:
     """
     Class for getting raw samples from 30Mhz API.
+    The stats of every import check are fetched per window of window_days, with `workers` windows in flight.
     """
-    
-    def __init__(self, api_key, organization):
+
+    column_names = ['timestamp', 'sensor_type', 'import_check', 'check_name', 'research_number', 'sample_description', 'file', 'order_sample_data_id']
+
+    def __init__(
+            self,
+            api_key,
+            organization,
+            session: ThirtyMHzSession = None,
+            workers: int = DEFAULT_WORKERS,
+            window_days: float = DEFAULT_EXPORT_WINDOW_DAYS,
+            api_url: str = None,
+    ):
         self.api_key = api_key
         self.organization = organization
-        self.import_check_url = f"https://api.30mhz.com/api/import-check/organization/{self.organization}"
-        self.stats_url = "https://api.30mhz.com/api/stats/check/{import_check_id}/from/{from_date}/until/{end_date}"
-        
+        self.session = session or ThirtyMHzSession()
+        self.workers = workers
+        self.window_days = window_days
+        api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+        self.import_check_url = f"{api_url}/import-check/organization/{self.organization}"
+        self.stats_url = api_url + "/stats/check/{import_check_id}/from/{from_date}/until/{end_date}"
+        # (import check id, from, until) of the windows that could not be fetched in the last export
+        self.failed_windows = []
+
+    def get_windows(self, from_date, end_date) -> List[Tuple[str, str]]:
+        """
+        Splits from_date - end_date, datetimes or ISO 8601 strings, into windows of window_days.
+        """
+        start, end = (to_utc(from_date), to_utc(end_date))
+        windows = []
+        while start < end:
+            until = min(start + timedelta(days=self.window_days), end)
+            windows.append((start.strftime(STATS_DATE_FORMAT), until.strftime(STATS_DATE_FORMAT)))
+            start = until
+        return windows
+
+    def get_samples_of_import_check(self, import_check, from_date, end_date) -> List[List]:
+        """
+        The sample rows, in the order of column_names, in the stats of one import check between from_date and
+        end_date.
+        """
+        import_check_id = import_check['checkId']
+        stats_url = self.stats_url.format(import_check_id=import_check_id, from_date=from_date, end_date=end_date)
+        r = self.session.get(stats_url, headers=self.headers, params=self.stats_params)
+        if not 200 <= r.status_code < 300:
+            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.text}")
+        return [
+            self.extract_sample_identifier_data(
+                sensor_update,
+                import_check['sensorType'],
+                import_check_id,
+                import_check['name'],
+                datetime.utcfromtimestamp(int(key)/1000).strftime('%Y-%m-%d %H:%M:%S')
+            )
+            for key, sensor_update in r.json().items()
+                if import_check['sensorType'] + '.research_number' in sensor_update
+                and import_check['sensorType'] + '.order_sample_data_id' in sensor_update
+        ]
+
+    def iter_samples(self, from_date, end_date) -> Iterator[List[List]]:
+        """
+        Streams the sample rows per import check and window, in that order. The windows are fetched concurrently,
+        at most 2 * workers ahead of the consumer. A window that fails is logged, added to failed_windows and
+        skipped.
+        """
+        self.failed_windows = []
+        tasks = [
+            (import_check, from_window, until_window)
+            for import_check in self._get_import_checks()
+            for from_window, until_window in self.get_windows(from_date, end_date)
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append((task, executor.submit(self.get_samples_of_import_check, *task)))
+                if len(pending) >= 2 * self.workers:
+                    yield self.get_window_result(*pending.popleft())
+            while pending:
+                yield self.get_window_result(*pending.popleft())
+
+    def get_window_result(self, task, future) -> List[List]:
+        try:
+            return future.result()
+        except Exception as e:
+            import_check, from_window, until_window = task
+            logger.warning(
+                f"Can't get the stats of import check {import_check['checkId']} from {from_window} until {until_window}: {e}"
+            )
+            self.failed_windows.append((import_check['checkId'], from_window, until_window))
+            return []
+
     def get_all_samples_for_user_from_until(self, from_date, end_date) -> DataFrame:
-        
-        column_names = ['timestamp', 'sensor_type', 'import_check', 'check_name', 'research_number', 'sample_description', 'file', 'order_sample_data_id']
-        
-        samples = DataFrame(columns=column_names)
-        
-        import_checks = self._get_import_checks()
-        
-        for import_check in import_checks:
-            import_check_id = import_check['checkId']
-            headers = self.headers
-            params = self.stats_params
-            stats_url = self.stats_url.format(import_check_id=import_check_id, from_date=from_date, end_date=end_date)
+        columns = {name: [] for name in self.column_names}
+        for rows in self.iter_samples(from_date, end_date):
+            for name, values in zip(self.column_names, zip(*rows)):
+                columns[name].extend(values)
+        return DataFrame(columns, columns=self.column_names)
+
+    def export(self, from_date, end_date, path: str, format: str = "csv") -> int:
+        """
+        Writes the samples to a CSV or Parquet file as they are fetched, so exports of many years don't have to
+        fit in memory. Parquet needs pyarrow.
+        :return: the number of rows written
+        """
+        if format == "parquet":
             try:
-                
-                r = requests.get(stats_url, headers=headers, params=params)
-                
-                data = r.json()
-                
-                samples_of_import_check = [
-                    self.extract_sample_identifier_data(
-                        sensor_update,
-                        import_check['sensorType'],
-                        import_check_id,
-                        import_check['name'],
-                        datetime.utcfromtimestamp(int(key)/1000).strftime('%Y-%m-%d %H:%M:%S')
-                    ) 
-                    for key,sensor_update in data.items()
-                        if import_check['sensorType'] + '.research_number' in sensor_update
-                        and import_check['sensorType'] + '.order_sample_data_id' in sensor_update
-                ]
-                
-                fey = DataFrame(samples_of_import_check, columns=column_names)
-                samples = concat([samples, fey])
-            except Exception as e:
-                logger.debug(e.message)
-                return samples                
-            
-        return samples
-    
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ThirtyMHzError("Parquet exports need pyarrow, pip install pyarrow")
+            schema = pyarrow.schema([(name, pyarrow.string()) for name in self.column_names])
+            with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+                return self.write_batches(
+                    from_date,
+                    end_date,
+                    lambda df: writer.write_table(
+                        pyarrow.Table.from_pandas(df.astype(str), schema=schema, preserve_index=False)
+                    ),
+                )
+        if format == "csv":
+            with open(path, "w", newline="") as f:
+                DataFrame(columns=self.column_names).to_csv(f, index=False)
+                return self.write_batches(
+                    from_date, end_date, lambda df: df.to_csv(f, header=False, index=False)
+                )
+        raise ThirtyMHzError(f"Unknown export format {format}")
+
+    def write_batches(self, from_date, end_date, write) -> int:
+        written = 0
+        for rows in self.iter_samples(from_date, end_date):
+            if rows:
+                write(DataFrame(rows, columns=self.column_names))
+                written += len(rows)
+        return written
+
+    def get_order_ids_of_import_check(self, import_check, from_date, end_date) -> Set[int]:
+        """
+        The order sample data ids in the stats of one import check between from_date and end_date.
+        """
+        field = import_check['sensorType'] + '.order_sample_data_id'
+        stats_url = self.stats_url.format(
+            import_check_id=import_check['checkId'], from_date=from_date, end_date=end_date
+        )
+        r = self.session.get(stats_url, headers=self.headers, params=self.stats_params)
+        if not 200 <= r.status_code < 300:
+            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.text}")
+        order_ids = (to_order_id(sensor_update[field]) for sensor_update in r.json().values() if field in sensor_update)
+        return {order_id for order_id in order_ids if order_id is not None}
+
     def get_all_order_ids_for_user_from_until(self, from_date, end_date) -> list:
         df = self.get_all_samples_for_user_from_until(from_date, end_date)
         return df['order_sample_data_id'].tolist()
 
-            
     @staticmethod
     def extract_sample_identifier_data(sensor_update: dict, sensor_type: str, import_check: str, check_name: str, key: str):
         # Checks if sensor import check belongs to EFA pipeline
@@ -625,8 +1485,108 @@ class SamplesGetter:
 
     def _get_import_checks(self):
         headers = self.headers
-        r = requests.get(self.import_check_url, headers=headers)
+        r = self.session.get(self.import_check_url, headers=headers)
         if 200 <= r.status_code < 300:
             return r.json()
         else:
-            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.json()}")
\ No newline at end of file
+            raise ThirtyMHzError(f"Faulty status code {r.status_code}: {r.json()}")
+
+def to_utc(value) -> datetime:
+    """
+    A datetime or ISO 8601 string as an aware UTC datetime, naive values are taken to be UTC.
+    """
+    value = to_datetime(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def to_order_id(value) -> Optional[int]:
+    """
+    Order sample data ids come back from the stats as ints, floats or strings.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+class RemoteDedupeIndex:
+    """
+    The order sample data ids that are already in 30MHz, according to the stats of the import checks of the
+    organization of samples_getter. The ids are fetched once per run, with a concurrent stats call per import
+    check. With a store, the ids are kept between runs and a run only queries the window since the previous one of
+    the same scope, with some overlap.
+    """
+
+    def __init__(
+            self,
+            samples_getter: SamplesGetter,
+            store: RemoteOrderIds = None,
+            window_days: float = DEFAULT_DEDUPE_WINDOW_DAYS,
+            overlap_hours: float = DEFAULT_DEDUPE_OVERLAP_HOURS,
+            workers: int = DEFAULT_WORKERS,
+            scope: str = None,
+    ):
+        """
+        :param scope: under which the store keeps the ids of this index and the moment it was synced until, like
+            the organization; indexes of different organizations that share a store need a scope of their own
+        """
+        self.samples_getter = samples_getter
+        self.store = store
+        self.scope = scope
+        self.window_days = window_days
+        self.overlap_hours = overlap_hours
+        self.workers = workers
+        self.ids: Optional[Set[int]] = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, order_id) -> bool:
+        return to_order_id(order_id) in self.get_ids()
+
+    def get_ids(self) -> Set[int]:
+        with self.lock:
+            if self.ids is None:
+                self.ids = self.fetch()
+            return self.ids
+
+    def get_since(self, now: datetime) -> datetime:
+        since = now - timedelta(days=self.window_days)
+        synced_until = self.store.get_synced_until(self.scope) if self.store is not None else None
+        if synced_until is not None:
+            since = max(since, synced_until - timedelta(hours=self.overlap_hours))
+        return since
+
+    def fetch(self) -> Set[int]:
+        ids = self.store.get_all(self.scope) if self.store is not None else set()
+        now = datetime.now(timezone.utc)
+        from_date = self.get_since(now).strftime(STATS_DATE_FORMAT)
+        end_date = now.strftime(STATS_DATE_FORMAT)
+        try:
+            import_checks = self.samples_getter._get_import_checks()
+        except (ThirtyMHzError, RequestException) as e:
+            logger.warning(f"Can't list the import checks to find samples already in 30MHz: {e}")
+            return ids
+
+        def fetch_import_check(import_check):
+            return self.samples_getter.get_order_ids_of_import_check(import_check, from_date, end_date)
+
+        fetched = set()
+        complete = True
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(fetch_import_check, i) for i in import_checks]
+            for import_check, future in zip(import_checks, futures):
+                try:
+                    fetched.update(future.result())
+                except Exception as e:
+                    logger.warning(f"Can't get the stats of import check {import_check.get('checkId')}: {e}")
+                    complete = False
+        logger.info(f"Found {len(fetched)} samples in 30MHz between {from_date} and {end_date}")
+        if self.store is not None:
+            # A window with a failed import check is queried again next run
+            self.store.add_many(fetched, synced_until=now if complete else None, scope=self.scope)
+        ids.update(fetched)
+        return ids
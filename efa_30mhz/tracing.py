@@ -0,0 +1,227 @@
+import cProfile
+import functools
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Tuple, Iterable, Iterator, List, Callable, Optional
+
+NULL_SPAN = nullcontext()
+
+
+class SpanStats:
+    __slots__ = ("count", "seconds", "max", "errors")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def add(self, seconds: float, error: bool):
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.errors += error
+
+
+class Tracer:
+    """
+    Times spans, the named stages of a sync run, tagged with the tenant they worked for.
+    Spans are aggregated per name and tags when they end, so tracing a run of any size takes little memory.
+    Spans nest: the time of a span includes the time of the spans inside it. Tracing is off until enabled, then a
+    span costs a function call.
+    """
+
+    __instance = None
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.spans: Dict[Tuple[str, Tuple], SpanStats] = {}
+
+    @staticmethod
+    def get() -> "Tracer":
+        if Tracer.__instance is None:
+            Tracer.__instance = Tracer()
+        return Tracer.__instance
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+
+    def span(self, name: str, **tags):
+        if not self.enabled:
+            return NULL_SPAN
+        return self.timed(name, tags)
+
+    @contextmanager
+    def timed(self, name: str, tags: Dict):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(name, tags, time.perf_counter() - start, error)
+
+    def iterate(self, name: str, iterable: Iterable, **tags) -> Iterator:
+        """
+        Traces producing the items of a lazy iterable, like the rows of a query, as a single span that ends when
+        the iterable is exhausted. The time the consumer spends on the items is not part of the span.
+        """
+        if not self.enabled:
+            return iter(iterable)
+        return self.timed_iterator(name, iter(iterable), tags)
+
+    def timed_iterator(self, name: str, iterator: Iterator, tags: Dict) -> Iterator:
+        seconds = 0.0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(name, tags, seconds, error)
+
+    def record(self, name: str, tags: Dict, seconds: float, error: bool = False):
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            stats = self.spans.get(key)
+            if stats is None:
+                stats = self.spans[key] = SpanStats()
+            stats.add(seconds, error)
+
+    def summary(self, by: str = None) -> List[Dict]:
+        """
+        :param by: tag to break the spans down by, like organization, or None for one row per span name
+        :return: rows of name, tag value, count, seconds, mean, max and errors, the slowest first
+        """
+        groups = {}
+        with self.lock:
+            for (name, tags), stats in self.spans.items():
+                value = dict(tags).get(by) if by is not None else None
+                if by is not None and value is None:
+                    continue
+                group = groups.setdefault((name, value), SpanStats())
+                group.count += stats.count
+                group.seconds += stats.seconds
+                group.max = max(group.max, stats.max)
+                group.errors += stats.errors
+        rows = [
+            {
+                "name": name,
+                by or "tag": value,
+                "count": stats.count,
+                "seconds": stats.seconds,
+                "mean": stats.seconds / stats.count,
+                "max": stats.max,
+                "errors": stats.errors,
+            }
+            for (name, value), stats in groups.items()
+        ]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def format_summary(self, by: str = None, limit: int = None) -> str:
+        rows = self.summary(by)[:limit]
+        header = f"{'span':<20}" + (f"{by:<24}" if by else "")
+        lines = [header + f"{'count':>9}{'total s':>11}{'mean ms':>10}{'max ms':>10}{'errors':>8}"]
+        for row in rows:
+            lines.append(
+                f"{row['name']:<20}"
+                + (f"{str(row[by]):<24}" if by else "")
+                + f"{row['count']:>9}{row['seconds']:>11.2f}{row['mean'] * 1000:>10.1f}"
+                  f"{row['max'] * 1000:>10.1f}{row['errors']:>8}"
+            )
+        return "\n".join(lines)
+
+
+def span(name: str, **tags):
+    """
+    A span of the global tracer, use as `with span("pdf.get", relation=relation_id):`
+    """
+    return Tracer.get().span(name, **tags)
+
+
+def traced(name: str, tags: Callable[..., Dict] = None):
+    """
+    Decorator that traces every call of a function as a span.
+    :param tags: function of the arguments of the call that returns the tags of the span
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            tracer = Tracer.get()
+            if not tracer.enabled:
+                return f(*args, **kwargs)
+            with tracer.timed(name, tags(*args, **kwargs) if tags is not None else {}):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Profiler:
+    """
+    cProfile of the thread that starts it and of every thread started while it runs, merged into one dump that
+    pstats, snakeviz or flameprof can read.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles: List[cProfile.Profile] = []
+
+    def start(self):
+        threading.setprofile(self.start_thread)
+        self.start_thread()
+
+    def start_thread(self, *args):
+        # Runs as the profile function of a new thread, until the thread's own profiler replaces it
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self) -> Optional[pstats.Stats]:
+        threading.setprofile(None)
+        with self.lock:
+            profiles, self.profiles = self.profiles, []
+        for profile in profiles:
+            profile.disable()
+        return pstats.Stats(*profiles) if profiles else None
+
+
+@contextmanager
+def profiled(path: str):
+    """
+    Profiles the block and writes the merged cProfile dump to path.
+    """
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        stats = profiler.stop()
+        if stats is not None:
+            stats.dump_stats(path)
@@ -1,5 +1,9 @@
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from logging import ERROR, DEBUG
+from typing import Dict, Optional
 
 import click
 import sentry_sdk
@@ -12,10 +16,16 @@ from efa_30mhz.eurofins import EurofinsSource
 from efa_30mhz.json import JSONSource
 from efa_30mhz.metrics import Metric
 from efa_30mhz.mssql import MSSQLSource
+from efa_30mhz.shards import merge_done_files, merge_stats, send_stats, shard_path, shard_rate_limit
+from efa_30mhz.store import DoneStore, HighWaterMarks
 from efa_30mhz.sync import Sync, Source, Target
 from efa_30mhz.thirty_mhz import ThirtyMHzTarget
+from efa_30mhz.tracing import Tracer, profiled
 
 CONFIG_FILE = "config.yaml"
+LOG_FILE = "app{time}.log"
+# Number of slowest tenants in the profile summary
+PROFILE_TENANTS = 20
 
 
 @click.group()
@@ -25,6 +35,36 @@ def cli(debug):
     logger.info("Debug mode is %s" % ("on" if debug else "off"))
 
 
+def setup_logging(log_file=LOG_FILE):
+    """
+    Logs to Sentry, as breadcrumbs and errors as events, and to log_file, kept for a week.
+    """
+    logger.add(
+        BreadcrumbHandler(level=DEBUG),
+        diagnose=True,
+        level=DEBUG,
+    )
+    logger.add(
+        EventHandler(level=ERROR),
+        diagnose=True,
+        level=ERROR,
+    )
+
+    logger.add(log_file, retention="1 week", level=DEBUG)
+
+
+def init_sentry(config):
+    sentry_sdk.init(
+        config['sentry']['url'],
+        traces_sample_rate=1.0
+    )
+
+
+def shard_log_file(log_file, index) -> str:
+    root, extension = os.path.splitext(log_file)
+    return f"{root}.shard{index}{extension}"
+
+
 def parse_config(config_file = None):
     if config_file is None:
         config_file = CONFIG_FILE
@@ -41,7 +81,9 @@ def create_mssql_source(database_config):
 
 
 def create_json_source(database_config):
-    def _create_json_source(table, **kwargs):
+    # A JSON database can't run queries, sources without a table read the default_table
+    def _create_json_source(table=None, **kwargs):
+        table = table or database_config["default_table"]
         return JSONSource(filename=database_config["tables"][table])
 
     return _create_json_source
@@ -54,14 +96,18 @@ def create_database_source(database_config):
         return create_json_source(database_config)
 
 
-def create_source(source_config, databases) -> Source:
+def create_source(
+        source_config, databases, done_store=None, high_water_marks=None, incremental=True, shard=None
+) -> Source:
     database_config = databases[source_config["default_database"]]
     database = create_database_source(database_config)
     auth_database_config = databases[source_config["auth_database"]]
     auth_database = create_database_source(auth_database_config)
     return EurofinsSource(
         super_source=database(
-            query=source_config["query"], table=source_config["samples"]["table"]
+            query=source_config["query"],
+            table=source_config["samples"]["table"],
+            bulk_query=source_config.get("bulk_query", None),
         ),
         auth_source=auth_database(query=source_config["auth_query"]),
         already_done_in=source_config["already_done_in"],
@@ -71,72 +117,301 @@ def create_source(source_config, databases) -> Source:
         schema_version=source_config.get("schema_version", None),
         default_api_key=source_config.get("default_api_key", None),
         default_organization=source_config.get("default_organization", None),
+        pdf_options=source_config.get("pdf", None),
+        bulk_read=source_config.get("bulk_read", False),
+        done_store=done_store,
+        high_water_marks=high_water_marks,
+        incremental=incremental,
+        shard=shard,
     )
 
 
-def create_target(target_config) -> Target:
-    return ThirtyMHzTarget(**target_config)
+def create_target(target_config, done_store=None, **kwargs) -> Target:
+    return ThirtyMHzTarget(**dict(target_config, **kwargs), done_store=done_store)
 
 
-def sync_source_to_target(source: Source, target: Target):
-    synchronization = Sync(source, target)
+def sync_source_to_target(
+        source: Source, target: Target, chunk_size: int = None, workers: int = None
+) -> Sync:
+    synchronization = Sync(source, target, chunk_size=chunk_size, workers=workers)
     synchronization.start()
+    return synchronization
 
 
-def already_done_sync(already_done_in, already_done_out):
+def already_done_sync(already_done_in, already_done_out, append=True):
+    """
+    Sends the ids done in this run to statsd and, without a done store, appends them to the already done file.
+    """
     logger.debug("Copying already done")
-    with open(already_done_in, "a") as to:
-        with open(already_done_out, "r") as fro:
-            rows = list(fro.readlines())
-            for row in rows:
-                Metric.client().set(constants.STATS_APP_SAMPLES_DONE, row)
+    with open(already_done_out, "r") as fro:
+        rows = list(fro.readlines())
+    with Metric.client().pipeline() as pipe:
+        for row in rows:
+            if row.strip():
+                pipe.set(constants.STATS_APP_SAMPLES_DONE, row.strip())
+    if append:
+        with open(already_done_in, "a") as to:
             if len(rows) > 0:
                 to.write("\n")
             to.writelines(rows)
 
 
-def do_sync(config):
+def open_done_store(app_config, source_config) -> Optional[DoneStore]:
+    """
+    Opens the done store of the `done_store` app setting, seeded from the already done file when it's new.
+    """
+    if not app_config.get("done_store"):
+        return None
+    done_store = DoneStore(app_config["done_store"])
+    if len(done_store) == 0:
+        done_store.import_file(source_config["already_done_in"])
+    return done_store
+
+
+def advance_high_water_marks(high_water_marks, seen_marks, failed_relations, failed_partitions=()):
+    """
+    Advances the marks of the relations read in this run of which the target accepted every ingest.
+    """
+    if None in failed_partitions:
+        # A partition of unknown relations failed
+        return
+    high_water_marks.advance(
+        {
+            relation_id: mark
+            for relation_id, mark in seen_marks.items()
+            if relation_id not in failed_relations and relation_id not in failed_partitions
+        }
+    )
+
+
+def do_sync(config, full_resync=False, shards=None):
+    """
+    :param shards: number of processes to split the relations over, by default the `shards` app setting or 1
+    """
     app_config = config["app"]
+    shards = shards or app_config.get("shards", 1)
+    if shards > 1:
+        return do_sharded_sync(config, shards, full_resync=full_resync)
     source_config = config[app_config["source"]]
     target_config = config[app_config["target"]]
     databases = config["databases"]
-    source = create_source(source_config, databases)
-    target = create_target(target_config)
-    sync_source_to_target(source, target)
+    done_store = open_done_store(app_config, source_config)
+    high_water_marks = None
+    if app_config.get("high_water_marks"):
+        high_water_marks = HighWaterMarks(app_config["high_water_marks"])
+    source = create_source(
+        source_config,
+        databases,
+        done_store=done_store,
+        high_water_marks=high_water_marks,
+        incremental=not full_resync,
+    )
+    target = create_target(target_config, done_store=done_store)
+    synchronization = sync_source_to_target(
+        source,
+        target,
+        chunk_size=app_config.get("chunk_size", None),
+        workers=app_config.get("pipeline_workers", None),
+    )
+    if high_water_marks is not None:
+        advance_high_water_marks(
+            high_water_marks,
+            source.seen_marks,
+            target.failed_relations,
+            synchronization.failed_partitions,
+        )
     already_done_sync(
-        source_config["already_done_in"], target_config["already_done_out"]
+        source_config["already_done_in"],
+        target_config["already_done_out"],
+        append=done_store is None,
     )
 
 
-@cli.command()
-@click.option("-c", "--config", "config_file")
-def sync(config_file):
+def run_shard(config, index, shards, full_resync=False) -> Dict:
     """
-    This command synchronizes the Eurofins sample data with the 30MHz data.
+    Syncs the relations of one shard, in a process of its own. The shard writes its done ids next to the already
+    done file and keeps its stats in memory, the parent merges both into those of a single run.
+    :return: the stats, the high water marks seen and the failed relations and partitions of the shard
     """
-    logger.add(
-        BreadcrumbHandler(level=DEBUG),
-        diagnose=True,
-        level=DEBUG,
+    app_config = config["app"]
+    source_config = config[app_config["source"]]
+    target_config = config[app_config["target"]]
+    # A spawned process starts without the log sinks and Sentry client of the parent
+    setup_logging(shard_log_file(LOG_FILE, index))
+    init_sentry(config)
+    # Without prefix, the parent adds it when it sends the merged stats
+    Metric.initialize_client(backend="memory", buffer=False)
+    # Only read here, the parent seeded it and adds the done ids of all shards
+    done_store = open_done_store(app_config, source_config)
+    high_water_marks = None
+    if app_config.get("high_water_marks"):
+        high_water_marks = HighWaterMarks(app_config["high_water_marks"])
+    source = create_source(
+        source_config,
+        config["databases"],
+        done_store=done_store,
+        high_water_marks=high_water_marks,
+        incremental=not full_resync,
+        shard=(index, shards),
     )
-    logger.add(
-        EventHandler(level=ERROR),
-        diagnose=True,
-        level=ERROR,
+    already_done_out = target_config["already_done_out"]
+    http = dict(target_config.get("http") or {})
+    if http.get("rate_limit") is not False:
+        # The shards share the limits of 30MHz
+        http["rate_limit"] = shard_rate_limit(http.get("rate_limit") or {}, shards)
+    target = create_target(
+        target_config,
+        already_done_out=shard_path(already_done_out, index),
+        setup_lock=f"{already_done_out}.lock",
+        http=http,
     )
+    synchronization = sync_source_to_target(
+        source,
+        target,
+        chunk_size=app_config.get("chunk_size", None),
+        workers=app_config.get("pipeline_workers", None),
+    )
+    return {
+        "stats": Metric.client().stats,
+        "seen_marks": source.seen_marks,
+        "failed_relations": set(target.failed_relations),
+        "failed_partitions": set(synchronization.failed_partitions),
+    }
+
+
+def do_sharded_sync(config, shards, full_resync=False):
+    """
+    Runs do_sync as shards processes that each sync the relations of which the hash of the relationId falls in
+    their shard, see run_shard. The done ids, stats and high water marks of the shards are merged into those of
+    a single run; the marks don't advance when a shard failed. The rate limit of the target is split over the
+    shards, see shard_rate_limit.
+    """
+    app_config = config["app"]
+    source_config = config[app_config["source"]]
+    target_config = config[app_config["target"]]
+    already_done_out = target_config["already_done_out"]
+    # Seeded before the shards start, so they don't all seed it
+    done_store = open_done_store(app_config, source_config)
+    logger.info(f"Syncing in {shards} shards")
+    results = []
+    errors = []
+    with ProcessPoolExecutor(
+            max_workers=shards, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(run_shard, config, index, shards, full_resync)
+            for index in range(shards)
+        ]
+        for index, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Shard {index} failed: {e!r}")
+                errors.append(e)
+    ids = merge_done_files(
+        [shard_path(already_done_out, index) for index in range(shards)], already_done_out
+    )
+    if os.path.exists(f"{already_done_out}.lock"):
+        os.remove(f"{already_done_out}.lock")
+    if done_store is not None:
+        done_store.add_many(ids)
+    with Metric.client().pipeline() as pipe:
+        send_stats(pipe, merge_stats(result["stats"] for result in results))
+    if app_config.get("high_water_marks") and not errors:
+        seen_marks = {}
+        failed_relations = set()
+        failed_partitions = set()
+        for result in results:
+            seen_marks.update(result["seen_marks"])
+            failed_relations |= result["failed_relations"]
+            failed_partitions |= result["failed_partitions"]
+        advance_high_water_marks(
+            HighWaterMarks(app_config["high_water_marks"]),
+            seen_marks,
+            failed_relations,
+            failed_partitions,
+        )
+    already_done_sync(
+        source_config["already_done_in"],
+        already_done_out,
+        append=done_store is None,
+    )
+    if errors:
+        raise errors[0]
+
 
-    logger.add("app{time}.log", retention="1 week", level=DEBUG)
+def profile_sync(config, profile_file, full_resync=False):
+    """
+    Runs do_sync with tracing and cProfile, writes the profile to profile_file and prints the time per stage.
+    """
+    tracer = Tracer.get()
+    tracer.enable()
+    with profiled(profile_file):
+        do_sync(config, full_resync=full_resync, shards=1)
+    logger.info(f"Profile written to {profile_file}")
+    click.echo(tracer.format_summary())
+    for tag in ("relation", "organization"):
+        click.echo()
+        click.echo(tracer.format_summary(by=tag, limit=PROFILE_TENANTS))
+
+
+@cli.command()
+@click.option("-c", "--config", "config_file")
+@click.option(
+    "--full-resync",
+    is_flag=True,
+    default=False,
+    help="Read all samples, ignoring the high water marks of earlier runs.",
+)
+@click.option(
+    "--profile",
+    "profile_file",
+    default=None,
+    help="Write a cProfile dump of the run to this file and print the time spent per stage.",
+)
+@click.option(
+    "--shards",
+    type=int,
+    default=None,
+    help="Split the relations over this many processes, that share the configured rate limit.",
+)
+def sync(config_file, full_resync, profile_file, shards):
+    """
+    This command synchronizes the Eurofins sample data with the 30MHz data.
+    """
+    setup_logging()
     logger.info("STARTING")
     logger.info("Reading config file")
+    if profile_file is not None and (shards or 1) > 1:
+        raise click.UsageError("--profile only profiles a single process, it can't be used with --shards")
     config = parse_config(config_file)
-    sentry_sdk.init(
-        config['sentry']['url'],
-        traces_sample_rate=1.0
-    )
+    init_sentry(config)
     logger.info("Initializing statsd client")
     Metric.initialize_client(**config["statsd"])
     Metric.client().incr(constants.STATS_APP_START)
     logger.info("Syncing")
-    with Metric.client().timer(constants.STATS_APP_RUNTIME):
-        do_sync(config)
+    try:
+        with Metric.client().timer(constants.STATS_APP_RUNTIME):
+            if profile_file is None:
+                do_sync(config, full_resync=full_resync, shards=shards)
+            else:
+                profile_sync(config, profile_file, full_resync=full_resync)
+    finally:
+        Metric.flush()
     logger.info("______________________________________________________")
+
+
+@cli.command()
+@click.option("-c", "--config", "config_file")
+def compact(config_file):
+    """
+    This command compacts the done store.
+    """
+    config = parse_config(config_file)
+    app_config = config["app"]
+    done_store = open_done_store(app_config, config[app_config["source"]])
+    if done_store is None:
+        logger.info("No done store configured")
+        return
+    logger.info(f"Compacting done store with {len(done_store)} ids")
+    done_store.compact()
@@ -6,6 +6,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=["Click", "SQLAlchemy", "pytest", "sentry-sdk"],
+    extras_require={"parquet": ["pyarrow"], "async": ["aiohttp>=3.12"]},
     entry_points="""
         [console_scripts]
         efa_30mhz=scripts.sync:cli
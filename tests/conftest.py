@@ -0,0 +1,9 @@
+import pytest
+
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+
+
+@pytest.fixture
+def simulator():
+    with ThirtyMHzSimulator(seed=1) as simulator:
+        yield simulator
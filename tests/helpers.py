@@ -0,0 +1,187 @@
+"""
+Helpers shared by the tests: rows and targets for the 30MHz simulator, lazy files that count how many of them are
+open, and fake requests sessions.
+"""
+import io
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from efa_30mhz.files import LazyFile
+from efa_30mhz.thirty_mhz import ThirtyMHzTarget
+
+
+def rows(n, organization="tenant", api_key="tenant-key"):
+    sample_date = datetime.now(pytz.utc) - timedelta(days=1)
+    sensor_types = [
+        {
+            "id": "210_v1",
+            "name": "Bemesting",
+            "schema": {
+                "file": {"name": "File", "type": "string"},
+                "research_number": {"name": "Onderzoeksnummer", "type": "string"},
+                "N": {"name": "Stikstof", "type": "double", "metric": "ph"},
+            },
+            "api_key": api_key,
+            "organization_id": organization,
+        }
+    ]
+    import_checks = [
+        {"id": "object - 210_v1", "name": "Object", "sensor_type": "210_v1", "api_key": api_key, "organization_id": organization}
+    ]
+    ingests = [
+        {
+            "id": "object - 210_v1",
+            "order_id": i,
+            "relation_id": 1,
+            "data": [
+                {
+                    "N": float(i),
+                    "datetime": sample_date + timedelta(minutes=i),
+                    "research_number": f"R{i}",
+                    "order_sample_data_id": i,
+                    "sample_description": "Object",
+                    "file": io.BytesIO(b"%PDF-1.4"),
+                }
+            ],
+            "api_key": api_key,
+            "organization_id": organization,
+        }
+        for i in range(n)
+    ]
+    return sensor_types, import_checks, ingests, [i["order_id"] for i in ingests]
+
+
+def target(simulator, tmp_path, **kwargs):
+    return ThirtyMHzTarget(
+        "default-key",
+        "default",
+        str(tmp_path / "done"),
+        api_url=simulator.url,
+        http={"backoff_factor": 0},
+        **kwargs,
+    )
+
+
+class CountingLoader:
+    """
+    Loader of CountedFiles that keeps track of how many of its files are open, its files are fetched as they are opened.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.max_open = 0
+
+    def file(self):
+        with self.lock:
+            self.open += 1
+            self.max_open = max(self.max_open, self.open)
+        return TrackedFile(self)
+
+
+class PrefetchingLoader(CountingLoader):
+    def prefetch(self, files):
+        for f in files:
+            if not f.fetched:
+                f.set_file(self.file())
+
+
+class TrackedFile(io.BytesIO):
+    def __init__(self, loader):
+        super().__init__(b"%PDF-1.4")
+        self.loader = loader
+
+    def close(self):
+        if not self.closed:
+            with self.loader.lock:
+                self.loader.open -= 1
+        super().close()
+
+
+class CountedFile(LazyFile):
+    def fetch(self):
+        return self.loader.file()
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    @property
+    def text(self):
+        return str(self.body)
+
+
+class FakeSession:
+    """
+    requests session of which GETs are answered by respond(). Tracked requests take latency seconds and are kept in
+    urls, with the most that were in flight at once in max_in_flight.
+    """
+
+    latency = 0.02
+
+    def __init__(self):
+        self.urls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None):
+        if not self.tracked(url):
+            return self.respond(url)
+        with self.lock:
+            self.urls.append(url)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return self.respond(url)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def tracked(self, url) -> bool:
+        return True
+
+    def respond(self, url) -> FakeResponse:
+        raise NotImplementedError
+
+
+class FakeStatsSession(FakeSession):
+    """
+    Session of an organization with the import checks `checks`. The stats of a window of an import check are
+    answered by stats(), or with a 500 when it returns None. Only the stats calls are tracked, their windows are kept
+    in windows.
+    """
+
+    def __init__(self, checks):
+        super(FakeStatsSession, self).__init__()
+        self.checks = list(checks)
+        self.windows = []
+
+    def tracked(self, url) -> bool:
+        return "/import-check/" not in url
+
+    def respond(self, url) -> FakeResponse:
+        if "/import-check/" in url:
+            return FakeResponse(
+                200, [{"checkId": c, "sensorType": "type", "name": f"Check {c}"} for c in self.checks]
+            )
+        check, from_date, end_date = re.search(r"/check/(.+)/from/(.+)/until/(.+)$", url).groups()
+        with self.lock:
+            self.windows.append((from_date, end_date))
+        stats = self.stats(check, from_date, end_date)
+        if stats is None:
+            return FakeResponse(500, {"error": "unavailable"})
+        return FakeResponse(200, stats)
+
+    def stats(self, check, from_date, end_date):
+        raise NotImplementedError
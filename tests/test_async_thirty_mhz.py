@@ -0,0 +1,176 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from efa_30mhz.async_thirty_mhz import AsyncThirtyMHzGetter, AsyncImportCheck
+from efa_30mhz.metrics import Metric
+from efa_30mhz.rate_limit import TokenBucket
+from efa_30mhz.thirty_mhz import ThirtyMHzError
+from tests.helpers import CountedFile, CountingLoader, rows, target
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_endpoints(simulator):
+    sensor_types, import_checks, ingests, _ = rows(3)
+    [sensor_type] = sensor_types
+    [import_check] = import_checks
+
+    async def run():
+        async with AsyncThirtyMHzGetter("default-key", "default", api_url=simulator.url) as getter:
+            tmz = getter.get_by_api_key("tenant-key", "tenant")
+            assert isinstance(tmz.import_check, AsyncImportCheck)
+            assert not await tmz.sensor_type.exists(id="210_v1")
+            await tmz.sensor_type.create(**{k: sensor_type[k] for k in ("id", "name", "schema")})
+            created = await tmz.sensor_type.get(id="210_v1")
+            await tmz.import_check.create(id=import_check["id"], name=import_check["name"], sensor_type=created)
+            check = await tmz.import_check.get(id=import_check["id"])
+            done = await tmz.import_check.ingest_batch(
+                [(i["order_id"], check, i["data"]) for i in ingests], max_events=2
+            )
+            [extra] = rows(1)[2]
+            await tmz.import_check.ingest(check, extra["data"])
+            return done, check
+
+    done, check = asyncio.run(run())
+    assert done == [0, 1, 2]
+    assert len(simulator.events[check["checkId"]]) == 4
+    assert simulator.uploads == 4
+
+
+@pytest.mark.parametrize("ingest_batch", [None, {"max_events": 5}])
+def test_target_ingests_async(simulator, tmp_path, ingest_batch):
+    t = target(simulator, tmp_path, asynchronous={"in_flight": 50, "per_organization": 10}, ingest_batch=ingest_batch)
+    t.write(rows(30))
+    [import_check] = simulator.import_checks["tenant"]
+    assert len(simulator.events[import_check["checkId"]]) == 30
+    assert simulator.uploads == 30
+    with open(tmp_path / "done") as f:
+        assert f.read() == "\n".join(map(str, range(30)))
+
+
+def test_async_ingest_failures(simulator, tmp_path):
+    t = target(simulator, tmp_path, asynchronous={})
+    sensor_types, import_checks, ingests, _ = rows(3)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    simulator.error_rate = 1.0
+    t.get_remote_index("tenant-key", "tenant").ids = set()
+    assert t.write_ingests(ingests) == []
+    assert t.failed_relations == {1}
+
+
+def test_async_partly_failed_batch_is_stored_once(simulator, tmp_path):
+    t = target(simulator, tmp_path)
+    sensor_types, import_checks, ingests, _ = rows(5)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+
+    async def run():
+        async with AsyncThirtyMHzGetter("default-key", "default", api_url=simulator.url) as getter:
+            tmz = getter.get(import_checks[0])
+            check = await tmz.import_check.get(id=import_checks[0]["id"])
+            items = [(i["order_id"], check, i["data"]) for i in ingests[:4]]
+            items.append((4, {"checkId": "unknown"}, ingests[4]["data"]))
+            return await tmz.import_check.ingest_batch(items, max_events=10), check
+
+    done, check = asyncio.run(run())
+    assert done == []
+    assert len(simulator.events[check["checkId"]]) == 4
+
+
+def test_async_retries_only_get_on_server_error(simulator):
+    simulator.error_rate = 1.0
+
+    async def run():
+        async with AsyncThirtyMHzGetter(
+                "default-key", "default", api_url=simulator.url, http={"retries": 2, "backoff_factor": 0}
+        ) as getter:
+            tmz = getter.get_default()
+            with pytest.raises(ThirtyMHzError):
+                await tmz.get("sensor-type")
+            with pytest.raises(ThirtyMHzError):
+                await tmz.post("ingest", [])
+
+    asyncio.run(run())
+    assert sum(n for (method, _), n in simulator.requests.items() if method == "GET") == 3
+    assert sum(n for (method, _), n in simulator.requests.items() if method == "POST") == 1
+
+
+def test_async_failed_batch_is_not_sent_again(simulator, tmp_path):
+    t = target(simulator, tmp_path)
+    sensor_types, import_checks, ingests, _ = rows(3)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+
+    async def run():
+        async with AsyncThirtyMHzGetter(
+                "default-key", "default", api_url=simulator.url, http={"backoff_factor": 0}
+        ) as getter:
+            tmz = getter.get(import_checks[0])
+            check = await tmz.import_check.get(id=import_checks[0]["id"])
+            items = [(i["order_id"], check, [dict(i["data"][0], file="upload")]) for i in ingests]
+            simulator.error_rate = 1.0
+            return await tmz.import_check.ingest_batch(items, max_events=10)
+
+    assert asyncio.run(run()) == []
+    assert sum(n for (method, route), n in simulator.requests.items() if method == "POST" and "ingest" in route) == 1
+
+
+def test_async_batch_reads_at_most_in_flight_files(simulator, tmp_path):
+    simulator.latency = 0.01
+    loader = CountingLoader()
+    sensor_types, import_checks, ingests, _ = rows(40)
+    for ingest in ingests:
+        ingest["data"][0]["file"] = CountedFile(loader)
+    t = target(simulator, tmp_path, asynchronous={"in_flight": 4}, ingest_batch={"max_events": 50})
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    t.get_remote_index("tenant-key", "tenant").ids = set()
+
+    assert len(t.write_ingests(ingests)) == 40
+    assert simulator.uploads == 40
+    assert loader.max_open <= 4
+    assert loader.open == 0
+
+
+@pytest.mark.parametrize("ingest_batch", [None, {"max_events": 10}])
+def test_async_windows_share_one_session(simulator, tmp_path, monkeypatch, ingest_batch):
+    sessions = []
+    client_session = aiohttp.ClientSession
+
+    def counting_session(*args, **kwargs):
+        sessions.append(client_session(*args, **kwargs))
+        return sessions[-1]
+
+    monkeypatch.setattr(aiohttp, "ClientSession", counting_session)
+    t = target(simulator, tmp_path, asynchronous={"in_flight": 4}, ingest_batch=ingest_batch, prefetch_window=10)
+    sensor_types, import_checks, ingests, _ = rows(45)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    t.get_remote_index("tenant-key", "tenant").ids = set()
+
+    assert len(t.get_windows(ingests)) == 5
+    assert len(t.write_ingests(ingests)) == 45
+    assert len(sessions) == 1
+
+
+def test_async_failed_connections_dont_raise_the_rate():
+    bucket = TokenBucket(rate=10, burst=10)
+
+    async def run():
+        # Nothing listens on port 1
+        async with AsyncThirtyMHzGetter(
+                "default-key", "default", api_url="http://127.0.0.1:1/api", http={"retries": 2, "backoff_factor": 0}
+        ) as getter:
+            tmz = getter.get_default()
+            tmz.rate_limit = bucket
+            with pytest.raises(ThirtyMHzError):
+                await tmz.get("sensor-type")
+
+    asyncio.run(run())
+    assert bucket.rate == 10
@@ -0,0 +1,53 @@
+from efa_30mhz.metrics import Metric
+from efa_30mhz.thirty_mhz import ThirtyMHz
+
+
+class CountingThirtyMHz(ThirtyMHz):
+    def __init__(self, listings, **kwargs):
+        super().__init__("key", "org", **kwargs)
+        self.listings = listings
+        self.gets = []
+
+    def get(self, base_url, organization=True):
+        self.gets.append(base_url)
+        return list(self.listings[base_url])
+
+    def post(self, base_url, data=None, files=None, organization=True):
+        item = dict(data)
+        self.listings[base_url].append(item)
+        return item
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_listing_fetched_once():
+    tmz = CountingThirtyMHz(
+        {"import-check": [{"sourceId": str(i), "checkId": i} for i in range(100)]}
+    )
+    for i in range(100):
+        assert tmz.import_check.get(id=i)["checkId"] == i
+    assert not tmz.import_check.exists(id="missing")
+    assert tmz.gets == ["import-check"]
+
+
+def test_create_updates_index():
+    tmz = CountingThirtyMHz({"sensor-type": []})
+    assert not tmz.sensor_type.exists(id="210")
+    tmz.sensor_type.create(id="210", name="210", schema={})
+    assert tmz.sensor_type.get(id=210)["radioId"] == "210"
+    assert tmz.gets == ["sensor-type"]
+
+
+def test_invalidate_and_ttl():
+    tmz = CountingThirtyMHz({"sensor-type": [{"radioId": "1"}]})
+    assert tmz.sensor_type.exists(id="1")
+    tmz.invalidate_cache()
+    assert tmz.sensor_type.exists(id="1")
+    assert len(tmz.gets) == 2
+
+    expired = CountingThirtyMHz({"sensor-type": [{"radioId": "1"}]}, cache_ttl=-1)
+    expired.sensor_type.exists(id="1")
+    expired.sensor_type.exists(id="1")
+    assert len(expired.gets) == 2
@@ -0,0 +1,30 @@
+import pytest
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.pdf import PDF
+from efa_30mhz.simulator.eurofins import EurofinsSimulator, document
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+@pytest.fixture
+def simulator():
+    with EurofinsSimulator(document_size=10000, missing=[("7", "3")]) as simulator:
+        yield simulator
+
+
+def test_get_pdf(simulator):
+    pdf = PDF(simulator.wsdl)
+    assert pdf.get_pdf({"relation_id": 7, "resource_id": 1}).read() == document("7", "1", 10000)
+    assert simulator.calls == 1
+
+
+def test_get_pdfs_matches_resources_by_id(simulator):
+    pdf = PDF(simulator.wsdl, workers=4, resources_per_request=3)
+    files = pdf.get_pdfs({"relation_id": 7, "resource_id": i} for i in range(6))
+    # The call with missing resource 3 is retried per resource
+    assert sorted(files) == [(7, 0), (7, 1), (7, 2), (7, 4), (7, 5)]
+    assert all(files[(7, i)].read() == document("7", str(i), 10000) for i in (0, 1, 2, 4, 5))
+    assert simulator.resources_per_call == {3: 2, 1: 3}
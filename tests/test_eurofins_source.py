@@ -0,0 +1,219 @@
+import json
+
+import pytest
+
+from efa_30mhz.eurofins import EurofinsSource
+from efa_30mhz.metrics import Metric
+from efa_30mhz.store import DoneStore, HighWaterMarks, to_datetime
+from efa_30mhz.sync import Source
+
+
+def raw_row(order_id, relation_id=1, package="210", sample_date="2021-05-01", updated_at=None):
+    return {
+        "orderSampleDataId": order_id,
+        "relationId": relation_id,
+        "resourceId": f"resource-{order_id}",
+        "sampleId": order_id,
+        "sampleCode": f"S{order_id}",
+        "sampleDate": sample_date,
+        "sampleDescription": "Kasgrond",
+        "analysisPackageCode": package,
+        "creationDate": sample_date,
+        "mainCategory": "",
+        "subCategory": "",
+        "resultGroupData": json.dumps(
+            [
+                {
+                    "resultData": [
+                        {
+                            "resultDescription": "pH",
+                            "resultValue": 6.1,
+                            "originCode": "PH",
+                            "resultUnitOfMeasureDescription": "",
+                        }
+                    ]
+                }
+            ]
+        ),
+        "additionalFieldList": json.dumps([{"fieldName": "CDOB", "fieldValue": "object"}]),
+        "createdAt": None,
+        "updatedAt": updated_at,
+    }
+
+
+class ListSource(Source):
+    def __init__(self, rows, **kwargs):
+        super().__init__(**kwargs)
+        self.rows = rows
+        self.pulled = 0
+
+    @staticmethod
+    def to_thirty_mhz(**kwargs):
+        pass
+
+    def read_all(self, *args, **kwargs):
+        return list(self.iter_rows(*args))
+
+    def iter_rows(self, *args, updated_after=None, **kwargs):
+        for row in self.rows:
+            if not args or row["relationId"] == args[0]:
+                if updated_after is None or to_datetime(row["updatedAt"]) > updated_after:
+                    self.pulled += 1
+                    yield row
+
+    def iter_rows_for(self, values, updated_after=None):
+        self.bulk_reads = getattr(self, "bulk_reads", 0) + 1
+        return (
+            row
+            for row in self.rows
+            if row["relationId"] in set(values)
+            and (updated_after is None or to_datetime(row["updatedAt"]) > updated_after)
+        )
+
+
+@pytest.fixture
+def eurofins(tmp_path):
+    Metric.initialize_client(host="localhost", port=8125)
+    already_done = tmp_path / "already_done"
+    already_done.write_text("")
+
+    def create(rows, auth_rows, **kwargs):
+        return EurofinsSource(
+            super_source=ListSource(rows),
+            auth_source=ListSource(auth_rows),
+            already_done_in=str(already_done),
+            package_codes={"210": "Kasgrond"},
+            metrics={"default": "ph"},
+            wsdl=None,
+            schema_version="1",
+            default_api_key="default-key",
+            default_organization="default-org",
+            **kwargs,
+        )
+
+    return create
+
+
+def auth_row(relation_id, api_key=None):
+    return {"relationId": relation_id, "apiKey": api_key, "organisationId": f"org-{relation_id}"}
+
+
+def test_read_single_user_is_lazy(eurofins):
+    source = eurofins([raw_row(i) for i in range(10)], [auth_row(1)])
+    rows = source.read_single_user(auth_row(1))
+    first = next(rows)
+    assert first["order_sample_data_id"] == 0
+    assert source.super_source.pulled == 1
+    assert len(list(rows)) == 9
+
+
+def test_read_all_filters_out_of_scope(eurofins):
+    rows = [raw_row(0), raw_row(1, package="999"), raw_row(2, sample_date="2018-01-01")]
+    source = eurofins(rows, [auth_row(1, api_key="key")])
+    result = source.read_all()
+    assert [r["order_sample_data_id"] for r in result] == [0]
+    assert result[0]["api_key"] == "Bearer key"
+
+
+def test_bulk_read_matches_per_user_read(eurofins):
+    rows = [raw_row(i, relation_id=i % 4) for i in range(20)]
+    auth_rows = [auth_row(0), auth_row(1, api_key="one"), auth_row(2, api_key="two")]
+    per_user = eurofins(rows, auth_rows).read_all()
+    bulk_source = eurofins(rows, auth_rows, bulk_read=True)
+    bulk = bulk_source.read_all()
+    key = lambda r: r["order_sample_data_id"]
+    assert sorted(bulk, key=key) == sorted(per_user, key=key)
+    assert len(bulk) == 15
+    assert bulk_source.super_source.bulk_reads == 1
+
+
+def test_partitions_per_relation(eurofins):
+    rows = [raw_row(i, relation_id=i % 3) for i in range(12)]
+    source = eurofins(rows, [auth_row(0), auth_row(1, api_key="one"), auth_row(2)])
+    partitions = dict(source.iter_partitions())
+    assert list(partitions) == [0, 1, 2]
+    per_partition = {k: [r["order_sample_data_id"] for r in rows()] for k, rows in partitions.items()}
+    assert per_partition[1] == [1, 4, 7, 10]
+    assert sorted(i for ids in per_partition.values() for i in ids) == list(range(12))
+
+
+def test_already_done_rows_are_skipped(eurofins, tmp_path):
+    (tmp_path / "already_done").write_text("1\n3\n")
+    source = eurofins([raw_row(i) for i in range(5)], [auth_row(1)])
+    assert [r["order_sample_data_id"] for r in source.read_all()] == [0, 2, 4]
+
+
+def test_done_store_rows_are_skipped(eurofins, tmp_path):
+    done_store = DoneStore(str(tmp_path / "state.sqlite"))
+    done_store.add_many([0, 4])
+    source = eurofins([raw_row(i) for i in range(5)], [auth_row(1)], done_store=done_store)
+    assert [r["order_sample_data_id"] for r in source.read_all()] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("bulk_read", [False, True])
+def test_incremental_read(eurofins, tmp_path, bulk_read):
+    rows = [
+        raw_row(i, relation_id=i % 2, updated_at=f"2021-05-{i + 1:02d}T12:00:00")
+        for i in range(10)
+    ]
+    auth_rows = [auth_row(0), auth_row(1)]
+    marks = HighWaterMarks(str(tmp_path / "state.sqlite"))
+    marks.advance({0: "2021-05-05T12:00:00", 1: "2021-05-08T12:00:00"})
+    source = eurofins(rows, auth_rows, high_water_marks=marks, bulk_read=bulk_read)
+    assert [r["order_sample_data_id"] for r in source.read_all()] == [6, 8, 9]
+    assert source.seen_marks == {
+        0: to_datetime("2021-05-09T12:00:00"),
+        1: to_datetime("2021-05-10T12:00:00"),
+    }
+
+    full = eurofins(rows, auth_rows, high_water_marks=marks, incremental=False)
+    assert len(full.read_all()) == 10
+
+
+def legacy_to_thirty_mhz(source, rows):
+    sensor_types = []
+    import_checks = []
+    organization_ids = list(dict.fromkeys(r["organization_id"] for r in rows))
+    for organization_id in organization_ids:
+        organization_rows = [r for r in rows if r["organization_id"] == organization_id]
+        sensor_types.extend(
+            source.uniques_schema(map(source.get_sensor_type, organization_rows), id_column="id")
+        )
+        import_checks.extend(
+            source.uniques(map(source.get_import_check, organization_rows), id_column="id")
+        )
+    return sensor_types, import_checks
+
+
+def test_to_thirty_mhz_matches_legacy(eurofins):
+    def with_results(row, n, object_code):
+        row = raw_row(**row)
+        results = [
+            {
+                "resultDescription": f"R{i}",
+                "resultValue": float(i),
+                "originCode": f"C{i}",
+                "resultUnitOfMeasureDescription": "",
+            }
+            for i in range(n)
+        ]
+        row["resultGroupData"] = json.dumps([{"resultData": results}])
+        row["additionalFieldList"] = json.dumps([{"fieldName": "CDOB", "fieldValue": object_code}])
+        return row
+
+    rows = [
+        with_results(
+            {"order_id": i, "relation_id": i % 3, "package": ["210", "310"][i % 2]},
+            n=1 + (i * 7) % 5,
+            object_code=f"object-{i % 4}",
+        )
+        for i in range(40)
+    ]
+    source = eurofins(rows, [auth_row(r, api_key=f"key-{r}") for r in range(3)])
+    source.package_codes["310"] = "Potgrond"
+    cleaned = source.read_all()
+    sensor_types, import_checks, ingests, ids = source.to_thirty_mhz(cleaned)
+    assert (sensor_types, import_checks) == legacy_to_thirty_mhz(source, cleaned)
+    assert ids == [r["order_sample_data_id"] for r in cleaned]
+    assert [i["order_id"] for i in ingests] == ids
+    assert {len(s["schema"]) for s in sensor_types} == {7}
@@ -0,0 +1,181 @@
+import json
+import os
+
+import pytest
+import yaml
+from click.testing import CliRunner
+from loguru import logger
+
+import efa_30mhz.constants as cst
+import scripts.sync
+from benchmarks.bench_sync import create_config
+from benchmarks.synthetic import auth_rows, eurofins_rows
+from efa_30mhz.metrics import Metric
+from efa_30mhz.simulator.eurofins import EurofinsSimulator
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from efa_30mhz.store import HighWaterMarks, to_datetime
+from efa_30mhz.thirty_mhz import ThirtyMHzTarget
+from scripts.sync import cli, do_sync
+
+RELATIONS = 4
+OPTIONS = {
+    "ingest_batch": True,
+    "workers": 2,
+    "in_flight": None,
+    "chunk_size": None,
+    "pipeline_workers": None,
+    "shards": None,
+}
+
+
+class FailingThirtyMHz(ThirtyMHzSimulator):
+    """
+    30MHz stand-in that fails the ingests of the organizations in failing, and only stores the first event of the
+    ingests of the organizations in partly_storing.
+    """
+
+    def __init__(self, **kwargs):
+        super(FailingThirtyMHz, self).__init__(**kwargs)
+        self.failing = set()
+        self.partly_storing = set()
+        # Number of events of every ingest of partly_storing
+        self.partly_stored = []
+
+    def ingest(self, organization, body):
+        if organization in self.failing:
+            return 500, {"error": "Simulated error"}
+        if organization in self.partly_storing:
+            events = json.loads(body)
+            self.partly_stored.append(len(events))
+            status, result = super(FailingThirtyMHz, self).ingest(organization, json.dumps(events[:1]))
+            return status, dict(result, failedEventsNo=len(events) - result["okEventsNo"])
+        return super(FailingThirtyMHz, self).ingest(organization, body)
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def teardown_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    directory = str(tmp_path)
+    with open(os.path.join(directory, "samples.json"), "w") as f:
+        json.dump(eurofins_rows(60, relations=RELATIONS), f)
+    with open(os.path.join(directory, "auth.json"), "w") as f:
+        json.dump(auth_rows(RELATIONS, without_api_key=1), f)
+    open(os.path.join(directory, "already_done_in"), "w").close()
+    return directory
+
+
+@pytest.fixture
+def thirty_mhz():
+    with FailingThirtyMHz() as thirty_mhz:
+        yield thirty_mhz
+
+
+def sync(directory, thirty_mhz, full_resync=False, **options):
+    """
+    Syncs the synthetic rows of directory with high water marks.
+    :return: the stored marks and the stats of the run
+    """
+    Metric.initialize_client(backend="memory", buffer=False)
+    with EurofinsSimulator(document_size=64) as eurofins:
+        config = create_config(
+            directory,
+            os.path.join(directory, "samples.json"),
+            os.path.join(directory, "auth.json"),
+            thirty_mhz.url,
+            eurofins.wsdl,
+            dict(OPTIONS, **options),
+        )
+        config["app"]["high_water_marks"] = os.path.join(directory, "marks.sqlite")
+        do_sync(config, full_resync=full_resync)
+    return HighWaterMarks(config["app"]["high_water_marks"]).get_all(), Metric.client()
+
+
+def newest(directory):
+    """
+    The updatedAt of the newest row of every relation, the marks of a run without failures.
+    """
+    with open(os.path.join(directory, "samples.json")) as f:
+        rows = json.load(f)
+    marks = {}
+    for row in rows:
+        relation_id, updated = str(row["relationId"]), to_datetime(row["updatedAt"])
+        marks[relation_id] = max(marks.get(relation_id, updated), updated)
+    return marks
+
+
+def found(stats) -> float:
+    return sum(float(value.split("|")[0]) for value in stats.values(cst.STATS_SOURCE_SAMPLES))
+
+
+def test_marks_advance_for_every_synced_relation(directory, thirty_mhz):
+    marks, _ = sync(directory, thirty_mhz)
+    assert marks == newest(directory)
+
+    # Nothing newer than the marks
+    marks, stats = sync(directory, thirty_mhz)
+    assert marks == newest(directory)
+    assert found(stats) == 0
+
+
+def test_failed_ingest_keeps_mark(directory, thirty_mhz):
+    thirty_mhz.failing = {"organization-1002"}
+    marks, _ = sync(directory, thirty_mhz)
+    expected = newest(directory)
+    assert set(marks) == set(expected) - {"1002"}
+    assert marks == {relation_id: expected[relation_id] for relation_id in marks}
+
+    # The next run reads the failed relation again and catches up
+    thirty_mhz.failing = set()
+    marks, _ = sync(directory, thirty_mhz)
+    assert marks == expected
+
+
+def test_partly_stored_chunk_keeps_mark(directory, thirty_mhz):
+    thirty_mhz.partly_storing = {"organization-1003"}
+    marks, _ = sync(directory, thirty_mhz)
+    assert set(marks) == set(newest(directory)) - {"1003"}
+    # The chunk was stored in part and its orders were not sent again one by one
+    assert thirty_mhz.partly_stored and min(thirty_mhz.partly_stored) > 1
+
+
+def test_failed_partition_keeps_mark(directory, thirty_mhz, monkeypatch):
+    write_chunk = ThirtyMHzTarget.write_chunk
+
+    def failing_write(self, rows):
+        # The rows of the partition are read, so their marks are seen
+        if any(i["relation_id"] == 1001 for i in rows[2]):
+            raise RuntimeError("Simulated write error")
+        return write_chunk(self, rows)
+
+    monkeypatch.setattr(ThirtyMHzTarget, "write_chunk", failing_write)
+    marks, _ = sync(directory, thirty_mhz, pipeline_workers=2)
+    assert set(marks) == set(newest(directory)) - {"1001"}
+
+
+def test_full_resync_reads_rows_below_marks(directory, thirty_mhz):
+    sync(directory, thirty_mhz)
+    marks, stats = sync(directory, thirty_mhz, full_resync=True)
+    assert found(stats) == 60
+    assert marks == newest(directory)
+
+
+@pytest.mark.parametrize("arguments, full_resync", [([], False), (["--full-resync"], True)])
+def test_cli_full_resync_flag(tmp_path, monkeypatch, arguments, full_resync):
+    calls = []
+    monkeypatch.setattr(scripts.sync, "do_sync", lambda config, **kwargs: calls.append(kwargs))
+    # The log sinks of the command would outlive the test
+    monkeypatch.setattr(logger, "add", lambda *args, **kwargs: None)
+    monkeypatch.chdir(tmp_path)
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.dump({"sentry": {"url": None}, "statsd": {"backend": "memory"}}))
+
+    result = CliRunner().invoke(cli, ["sync", "-c", str(config_file), *arguments], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert calls == [{"full_resync": full_resync, "shards": None}]
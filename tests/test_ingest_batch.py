@@ -0,0 +1,88 @@
+from datetime import datetime
+
+from efa_30mhz.metrics import Metric
+import pytest
+
+from efa_30mhz.thirty_mhz import ThirtyMHz, ThirtyMHzError
+
+
+class IngestThirtyMHz(ThirtyMHz):
+    def __init__(self, error=None):
+        """
+        :param error: ThirtyMHzError every request with more than one order fails with
+        """
+        super().__init__("key", "org")
+        self.error = error
+        self.posts = []
+        self.stored = []
+
+    def post(self, base_url, data=None, files=None, organization=True):
+        self.posts.append(data)
+        if self.error is not None and len(data) > 1:
+            raise self.error
+        if any(event["data"].get("reject") for event in data):
+            return {"okEventsNo": 0, "failedEventsNo": len(data)}
+        failed = [event for event in data if event["data"].get("bad")]
+        self.stored.extend(event for event in data if not event["data"].get("bad"))
+        return {"okEventsNo": len(data) - len(failed), "failedEventsNo": len(failed)}
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def items(n, bad=(), reject=()):
+    return [
+        (
+            order_id,
+            {"checkId": f"check-{order_id % 3}"},
+            [{"datetime": datetime(2021, 1, 1), "value": order_id, "bad": order_id in bad, "reject": order_id in reject}],
+        )
+        for order_id in range(n)
+    ]
+
+
+def test_ingest_batch_chunks_by_events():
+    tmz = IngestThirtyMHz()
+    done = tmz.import_check.ingest_batch(items(10), max_events=4)
+    assert done == list(range(10))
+    assert [len(p) for p in tmz.posts] == [4, 4, 2]
+    assert {e["checkId"] for e in tmz.posts[0]} == {"check-0", "check-1", "check-2"}
+
+
+def test_ingest_batch_chunks_by_bytes():
+    tmz = IngestThirtyMHz()
+    done = tmz.import_check.ingest_batch(items(10), max_bytes=300)
+    assert done == list(range(10))
+    assert len(tmz.posts) > 1
+    assert sum(len(p) for p in tmz.posts) == 10
+
+
+def test_ingest_batch_maps_failures_to_orders():
+    tmz = IngestThirtyMHz()
+    done = tmz.import_check.ingest_batch(items(8, reject={2, 5}), max_events=4)
+    assert done == [0, 1, 3, 4, 6, 7]
+    assert sorted(e["data"]["value"] for e in tmz.stored) == [0, 1, 3, 4, 6, 7]
+
+
+def test_ingest_batch_does_not_resend_partly_stored_chunks():
+    tmz = IngestThirtyMHz()
+    done = tmz.import_check.ingest_batch(items(5, bad={4}), max_events=10)
+    assert done == []
+    assert len(tmz.posts) == 1
+    assert len(tmz.stored) == 4
+
+
+@pytest.mark.parametrize("status_code", [500, 504, None])
+def test_ingest_batch_does_not_resend_chunks_that_may_be_stored(status_code):
+    tmz = IngestThirtyMHz(error=ThirtyMHzError("Failed", status_code))
+    done = tmz.import_check.ingest_batch(items(3), max_events=10)
+    assert done == []
+    assert len(tmz.posts) == 1
+
+
+def test_ingest_batch_resends_rejected_chunks():
+    tmz = IngestThirtyMHz(error=ThirtyMHzError("Failed", 400))
+    done = tmz.import_check.ingest_batch(items(3), max_events=10)
+    assert done == [0, 1, 2]
+    assert [len(p) for p in tmz.posts] == [3, 1, 1, 1]
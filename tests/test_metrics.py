@@ -0,0 +1,96 @@
+import socket
+import time
+
+import pytest
+
+from efa_30mhz.metrics import (
+    BufferedStatsClient,
+    MemoryStatsClient,
+    Metric,
+    NullStatsClient,
+    create_client,
+)
+
+
+def test_aggregates_until_flush():
+    memory = MemoryStatsClient(prefix="efa")
+    client = BufferedStatsClient(memory, flush_interval=60)
+    for _ in range(10):
+        client.incr("ingests")
+    client.gauge("todo", 5)
+    client.gauge("todo", 3)
+    client.set("done", 1)
+    client.set("done", 1)
+    client.set("done", 2)
+    client.timing("time", 12)
+    assert memory.stats == []
+
+    client.flush()
+    assert memory.values("efa.ingests") == ["10|c"]
+    assert memory.values("efa.todo") == ["3|g"]
+    assert sorted(memory.values("efa.done")) == ["1|s", "2|s"]
+    assert memory.values("efa.time") == ["12.000000|ms"]
+
+
+def test_flushes_on_size():
+    memory = MemoryStatsClient()
+    client = BufferedStatsClient(memory, max_stats=5, flush_interval=60, aggregate=False)
+    for _ in range(4):
+        client.incr("ingests")
+    assert memory.count("ingests") == 0
+    client.incr("ingests")
+    assert memory.count("ingests") == 5
+
+
+def test_flushes_on_interval():
+    memory = MemoryStatsClient()
+    client = BufferedStatsClient(memory, flush_interval=0.01)
+    client.incr("ingests")
+    time.sleep(0.02)
+    client.incr("ingests")
+    assert memory.count("ingests") == 2
+
+
+def test_negative_gauge_and_pipeline():
+    memory = MemoryStatsClient()
+    client = BufferedStatsClient(memory, flush_interval=60)
+    client.gauge("level", -2)
+    with client.pipeline() as pipe:
+        pipe.set("done", 1)
+        pipe.set("done", 2)
+    client.flush()
+    assert memory.values("level") == ["0|g", "-2|g"]
+    assert memory.values("done") == ["1|s", "2|s"]
+
+
+def test_udp_packets_are_packed():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(1)
+    client = create_client(host="127.0.0.1", port=server.getsockname()[1], buffer={"flush_interval": 60})
+    for i in range(20):
+        client.set("done", i)
+    client.flush()
+    packet = server.recv(65535).decode()
+    assert len(packet.split("\n")) == 20
+    server.close()
+
+
+def test_backends():
+    assert isinstance(create_client(backend="null"), NullStatsClient)
+    assert isinstance(create_client(backend="memory"), MemoryStatsClient)
+    assert isinstance(create_client(backend="memory", buffer=True), BufferedStatsClient)
+    assert isinstance(create_client(host="localhost", port=8125), BufferedStatsClient)
+    assert not isinstance(create_client(host="localhost", port=8125, buffer=False), BufferedStatsClient)
+    with pytest.raises(ValueError):
+        create_client(backend="tcp")
+    NullStatsClient().incr("ingests")
+
+
+def test_metric_reinitialize():
+    Metric.initialize_client(backend="memory")
+    Metric.client().incr("ingests")
+    assert Metric.client().count("ingests") == 1
+    Metric.initialize_client(backend="null")
+    assert isinstance(Metric.client(), NullStatsClient)
+    Metric.initialize_client(host="localhost", port=8125)
@@ -0,0 +1,85 @@
+import threading
+
+from efa_30mhz.mssql import MSSQLSource
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetches = []
+        self.query = None
+        self.closed = False
+
+    def execute(self, query, params=None):
+        self.query = query
+        self.params = params
+
+    def fetchmany(self, size):
+        self.fetches.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cursors = []
+        self.rows = rows
+
+    def cursor(self, as_dict=False):
+        assert as_dict
+        self.cursors.append(FakeCursor(list(self.rows)))
+        return self.cursors[-1]
+
+
+def source(rows, **kwargs):
+    src = MSSQLSource.__new__(MSSQLSource)
+    src.conn = FakeConnection(rows)
+    src.local = threading.local()
+    src.local.conn = src.conn
+    src.table = kwargs.get("table")
+    src.query = kwargs.get("query")
+    src.batch_size = kwargs.get("batch_size", 2)
+    return src
+
+
+def test_iter_rows_fetches_in_batches():
+    src = source([{"id": i} for i in range(5)], query="SELECT * FROM s WHERE relationId = {}")
+    rows = src.iter_rows(42)
+    assert next(rows) == {"id": 0}
+    cursor = src.conn.cursors[0]
+    assert cursor.query == "SELECT * FROM s WHERE relationId = 42"
+    assert cursor.fetches == [2]
+    assert list(rows) == [{"id": i} for i in range(1, 5)]
+    assert cursor.fetches == [2, 2, 2, 2]
+    assert cursor.closed
+
+
+def test_iter_rows_for_is_parameterized_and_chunked():
+    src = source([{"id": 1}], table="samples")
+    src.bulk_query = "SELECT * FROM samples WHERE code LIKE 'A%'"
+    src.bulk_column = "relationId"
+    src.bulk_chunk_size = 2
+    assert list(src.iter_rows_for([1, 2, 3])) == [{"id": 1}, {"id": 1}]
+    first, second = src.conn.cursors
+    assert first.query == (
+        "SELECT * FROM (SELECT * FROM samples WHERE code LIKE 'A%%') AS bulk "
+        "WHERE bulk.relationId IN (%s, %s)"
+    )
+    assert first.params == (1, 2)
+    assert second.query.endswith("IN (%s)")
+    assert second.params == (3,)
+
+
+def test_iter_rows_updated_after():
+    src = source([{"id": 1}], query="SELECT * FROM s WHERE relationId = {} AND code LIKE 'A%'")
+    src.updated_column = "updatedAt"
+    assert list(src.iter_rows(42, updated_after="2021-01-01")) == [{"id": 1}]
+    cursor = src.conn.cursors[0]
+    assert cursor.query == (
+        "SELECT * FROM (SELECT * FROM s WHERE relationId = 42 AND code LIKE 'A%%') AS incremental "
+        "WHERE (incremental.updatedAt > %s OR incremental.updatedAt IS NULL)"
+    )
+    assert cursor.params == ("2021-01-01",)
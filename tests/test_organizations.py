@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+import requests
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.thirty_mhz import OrganizationCache, ThirtyMHz, ThirtyMHzError, ThirtyMHzTarget
+from tests.helpers import FakeResponse, FakeSession
+
+
+class OrganizationSession(FakeSession):
+    def __init__(self, existing, unavailable=(), unreachable=(), forbidden=()):
+        """
+        :param unavailable: organizations that get a 503
+        :param unreachable: organizations of which the request raises a ConnectionError
+        :param forbidden: organizations that get a 403, like for an api key that can't see them
+        """
+        super(OrganizationSession, self).__init__()
+        self.existing = existing
+        self.unavailable = set(unavailable)
+        self.unreachable = set(unreachable)
+        self.forbidden = set(forbidden)
+
+    def respond(self, url):
+        organization = url.rsplit("/", 1)[-1]
+        if organization in self.unreachable:
+            raise requests.ConnectionError("unreachable")
+        if organization in self.unavailable:
+            return FakeResponse(503, {"error": "unavailable"})
+        if organization in self.forbidden:
+            return FakeResponse(403, {"error": "forbidden"})
+        if organization in self.existing:
+            return FakeResponse(200, {"id": organization})
+        return FakeResponse(404, {"error": "not found"})
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_prefetch_fetches_distinct_organizations_concurrently():
+    session = OrganizationSession(existing={"a", "b"})
+    organizations = OrganizationCache(ThirtyMHz("key", "a", session=session), workers=4)
+    organizations.prefetch(["a", "b", "c", "a", "b", "d"])
+    assert len(session.urls) == 4
+    assert session.max_in_flight > 1
+    assert organizations.get("a") == {"id": "a"}
+    assert organizations.exists("b")
+    assert not organizations.exists("c")
+    organizations.prefetch(["a", "c"])
+    assert len(session.urls) == 4
+
+
+def test_failures_are_not_cached_as_missing():
+    session = OrganizationSession(existing={"a", "b", "c", "d"}, unavailable={"b"}, unreachable={"c"}, forbidden={"d"})
+    organizations = OrganizationCache(ThirtyMHz("key", "a", session=session), workers=4)
+    organizations.prefetch(["a", "b", "c", "d"])
+    assert organizations.metadata == {"a": {"id": "a"}}
+    with pytest.raises(ThirtyMHzError):
+        organizations.exists("b")
+    with pytest.raises(ThirtyMHzError):
+        organizations.exists("c")
+    with pytest.raises(ThirtyMHzError) as e:
+        organizations.exists("d")
+    assert e.value.status_code == 403
+    session.unavailable = session.unreachable = session.forbidden = set()
+    assert organizations.exists("b") and organizations.exists("c") and organizations.exists("d")
+
+
+def ingest(order_id, organization, days_ago):
+    timestamp = datetime.now(pytz.utc) - timedelta(days=days_ago)
+    return {
+        "id": "check",
+        "order_id": order_id,
+        "organization_id": organization,
+        "data": [{"datetime": timestamp, "order_sample_data_id": order_id}],
+    }
+
+
+def test_recent_filter_per_organization(tmp_path):
+    target = ThirtyMHzTarget("key", "existing", str(tmp_path / "done"))
+    target.organizations.tmz.session = OrganizationSession(existing={"existing"})
+    ingests = [
+        ingest(1, "existing", 1),
+        ingest(2, "existing", 30),
+        ingest(3, "new", 1),
+        ingest(4, "new", 30),
+    ]
+    target.organizations.prefetch(i["organization_id"] for i in ingests)
+    assert [i["order_id"] for i in target.filter_recent(ingests)] == [1, 3, 4]
+    assert len(target.organizations.tmz.session.urls) == 2
+
+
+def test_recent_filter_drops_organizations_that_failed(tmp_path):
+    target = ThirtyMHzTarget("key", "existing", str(tmp_path / "done"))
+    target.organizations.tmz.session = OrganizationSession(existing={"existing", "down"}, unavailable={"down"})
+    ingests = [dict(ingest(1, "existing", 1), relation_id=10), dict(ingest(2, "down", 30), relation_id=20)]
+    target.organizations.prefetch(i["organization_id"] for i in ingests)
+    assert [i["order_id"] for i in target.filter_recent(ingests)] == [1]
+    assert target.failed_relations == {20}
+
+
+def test_recent_filter_doesnt_take_forbidden_organization_for_new(tmp_path):
+    target = ThirtyMHzTarget("key", "existing", str(tmp_path / "done"))
+    target.organizations.tmz.session = OrganizationSession(existing={"existing", "hidden"}, forbidden={"hidden"})
+    ingests = [dict(ingest(1, "existing", 1), relation_id=10), dict(ingest(2, "hidden", 30), relation_id=20)]
+    assert [i["order_id"] for i in target.filter_recent(ingests)] == [1]
+    assert target.failed_relations == {20}
+
+
+def test_sharing_skipped_for_missing_organization(tmp_path, monkeypatch):
+    target = ThirtyMHzTarget("key", "default", str(tmp_path / "done"))
+    target.organizations.tmz.session = OrganizationSession(
+        existing={"default", "existing", "hidden"}, forbidden={"hidden"}
+    )
+    shared = []
+    tmz = target.tmz.get_default()
+    monkeypatch.setattr(ThirtyMHz, "get", lambda self, base_url, organization=True: [])
+    monkeypatch.setattr(tmz.sensor_type, "create", lambda **kwargs: None)
+    monkeypatch.setattr(
+        tmz.share_sensor_type, "create", lambda id, organization_id: shared.append(organization_id)
+    )
+    target.write_sensor_types(
+        [
+            {"id": "type", "name": "Type", "schema": {}, "api_key": "key", "organization_id": o}
+            for o in ("existing", "missing", "hidden")
+        ]
+    )
+    assert shared == ["existing"]
+    # The forbidden organization is asked again, not remembered as missing
+    target.organizations.tmz.session.forbidden = set()
+    target.write_sensor_types(
+        [{"id": "type", "name": "Type", "schema": {}, "api_key": "key", "organization_id": "hidden"}]
+    )
+    assert shared == ["existing", "hidden"]
@@ -0,0 +1,102 @@
+import base64
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from efa_30mhz.errors import FileUnavailableError
+from efa_30mhz.files import prefetch
+from efa_30mhz.pdf import PDF
+
+
+class FakeService:
+    def __init__(self, missing=()):
+        self.calls = []
+        self.missing = missing
+        self.lock = threading.Lock()
+
+    def getResource(self, getResourcesRequest):
+        requested = getResourcesRequest["resources"][0]["ResourceRequestArray"]
+        if isinstance(requested, dict):
+            requested = [requested]
+        ids = [r["resourceId"] for r in requested]
+        with self.lock:
+            self.calls.append(ids)
+        if any(i in self.missing for i in ids):
+            return {"resources": None}
+        return {
+            "resources": {
+                "ResourceResponseArray": [
+                    {"resourceId": i, "resourceContent": base64.encodebytes(content(i)).decode()}
+                    for i in ids
+                ]
+            }
+        }
+
+
+def content(resource_id):
+    return f"%PDF {resource_id} ".encode() * 10000
+
+
+def pdf_with(service, **kwargs):
+    pdf = PDF(None, **kwargs)
+    pdf.client = SimpleNamespace(service=service)
+    return pdf
+
+
+def rows(relations, per_relation):
+    return [
+        {"relation_id": r, "resource_id": f"{r}-{i}"}
+        for r in range(relations)
+        for i in range(per_relation)
+    ]
+
+
+def test_get_pdf_decodes_to_spooled_file():
+    pdf = pdf_with(FakeService(), spool_size=1024)
+    f = pdf.get_pdf({"relation_id": 1, "resource_id": "a"})
+    assert f.read() == content("a")
+    assert f._rolled
+
+
+def test_get_pdfs_groups_resources_per_relation():
+    service = FakeService()
+    pdf = pdf_with(service, resources_per_request=3, workers=4)
+    files = pdf.get_pdfs(rows(relations=4, per_relation=5))
+    assert len(files) == 20
+    assert len(service.calls) == 8
+    assert files[(2, "2-4")].read() == content("2-4")
+
+
+def test_get_pdfs_skips_missing():
+    service = FakeService(missing={"1-1"})
+    pdf = pdf_with(service, resources_per_request=5)
+    files = pdf.get_pdfs(rows(relations=2, per_relation=3))
+    assert set(files) == {(0, "0-0"), (0, "0-1"), (0, "0-2"), (1, "1-0"), (1, "1-2")}
+
+
+def test_handle_fetches_only_when_opened():
+    service = FakeService()
+    pdf = pdf_with(service)
+    handles = [pdf.handle(row) for row in rows(relations=1, per_relation=3)]
+    assert service.calls == []
+    assert handles[1].open().read() == content("0-1")
+    assert service.calls == [["0-1"]]
+    assert [h.fetched for h in handles] == [False, True, False]
+
+
+def test_prefetch_handles():
+    service = FakeService()
+    pdf = pdf_with(service, resources_per_request=10)
+    handles = [pdf.handle(row) for row in rows(relations=2, per_relation=3)]
+    prefetch(handles[:4])
+    assert len(service.calls) == 2
+    assert handles[3].open().read() == content("1-0")
+    assert not handles[5].fetched
+    assert len(service.calls) == 2
+
+
+def test_missing_handle_is_unavailable():
+    pdf = pdf_with(FakeService(missing={"0-0"}))
+    with pytest.raises(FileUnavailableError):
+        pdf.handle({"relation_id": 0, "resource_id": "0-0"}).open()
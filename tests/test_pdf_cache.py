@@ -0,0 +1,58 @@
+import io
+import os
+from types import SimpleNamespace
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.pdf import PDF
+from efa_30mhz.pdf_cache import PDFCache
+from tests.test_pdf import FakeService, content
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_put_and_get(tmp_path):
+    cache = PDFCache(str(tmp_path))
+    f = io.BytesIO(b"report")
+    content_hash = cache.put(1, "a", f)
+    assert f.read() == b"report"
+    assert cache.get(1, "a").read() == b"report"
+    assert cache.get(1, "b") is None
+    assert os.path.exists(cache.path(content_hash))
+    assert PDFCache(str(tmp_path)).get(1, "a").read() == b"report"
+
+
+def test_lru_eviction(tmp_path):
+    cache = PDFCache(str(tmp_path), max_bytes=25)
+    cache.put(1, "a", io.BytesIO(b"a" * 10))
+    cache.put(1, "b", io.BytesIO(b"b" * 10))
+    cache.get(1, "a")
+    cache.put(1, "c", io.BytesIO(b"c" * 10))
+    assert cache.contains(1, "a")
+    assert not cache.contains(1, "b")
+    assert cache.contains(1, "c")
+    assert cache.total == 20
+
+
+def test_data_upload_id_per_content(tmp_path):
+    cache = PDFCache(str(tmp_path), max_bytes=5)
+    cache.put(1, "a", io.BytesIO(b"same report"))
+    cache.put(2, "b", io.BytesIO(b"same report"))
+    cache.set_data_upload_id(1, "a", "org", "upload-1")
+    assert cache.get_data_upload_id(2, "b", "org") == "upload-1"
+    assert cache.get_data_upload_id(2, "b", "other") is None
+    # Evicted files still remember their upload
+    assert not cache.contains(1, "a")
+    assert cache.get_data_upload_id(1, "a", "org") == "upload-1"
+
+
+def test_pdf_uses_cache(tmp_path):
+    service = FakeService()
+    pdf = PDF(None, cache={"directory": str(tmp_path)})
+    pdf.client = SimpleNamespace(service=service)
+    row = {"relation_id": 1, "resource_id": "a"}
+    assert pdf.get_pdf(row).read() == content("a")
+    assert pdf.get_pdf(row).read() == content("a")
+    assert pdf.get_pdfs([row])[(1, "a")].read() == content("a")
+    assert len(service.calls) == 1
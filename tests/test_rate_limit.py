@@ -0,0 +1,159 @@
+import asyncio
+import json
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.rate_limit import TokenBucket, RateLimiter, parse_retry_after
+from efa_30mhz.session import ThirtyMHzSession, SessionPool
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from tests.helpers import rows, target
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_parse_retry_after():
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after(format_datetime(now + timedelta(seconds=5), usegmt=True), now=now) == 5
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+def test_unlimited_until_throttled():
+    bucket = TokenBucket()
+    for _ in range(10):
+        assert bucket.acquire() == 0
+    bucket.throttled(retry_after=0.05)
+    assert bucket.rate is not None
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_rate_is_cut_once_per_throttle_and_recovers():
+    bucket = TokenBucket(rate=10, min_rate=1, max_rate=11, increase=0.5)
+    bucket.throttled(retry_after=0.01)
+    bucket.throttled(retry_after=0.01)
+    assert bucket.rate == 5
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 11
+
+
+def test_rate_limits_requests():
+    bucket = TokenBucket(rate=100, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_bucket_per_api_key_and_organization():
+    limiter = RateLimiter(rate=1)
+    assert limiter.get("a", "org") is limiter.get("a", "org")
+    assert limiter.get("a", "org") is not limiter.get("b", "org")
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.bodies.append(body)
+            throttled = self.server.throttles > 0
+            self.server.throttles -= 1
+        status = 429 if throttled else 200
+        data = json.dumps({"status": status}).encode()
+        self.send_response(status)
+        if throttled and self.server.retry_after is not None:
+            self.send_header("Retry-After", self.server.retry_after)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def throttling_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    server.lock = threading.Lock()
+    server.bodies = []
+    server.throttles = 0
+    server.retry_after = "0"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/api"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_retries_throttled_requests(throttling_server):
+    throttling_server.throttles = 2
+    bucket = TokenBucket()
+    session = ThirtyMHzSession(rate_limit=bucket)
+    assert session.get(throttling_server.url).status_code == 200
+    assert len(throttling_server.bodies) == 3
+    assert bucket.rate is not None
+
+
+def test_session_gives_up_after_throttle_retries(throttling_server):
+    throttling_server.throttles = 10
+    session = ThirtyMHzSession(rate_limit=TokenBucket(), throttle_retries=2)
+    assert session.get(throttling_server.url).status_code == 429
+    # urllib3 doesn't retry a 429 itself
+    assert len(throttling_server.bodies) == 3
+
+
+def test_session_resends_files(throttling_server):
+    throttling_server.throttles = 1
+    session = SessionPool(backoff_factor=0).get("key", "org")
+    with open(__file__, "rb") as f:
+        session.post(throttling_server.url, files={"file": ("report.pdf", f, "application/pdf")})
+    assert len(throttling_server.bodies) == 2
+    assert len(throttling_server.bodies[0]) == len(throttling_server.bodies[1])
+    assert b"test_session_resends_files" in throttling_server.bodies[1]
+
+
+def test_async_session_resends_streamed_files(throttling_server):
+    pytest.importorskip("aiohttp")
+    from efa_30mhz.async_thirty_mhz import AsyncThirtyMHzGetter
+
+    throttling_server.throttles = 1
+
+    async def run(f):
+        async with AsyncThirtyMHzGetter("key", "org", api_url=throttling_server.url) as getter:
+            await getter.get_default().data_upload.create(file=f)
+
+    with open(__file__, "rb") as f:
+        asyncio.run(run(f))
+        assert f.closed
+    assert len(throttling_server.bodies) == 2
+    assert len(throttling_server.bodies[0]) == len(throttling_server.bodies[1])
+    assert b"test_async_session_resends_streamed_files" in throttling_server.bodies[1]
+
+
+def test_no_ingest_lost_when_throttled(tmp_path):
+    with ThirtyMHzSimulator(seed=1, rate_limit=20, burst=5) as simulator:
+        t = target(simulator, tmp_path, concurrency={"workers": 4, "per_organization": 4})
+        t.write(rows(20))
+        assert simulator.statuses[429] > 0
+        [import_check] = simulator.import_checks["tenant"]
+        assert len(simulator.events[import_check["checkId"]]) == 20
+    with open(tmp_path / "done") as f:
+        assert len(f.read().split("\n")) == 20
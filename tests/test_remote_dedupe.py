@@ -0,0 +1,113 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from efa_30mhz.store import RemoteOrderIds
+from efa_30mhz.thirty_mhz import RemoteDedupeIndex, SamplesGetter, STATS_DATE_FORMAT
+from tests.helpers import FakeStatsSession, rows, target
+
+
+class OrderIdsSession(FakeStatsSession):
+    def __init__(self, stats, failing=()):
+        super(OrderIdsSession, self).__init__(stats)
+        self.order_ids = stats
+        self.failing = failing
+
+    def stats(self, check, from_date, end_date):
+        if check in self.failing:
+            return None
+        return {
+            str(i): {"type.order_sample_data_id": order_id, "type.research_number": "R"}
+            for i, order_id in enumerate(self.order_ids[check])
+        }
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def parse(date):
+    return datetime.strptime(date, STATS_DATE_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def index(session, **kwargs):
+    return RemoteDedupeIndex(SamplesGetter("key", "org", session=session), **kwargs)
+
+
+def test_index_fetches_once_concurrently():
+    session = OrderIdsSession({"a": [1, 2.0], "b": ["3"], "c": [], "d": [4]})
+    remote = index(session, workers=4)
+    assert 1 in remote and 2 in remote and "3" in remote and 4 in remote
+    assert 5 not in remote
+    assert len(session.windows) == 4
+    assert session.max_in_flight > 1
+    from_date, end_date = map(parse, session.windows[0])
+    assert timedelta(days=6.9) < end_date - from_date < timedelta(days=7.1)
+
+
+def test_index_is_incremental_with_store(tmp_path):
+    store_path = str(tmp_path / "state.sqlite")
+    first = OrderIdsSession({"a": [1, 2]})
+    assert 1 in index(first, store=RemoteOrderIds(store_path))
+    second = OrderIdsSession({"a": [3]})
+    remote = index(second, store=RemoteOrderIds(store_path), overlap_hours=1)
+    assert 1 in remote and 3 in remote
+    from_date, end_date = map(parse, second.windows[0])
+    assert end_date - from_date < timedelta(hours=1, minutes=1)
+
+
+def test_failed_import_check_is_queried_again(tmp_path):
+    store_path = str(tmp_path / "state.sqlite")
+    first = OrderIdsSession({"a": [1], "b": [2]}, failing={"b"})
+    remote = index(first, store=RemoteOrderIds(store_path))
+    assert 1 in remote and 2 not in remote
+    assert RemoteOrderIds(store_path).get_synced_until() is None
+    second = OrderIdsSession({"a": [1], "b": [2]})
+    assert 2 in index(second, store=RemoteOrderIds(store_path))
+    from_date, end_date = map(parse, second.windows[0])
+    assert end_date - from_date > timedelta(days=6)
+
+
+def test_target_skips_samples_already_in_tenant_organization(tmp_path):
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    with ThirtyMHzSimulator() as simulator:
+        target(simulator, tmp_path / "first").write(rows(3))
+        [import_check] = simulator.import_checks["tenant"]
+        assert len(simulator.events[import_check["checkId"]]) == 3
+
+        # The default organization has none of the samples, the tenant has the first three
+        second = target(simulator, tmp_path / "second")
+        second.write(rows(5))
+        assert len(simulator.events[import_check["checkId"]]) == 5
+        stored = [e["data"]["order_sample_data_id"] for e in simulator.events[import_check["checkId"]]]
+        assert sorted(stored) == list(range(5))
+        assert set(second.remote_indexes) == {("tenant-key", "tenant")}
+        with open(tmp_path / "second" / "done") as f:
+            assert f.read() == "3\n4"
+
+
+def test_indexes_of_organizations_keep_their_own_window(tmp_path):
+    store = RemoteOrderIds(str(tmp_path / "state.sqlite"))
+    assert 1 in index(OrderIdsSession({"a": [1]}), store=store)
+    other = OrderIdsSession({"a": [2]})
+    assert 2 in index(other, store=store, scope="other")
+    from_date, end_date = map(parse, other.windows[0])
+    assert end_date - from_date > timedelta(days=6)
+    assert store.get_synced_until("other") is not None
+    # Every index only loads the ids of its own scope
+    assert 1 not in index(OrderIdsSession({}), store=store, scope="other")
+    assert store.get_all() == {1}
+    assert store.get_all("other") == {2}
+
+
+def test_store_without_scopes_keeps_ids_of_default_organization(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE remote (id INTEGER PRIMARY KEY)")
+        db.executemany("INSERT INTO remote (id) VALUES (?)", [(1,), (2,)])
+    db.close()
+    store = RemoteOrderIds(path)
+    assert store.get_all() == {1, 2}
+    assert store.get_all("other") == set()
@@ -0,0 +1,93 @@
+import csv
+
+import pytest
+
+from efa_30mhz.thirty_mhz import SamplesGetter, ThirtyMHzError
+from tests.helpers import FakeStatsSession
+
+
+class DailyStatsSession(FakeStatsSession):
+    """
+    Two import checks with one sample per day, the stats of check "b" fail for one window.
+    """
+
+    def __init__(self, failing_from=None):
+        super(DailyStatsSession, self).__init__(("a", "b"))
+        self.failing_from = failing_from
+
+    def stats(self, check, from_date, end_date):
+        if check == "b" and from_date == self.failing_from:
+            return None
+        day = int(from_date[8:10])
+        days = int(end_date[8:10]) - day
+        return {
+            str(1609459200000 + (day - 1 + i) * 86400000): {
+                "type.research_number": f"{check}-{day + i}",
+                "type.sample_description": "Sample",
+                "type.file": "file",
+                "type.order_sample_data_id": day + i,
+            }
+            for i in range(days)
+        }
+
+
+def getter(session, **kwargs):
+    return SamplesGetter("key", "org", session=session, **kwargs)
+
+
+def test_windows():
+    windows = getter(None, window_days=10).get_windows("2021-01-01T00:00:00Z", "2021-01-25T00:00:00Z")
+    assert windows == [
+        ("2021-01-01T00:00:00Z", "2021-01-11T00:00:00Z"),
+        ("2021-01-11T00:00:00Z", "2021-01-21T00:00:00Z"),
+        ("2021-01-21T00:00:00Z", "2021-01-25T00:00:00Z"),
+    ]
+
+
+def test_samples_of_all_windows_in_one_frame():
+    session = DailyStatsSession()
+    samples = getter(session, workers=4, window_days=5).get_all_samples_for_user_from_until(
+        "2021-01-01T00:00:00Z", "2021-01-21T00:00:00Z"
+    )
+    assert len(session.urls) == 8
+    assert session.max_in_flight > 1
+    assert list(samples.columns) == SamplesGetter.column_names
+    assert samples["research_number"].tolist() == [f"{c}-{d}" for c in "ab" for d in range(1, 21)]
+    assert samples["timestamp"].iloc[0] == "2021-01-01 00:00:00"
+
+
+def test_failed_window_does_not_drop_the_rest():
+    session = DailyStatsSession(failing_from="2021-01-06T00:00:00Z")
+    samples_getter = getter(session, workers=2, window_days=5)
+    samples = samples_getter.get_all_samples_for_user_from_until(
+        "2021-01-01T00:00:00Z", "2021-01-21T00:00:00Z"
+    )
+    assert len(samples) == 35
+    assert samples_getter.failed_windows == [("b", "2021-01-06T00:00:00Z", "2021-01-11T00:00:00Z")]
+
+
+def test_export_csv(tmp_path):
+    path = str(tmp_path / "samples.csv")
+    written = getter(DailyStatsSession(), window_days=7).export(
+        "2021-01-01T00:00:00Z", "2021-01-21T00:00:00Z", path
+    )
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert written == len(rows) == 40
+    assert rows[0]["order_sample_data_id"] == "1"
+
+
+def test_export_unknown_format(tmp_path):
+    with pytest.raises(ThirtyMHzError):
+        getter(DailyStatsSession()).export("2021-01-01", "2021-01-02", str(tmp_path / "x"), format="xlsx")
+
+
+def test_export_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pandas
+
+    path = str(tmp_path / "samples.parquet")
+    assert getter(DailyStatsSession(), window_days=7).export(
+        "2021-01-01T00:00:00Z", "2021-01-21T00:00:00Z", path, format="parquet"
+    ) == 40
+    assert len(pandas.read_parquet(path)) == 40
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from efa_30mhz.thirty_mhz import ThirtyMHz, ThirtyMHzError, ThirtyMHzGetter
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests += 1
+            status = 503 if self.server.failures > 0 else 200
+            self.server.failures -= 1
+        time.sleep(self.server.delay)
+        body = json.dumps([] if status == 200 else {"error": "unavailable"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    server.failures = 0
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    root = f"http://127.0.0.1:{server.server_address[1]}/api"
+    monkeypatch.setattr(
+        ThirtyMHz, "api_url", root + "/{base_url}/organization/{organization}"
+    )
+    monkeypatch.setattr(ThirtyMHz, "api_url_no_organization", root + "/{base_url}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_getter_reuses_connection(stub_server):
+    getter = ThirtyMHzGetter("key", "org")
+    for _ in range(20):
+        getter.get_default().get("sensor-type")
+        getter.get({"api_key": "key", "organization_id": "org"}).post("ingest", [])
+    assert stub_server.requests == 40
+    assert stub_server.connections == 1
+
+
+def test_getter_session_per_tenant(stub_server):
+    getter = ThirtyMHzGetter("key", "org")
+    getter.get_default().get("sensor-type")
+    getter.get({"api_key": "other", "organization_id": "other"}).get("sensor-type")
+    getter.get_default().get("sensor-type")
+    assert stub_server.connections == 2
+
+
+def test_retry_on_server_error(stub_server):
+    stub_server.failures = 2
+    getter = ThirtyMHzGetter("key", "org", http={"backoff_factor": 0})
+    assert getter.get_default().get("sensor-type") == []
+    assert stub_server.requests == 3
+
+
+def test_no_retry_of_post_on_server_error(stub_server):
+    stub_server.failures = 1
+    getter = ThirtyMHzGetter("key", "org", http={"backoff_factor": 0})
+    with pytest.raises(ThirtyMHzError):
+        getter.get_default().post("ingest", [])
+    assert stub_server.requests == 1
+
+
+def test_timeout_raises_thirty_mhz_error(stub_server):
+    stub_server.delay = 0.5
+    getter = ThirtyMHzGetter("key", "org", http={"read_timeout": 0.1, "retries": 0})
+    with pytest.raises(ThirtyMHzError):
+        getter.get_default().get("sensor-type")
+    with pytest.raises(ThirtyMHzError):
+        getter.get_default().post("ingest", [])
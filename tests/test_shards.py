@@ -0,0 +1,165 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import pytest
+
+import efa_30mhz.constants as cst
+from benchmarks.bench_sync import create_config
+from benchmarks.synthetic import auth_rows, eurofins_rows
+from efa_30mhz.metrics import MemoryStatsClient, Metric
+from efa_30mhz.rate_limit import TokenBucket
+from efa_30mhz.shards import merge_done_files, merge_stats, send_stats, shard_of, shard_rate_limit
+from efa_30mhz.simulator.eurofins import EurofinsSimulator
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from scripts.sync import do_sync
+
+OPTIONS = {
+    "ingest_batch": True,
+    "workers": 2,
+    "in_flight": None,
+    "chunk_size": None,
+    "pipeline_workers": None,
+    "shards": None,
+}
+
+
+def test_shard_of_is_stable():
+    assert shard_of(1234, 4) == zlib.crc32(b"1234") % 4
+    assert shard_of(1234, 4) == shard_of("1234", 4)
+    assert {shard_of(relation, 3) for relation in range(100)} == {0, 1, 2}
+
+
+def test_merge_done_files(tmp_path):
+    paths = [str(tmp_path / f"out.shard{i}") for i in range(3)]
+    with open(paths[0], "w") as f:
+        f.write("1\n2")
+    with open(paths[2], "w") as f:
+        f.write("3\n")
+    out = str(tmp_path / "out")
+
+    assert merge_done_files(paths, out) == ["1", "2", "3"]
+    with open(out) as f:
+        assert f.read() == "1\n2\n3"
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_merge_stats_sums_last_gauges():
+    merged = merge_stats(
+        [
+            ["a:1|c", "g:5|g", "g:7|g", ""],
+            ["a:2|c", "g:3|g", "t:10|ms", "s:x|s"],
+        ]
+    )
+    assert sorted(merged) == ["a:1|c", "a:2|c", "g:10|g", "s:x|s", "t:10|ms"]
+
+
+def test_send_stats_adds_prefix():
+    client = MemoryStatsClient(prefix="efa")
+    with client.pipeline() as pipe:
+        send_stats(pipe, ["a:2|c", "b:1|c|@0.5", "g:10|g", "d:-1|g", "t:1.5|ms", "s:x|s"])
+    assert client.stats == [
+        "efa.a:2|c", "efa.b:2|c", "efa.g:10|g", "efa.d:-1|g", "efa.t:1.500000|ms", "efa.s:x|s"
+    ]
+
+
+def test_clients_import_without_fcntl():
+    # Like on Windows, only the lock of sharded runs needs it
+    code = "import sys; sys.modules['fcntl'] = None; import efa_30mhz.thirty_mhz, efa_30mhz.eurofins"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_shard_rate_limits_add_up_to_the_configured_limit():
+    assert shard_rate_limit({"rate": 9, "max_rate": 12, "burst": 6, "increase": 0.1}, 3) == {
+        "rate": 3, "max_rate": 4, "min_rate": 0.5 / 3, "burst": 2, "increase": 0.1
+    }
+    assert shard_rate_limit({}, 10)["burst"] == 1
+
+    # The buckets of the shards together let no more requests out than one bucket with the configured limit
+    buckets = [TokenBucket(**shard_rate_limit({"rate": 40, "max_rate": 40, "burst": 4}, 4)) for _ in range(4)]
+    sent = []
+    deadline = time.monotonic() + 0.5
+
+    def shard(bucket):
+        while time.monotonic() < deadline:
+            bucket.acquire()
+            sent.append(1)
+            bucket.succeeded()
+
+    threads = [threading.Thread(target=shard, args=(bucket,)) for bucket in buckets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(sent) <= 40 * 0.5 + 4
+
+
+def sync_with(directory, shards):
+    """
+    Syncs the synthetic rows against fresh stand-ins.
+    :return: the done ids, the 30MHz stand-in and the stats of the run
+    """
+    os.makedirs(directory)
+    samples_file = os.path.join(directory, "samples.json")
+    auth_file = os.path.join(directory, "auth.json")
+    with open(samples_file, "w") as f:
+        json.dump(eurofins_rows(300, relations=12), f)
+    with open(auth_file, "w") as f:
+        json.dump(auth_rows(12, without_api_key=4), f)
+    open(os.path.join(directory, "already_done_in"), "w").close()
+    Metric.initialize_client(backend="memory", buffer=False)
+    with ThirtyMHzSimulator() as thirty_mhz, EurofinsSimulator(document_size=64) as eurofins:
+        config = create_config(
+            directory, samples_file, auth_file, thirty_mhz.url, eurofins.wsdl, OPTIONS
+        )
+        do_sync(config, shards=shards)
+    with open(os.path.join(directory, "already_done_in")) as f:
+        done = [line.strip() for line in f if line.strip()]
+    return done, thirty_mhz, Metric.client()
+
+
+def events_per_check(thirty_mhz):
+    # Check and data upload ids are random per stand-in
+    return {
+        (organization, i["sourceId"]): sorted(
+            json.dumps(dict(e, checkId=None, data=dict(e["data"], file=None)), sort_keys=True)
+            for e in thirty_mhz.events[i["checkId"]]
+        )
+        for organization, import_checks in thirty_mhz.import_checks.items()
+        for i in import_checks
+    }
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    # The shards log to app*.log files in the working directory they inherit
+    monkeypatch.chdir(tmp_path)
+    yield sync_with(str(tmp_path / "single"), None), sync_with(str(tmp_path / "sharded"), 3)
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_sharded_sync_equals_single_run(runs, tmp_path):
+    (single_done, single, single_stats), (sharded_done, sharded, sharded_stats) = runs
+    assert {path.name.split(".")[1] for path in tmp_path.glob("app*.log")} == {"shard0", "shard1", "shard2"}
+
+    assert single_done
+    assert len(sharded_done) == len(set(sharded_done))
+    assert set(sharded_done) == set(single_done)
+    assert events_per_check(sharded) == events_per_check(single)
+    for organization, sensor_types in sharded.sensor_types.items():
+        ids = [s["radioId"] for s in sensor_types]
+        assert len(ids) == len(set(ids)), organization
+    assert {o: len(s) for o, s in sharded.sensor_types.items()} == {
+        o: len(s) for o, s in single.sensor_types.items()
+    }
+    assert sharded.uploads == single.uploads
+    assert sharded_stats.count(cst.STATS_30MHZ_INGESTS_SUCCESS) == single_stats.count(
+        cst.STATS_30MHZ_INGESTS_SUCCESS
+    )
+    assert set(sharded_stats.values(cst.STATS_APP_SAMPLES_DONE)) == set(
+        single_stats.values(cst.STATS_APP_SAMPLES_DONE)
+    )
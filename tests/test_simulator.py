@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+import requests
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.thirty_mhz import SamplesGetter
+from tests.helpers import CountedFile, PrefetchingLoader, rows, target
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def test_target_against_simulator(simulator, tmp_path):
+    target(simulator, tmp_path).write(rows(5))
+    assert [s["radioId"] for s in simulator.sensor_types["default"]] == ["210_v1"]
+    assert [s["radioId"] for s in simulator.sensor_types["tenant"]] == ["210_v1"]
+    [import_check] = simulator.import_checks["tenant"]
+    assert len(simulator.events[import_check["checkId"]]) == 5
+    assert simulator.uploads == 5
+    with open(tmp_path / "done") as f:
+        assert f.read() == "0\n1\n2\n3\n4"
+
+    samples = SamplesGetter("tenant-key", "tenant", api_url=simulator.url).get_all_samples_for_user_from_until(
+        datetime.now(pytz.utc) - timedelta(days=2), datetime.now(pytz.utc)
+    )
+    assert sorted(samples["order_sample_data_id"]) == [0, 1, 2, 3, 4]
+
+
+def test_simulator_errors_fail_ingests(simulator, tmp_path):
+    t = target(simulator, tmp_path)
+    sensor_types, import_checks, ingests, ids = rows(3)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    simulator.error_rate = 1.0
+    t.get_remote_index("tenant-key", "tenant").ids = set()
+    assert t.write_ingests(ingests) == []
+    assert t.failed_relations == {1}
+    assert simulator.statuses[500] > 0
+
+
+def test_simulator_throttles_per_api_key(simulator):
+    simulator.rate_limit = 1
+    simulator.burst = 2
+    url = simulator.url + "/sensor-type/organization/org"
+    statuses = [requests.get(url, headers={"Authorization": "a"}).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    assert requests.get(url, headers={"Authorization": "b"}).status_code == 200
+    response = requests.get(url, headers={"Authorization": "a"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_sharing_skipped_for_unknown_organization(simulator, tmp_path):
+    simulator.organizations = {"default"}
+    sensor_types, import_checks, _, _ = rows(0)
+    target(simulator, tmp_path).write_sensor_types(sensor_types)
+    assert "tenant" not in simulator.sensor_types
+
+
+def test_partly_failed_batch_is_stored_once(simulator, tmp_path):
+    t = target(simulator, tmp_path)
+    sensor_types, import_checks, ingests, _ = rows(5)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    tmz = t.tmz.get(import_checks[0])
+    check = tmz.import_check.get(id=import_checks[0]["id"])
+    items = [(i["order_id"], check, i["data"]) for i in ingests[:4]]
+    items.append((4, {"checkId": "unknown"}, ingests[4]["data"]))
+    assert tmz.import_check.ingest_batch(items, max_events=10) == []
+    assert len(simulator.events[check["checkId"]]) == 4
+
+
+@pytest.mark.parametrize("options", [{}, {"ingest_batch": {"max_events": 10}}, {"asynchronous": {}}])
+def test_files_are_prefetched_in_windows(simulator, tmp_path, options):
+    if "asynchronous" in options:
+        pytest.importorskip("aiohttp")
+    loader = PrefetchingLoader()
+    sensor_types, import_checks, ingests, _ = rows(50)
+    for ingest in ingests:
+        ingest["data"][0]["file"] = CountedFile(loader)
+    # Their files are fetched but never uploaded
+    ingests[3]["id"] = ingests[40]["id"] = "unknown"
+    t = target(simulator, tmp_path, prefetch_window=10, **options)
+    t.write_sensor_types(sensor_types)
+    t.write_import_checks(import_checks)
+    t.get_remote_index("tenant-key", "tenant").ids = set()
+
+    assert len(t.write_ingests(ingests)) == 48
+    assert loader.max_open <= 20
+    assert loader.open == 0
+    assert simulator.uploads == 48
@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import pytest
+
+from efa_30mhz.store import DoneStore, HighWaterMarks
+
+
+def test_done_store_membership(tmp_path):
+    store = DoneStore(str(tmp_path / "state.sqlite"))
+    store.add_many([1, 2, "3"])
+    store.add_many([3, 4])
+    assert 3 in store and "4" in store
+    assert 5 not in store
+    assert len(store) == 4
+    store.close()
+    assert 1 in DoneStore(str(tmp_path / "state.sqlite"))
+
+
+def test_done_store_batch_is_atomic(tmp_path):
+    store = DoneStore(str(tmp_path / "state.sqlite"))
+
+    def ids():
+        yield 1
+        raise ValueError("broken batch")
+
+    with pytest.raises(ValueError):
+        store.add_many(ids())
+    assert len(store) == 0
+
+
+def test_done_store_import_file(tmp_path):
+    already_done = tmp_path / "already_done"
+    already_done.write_text("1\n2\n\n3")
+    store = DoneStore(str(tmp_path / "state.sqlite"))
+    store.import_file(str(already_done))
+    store.import_file(str(tmp_path / "missing"))
+    store.compact()
+    assert len(store) == 3
+
+
+def test_high_water_marks_only_advance(tmp_path):
+    marks = HighWaterMarks(str(tmp_path / "state.sqlite"))
+    marks.advance({1: "2021-05-01T00:00:00", 2: datetime(2021, 5, 1)})
+    marks.advance({1: datetime(2021, 4, 1), 2: "2021-06-01T00:00:00", 3: None})
+    assert marks.get_all() == {"1": datetime(2021, 5, 1), "2": datetime(2021, 6, 1)}
@@ -1,4 +1,6 @@
-from efa_30mhz.sync import Source, Target, Sync
+import threading
+
+from efa_30mhz.sync import Source, Target, Sync, chunked
 
 
 def test_generic_source_target():
@@ -35,3 +37,110 @@ def test_generic_source_target():
     with Sync(GenericSource, {}, GenericTarget, {}) as sync:
         sync.start()
     assert GenericTarget.rows == GenericSource.rows
+
+
+def test_chunked():
+    assert list(chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked([], 3)) == []
+
+
+class CountingSource(Source):
+    def __init__(self, n, **kwargs):
+        super().__init__(**kwargs)
+        self.n = n
+        self.read = 0
+
+    def read_all(self):
+        return list(self.iter_rows())
+
+    def iter_rows(self):
+        for i in range(self.n):
+            self.read += 1
+            yield {"id": i, "organization_id": f"org-{i % 2}"}
+
+    def to_thirty_mhz(self, rows):
+        sensor_types = [{"id": "type", "organization_id": r["organization_id"]} for r in rows]
+        return sensor_types, [], [r["id"] for r in rows], [r["id"] for r in rows]
+
+
+class RecordingTarget(Target):
+    def __init__(self, source, **kwargs):
+        super().__init__(**kwargs)
+        self.source = source
+        self.writes = []
+        self.read_at_write = []
+
+    def write(self, rows):
+        self.read_at_write.append(self.source.read)
+        self.writes.append(rows)
+
+
+def test_sync_streams_bounded_chunks():
+    source = CountingSource(25)
+    target = RecordingTarget(source)
+    Sync(source, target, chunk_size=10).start()
+    assert [len(ids) for _, _, _, ids in target.writes] == [10, 10, 5]
+    # A chunk is written before the rows of the next one are read
+    assert target.read_at_write == [10, 20, 25]
+    assert [i for _, _, ingests, _ in target.writes for i in ingests] == list(range(25))
+
+
+def test_sync_without_chunk_size_writes_once():
+    source = CountingSource(25)
+    target = RecordingTarget(source)
+    Sync(source, target).start()
+    assert len(target.writes) == 1
+    assert len(target.writes[0][3]) == 25
+
+
+class PartitionedSource(CountingSource):
+    def __init__(self, partitions, **kwargs):
+        super().__init__(0, **kwargs)
+        self.partitions = partitions
+
+    def iter_partitions(self):
+        for key, rows in self.partitions.items():
+            yield key, rows
+
+
+def test_sync_partitions_isolate_failures():
+    slow_started = threading.Event()
+    fast_written = threading.Event()
+
+    def slow():
+        slow_started.set()
+        # Only continues once the fast partition is written, so it can't block it
+        assert fast_written.wait(5)
+        yield {"id": 0, "organization_id": "slow"}
+
+    def failing():
+        raise RuntimeError("tenant rejected")
+        yield
+
+    def fast():
+        assert slow_started.wait(5)
+        yield {"id": 1, "organization_id": "fast"}
+
+    source = PartitionedSource({"slow": slow, "failing": failing, "fast": fast})
+
+    class SignallingTarget(RecordingTarget):
+        def write(self, rows):
+            super().write(rows)
+            if rows[3] == [1]:
+                fast_written.set()
+
+    target = SignallingTarget(source)
+    synchronization = Sync(source, target, workers=3)
+    synchronization.start()
+    assert synchronization.failed_partitions == ["failing"]
+    assert [ids for _, _, _, ids in target.writes] == [[1], [0]]
+
+
+def test_sync_partitions_chunked():
+    source = PartitionedSource({
+        "a": lambda: ({"id": i, "organization_id": "a"} for i in range(5)),
+        "b": lambda: iter([]),
+    })
+    target = RecordingTarget(source)
+    Sync(source, target, chunk_size=2, workers=2).start()
+    assert [ids for _, _, _, ids in target.writes] == [[0, 1], [2, 3], [4]]
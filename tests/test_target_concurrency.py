@@ -0,0 +1,175 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from efa_30mhz.metrics import Metric
+from efa_30mhz.simulator.thirty_mhz import ThirtyMHzSimulator
+from efa_30mhz.thirty_mhz import ThirtyMHz, ThirtyMHzGetter, ThirtyMHzTarget
+from tests.helpers import rows
+
+
+class SlowThirtyMHz(ThirtyMHz):
+    in_flight = {}
+    max_in_flight = {}
+    lock = threading.Lock()
+
+    def get(self, base_url, organization=True):
+        return [{"sourceId": "check", "checkId": "check"}]
+
+    def post(self, base_url, data=None, files=None, organization=True):
+        cls = SlowThirtyMHz
+        with cls.lock:
+            cls.in_flight[self.organization] = cls.in_flight.get(self.organization, 0) + 1
+            cls.max_in_flight[self.organization] = max(
+                cls.max_in_flight.get(self.organization, 0),
+                cls.in_flight[self.organization],
+            )
+        time.sleep(0.01)
+        with cls.lock:
+            cls.in_flight[self.organization] -= 1
+        # A request with a failing event is rejected as a whole
+        if any(event["data"]["order_sample_data_id"] % 7 == 0 for event in data):
+            return {"okEventsNo": 0, "failedEventsNo": len(data)}
+        return {"okEventsNo": len(data), "failedEventsNo": 0}
+
+
+class SlowGetter(ThirtyMHzGetter):
+    def get_by_api_key(self, api_key, organization):
+        with self.lock:
+            if (api_key, organization) not in self.tmzs:
+                self.tmzs[(api_key, organization)] = SlowThirtyMHz(api_key, organization)
+            return self.tmzs[(api_key, organization)]
+
+
+def setup_module():
+    Metric.initialize_client(host="localhost", port=8125)
+
+
+def ingests(n, organizations=3):
+    return [
+        {
+            "id": "check",
+            "order_id": i,
+            "data": [{"datetime": datetime(2021, 1, 1), "order_sample_data_id": i}],
+            "api_key": "key",
+            "organization_id": f"org-{i % organizations}",
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def target(monkeypatch, tmp_path):
+    def create(**kwargs):
+        target = ThirtyMHzTarget("key", "org-0", str(tmp_path / "done"), **kwargs)
+        target.tmz = SlowGetter("key", "org-0")
+        monkeypatch.setattr(target, "filter_existing_order_sample_data_ids", lambda i: i)
+        SlowThirtyMHz.max_in_flight = {}
+        return target
+
+    return create
+
+
+def test_concurrent_done_ids_match_serial(target):
+    serial = target().write_ingests(ingests(60))
+    concurrent = target(concurrency={"workers": 8, "per_organization": 2}).write_ingests(
+        ingests(60)
+    )
+    assert concurrent == serial
+    assert concurrent == [i for i in range(60) if i % 7 != 0]
+
+
+def test_concurrent_per_organization_cap(target):
+    t = target(concurrency={"workers": 16, "per_organization": 2})
+    t.write_ingests(ingests(60))
+    assert set(SlowThirtyMHz.max_in_flight) == {"org-0", "org-1", "org-2"}
+    assert max(SlowThirtyMHz.max_in_flight.values()) <= 2
+
+
+def test_concurrent_batched(target):
+    t = target(
+        concurrency={"workers": 4}, ingest_batch={"max_events": 5, "max_bytes": 10000}
+    )
+    assert t.write_ingests(ingests(60)) == [i for i in range(60) if i % 7 != 0]
+
+
+def test_write_stream(target, monkeypatch, tmp_path):
+    t = target()
+    set_up = []
+    monkeypatch.setattr(t.organizations, "fetch", lambda organization: None)
+    monkeypatch.setattr(t, "write_sensor_types", lambda s: set_up.extend(x["id"] for x in s))
+    monkeypatch.setattr(
+        t, "write_import_checks", lambda c: set_up.extend(x["id"] for x in c)
+    )
+    all_ingests = ingests(30)
+    chunks = [
+        (
+            [{"id": "type", "organization_id": "org-0"}],
+            [{"id": "check", "organization_id": "org-0"}],
+            all_ingests[start: start + 10],
+            [i["order_id"] for i in all_ingests[start: start + 10]],
+        )
+        for start in range(0, 30, 10)
+    ]
+    t.write_stream(chunks)
+    assert set_up == ["type", "check"]
+    with open(tmp_path / "done") as f:
+        assert list(map(int, f.read().split("\n"))) == [i for i in range(30) if i % 7 != 0]
+
+
+def test_write_chunk_waits_for_set_up_of_other_chunk(target, monkeypatch, tmp_path):
+    t = target()
+    monkeypatch.setattr(t.organizations, "fetch", lambda organization: None)
+    sensor_type_started = threading.Event()
+    events = []
+
+    def write_sensor_types(sensor_types):
+        if sensor_types:
+            sensor_type_started.set()
+            time.sleep(0.05)
+            events.append("sensor type set up")
+
+    monkeypatch.setattr(t, "write_sensor_types", write_sensor_types)
+    monkeypatch.setattr(t, "write_import_checks", lambda c: None)
+    write_ingests = t.write_ingests
+
+    def record_ingests(i):
+        events.append("ingest")
+        return write_ingests(i)
+
+    monkeypatch.setattr(t, "write_ingests", record_ingests)
+    sensor_types = [{"id": "type", "organization_id": "org-0"}]
+    chunks = [(sensor_types, [], ingests(10)[start: start + 5], []) for start in (0, 5)]
+    t.start_stream()
+    first = threading.Thread(target=t.write_chunk, args=(chunks[0],))
+    first.start()
+    assert sensor_type_started.wait(5)
+    t.write_chunk(chunks[1])
+    first.join()
+    t.finish_stream()
+    assert events == ["sensor type set up", "ingest", "ingest"]
+    with open(tmp_path / "done") as f:
+        assert sorted(map(int, f.read().split("\n"))) == [i for i in range(10) if i % 7 != 0]
+
+
+def test_default_sensor_type_created_once_for_concurrent_tenants(tmp_path):
+    with ThirtyMHzSimulator(latency=0.02) as simulator:
+        t = ThirtyMHzTarget(
+            "default-key", "default", str(tmp_path / "done"), api_url=simulator.url, http={"backoff_factor": 0}
+        )
+        threads = [
+            threading.Thread(
+                target=t.write_sensor_types,
+                args=(rows(1, organization=f"tenant-{i}", api_key=f"key-{i}")[0],),
+            )
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [s["radioId"] for s in simulator.sensor_types["default"]] == ["210_v1"]
+        for i in range(3):
+            assert [s["radioId"] for s in simulator.sensor_types[f"tenant-{i}"]] == ["210_v1"]
@@ -0,0 +1,89 @@
+import pstats
+import threading
+import time
+
+import pytest
+
+from efa_30mhz.sync import Sync
+from efa_30mhz.tracing import Tracer, span, traced, profiled
+from tests.test_sync import CountingSource, RecordingTarget
+
+
+@pytest.fixture
+def tracer():
+    tracer = Tracer.get()
+    tracer.reset()
+    tracer.enable()
+    yield tracer
+    tracer.disable()
+    tracer.reset()
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer.get()
+    tracer.reset()
+    with span("stage", organization="a"):
+        pass
+    assert list(tracer.iterate("rows", [1, 2])) == [1, 2]
+    assert tracer.summary() == []
+
+
+def test_spans_aggregate_per_name_and_tag(tracer):
+    for organization in ["a", "a", "b"]:
+        with span("30mhz.ingest", organization=organization):
+            pass
+    with pytest.raises(ValueError):
+        with span("30mhz.ingest", organization="b"):
+            raise ValueError()
+
+    [row] = tracer.summary()
+    assert row["name"] == "30mhz.ingest"
+    assert row["count"] == 4
+    assert row["errors"] == 1
+    per_organization = {row["organization"]: row["count"] for row in tracer.summary(by="organization")}
+    assert per_organization == {"a": 2, "b": 2}
+    assert "30mhz.ingest" in tracer.format_summary(by="organization")
+
+
+def test_iterate_excludes_consumer_time(tracer):
+    def rows():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    for _ in tracer.iterate("source.read", rows(), relation=1):
+        time.sleep(0.05)
+
+    [row] = tracer.summary(by="relation")
+    assert row["count"] == 1
+    assert 0.03 <= row["seconds"] < 0.1
+
+
+def test_traced_tags_from_arguments(tracer):
+    @traced("pdf.get", tags=lambda row: {"relation": row["relation_id"]})
+    def get_pdf(row):
+        return row["resource_id"]
+
+    assert get_pdf({"relation_id": 1, "resource_id": 2}) == 2
+    assert tracer.summary(by="relation")[0]["relation"] == 1
+
+
+def test_sync_stages(tracer):
+    source = CountingSource(10)
+    Sync(source, RecordingTarget(source), chunk_size=4).start()
+    names = {row["name"]: row["count"] for row in tracer.summary()}
+    assert names == {"sync": 1, "sync.convert": 3, "sync.write": 3}
+
+
+def test_profiled_includes_threads(tmp_path):
+    def work():
+        sum(range(1000))
+
+    path = str(tmp_path / "run.prof")
+    with profiled(path):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    functions = {name for _, _, name in pstats.Stats(path).stats}
+    assert "work" in functions